@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+
+"""X-Carve Microscope Tool Headless Batch Processor"""
+
+import argparse
+import copy
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+import yaml
+
+import cv2
+
+import cnc_video
+import util
+import video
+
+
+'''
+DESIGN NOTES:
+  * Runs the same processing/overlay/measurement pipeline as the interactive
+    tool, but without any HighGUI calls (i.e., no imshow()/waitKey()), so
+    frames are processed as fast as the CPU allows.
+  * Each input is either a video file or a directory of still images.
+  * Inputs are independent, so they can be farmed out to a process pool.
+  * Annotated outputs are named after their inputs, so inputs with the same
+    name (e.g., in different directories) get their index as a prefix.
+'''
+
+IMAGE_EXTENSIONS = (".bmp", ".jpg", ".jpeg", ".png", ".tif", ".tiff")
+
+DEF_OUTPUT_FOURCC = "MJPG"
+DEF_OUTPUT_RATE = 30.0
+
+RESULT_FIELDS = ["source", "frame", "variance", "deltaX", "deltaY",
+                 "distance"]
+
+
+def frameSource(path):
+    """
+    Generator that returns (frameNum, image) tuples from the given input.
+
+    @param path Either a video file or a directory of image files
+
+    Images in a directory are returned in (file)name order.
+    """
+    if os.path.isdir(path):
+        names = sorted([n for n in os.listdir(path)
+                        if os.path.splitext(n)[1].lower() in IMAGE_EXTENSIONS])
+        for frameNum, name in enumerate(names):
+            img = cv2.imread(os.path.join(path, name))
+            if img is None:
+                logging.warning("Unable to read image file '%s'", name)
+                continue
+            yield frameNum, img
+    else:
+        cap = cv2.VideoCapture(path)
+        if not cap.isOpened():
+            logging.error("Unable to open video file '%s'", path)
+            raise RuntimeError
+        try:
+            frameNum = 0
+            while True:
+                ret, img = cap.read()
+                if not ret:
+                    break
+                yield frameNum, img
+                frameNum += 1
+        finally:
+            cap.release()
+
+
+def outputNames(paths):
+    """
+    Return the names of the annotated outputs for the given inputs.
+
+    @param paths List of input paths
+
+    Names are the inputs' basenames (without a video file's extension), with
+     the input's index as a prefix if more than one input has that name.
+    """
+    names = []
+    for path in paths:
+        name = os.path.basename(os.path.normpath(path))
+        if not os.path.isdir(path):
+            name = os.path.splitext(name)[0]
+        names.append(name)
+    return ["{0:03d}_{1}".format(i, name) if names.count(name) > 1 else name
+            for i, name in enumerate(names)]
+
+
+class AnnotatedOutput(object):
+    """
+    Writer for annotated frames.
+
+    Video inputs are written as a video file, image directories are written
+     as a directory of (PNG) images.
+    """
+    def __init__(self, outDir, path, name):
+        """
+        Instantiate AnnotatedOutput object.
+
+        @param outDir Directory in which annotated output is written
+        @param path Input path that the annotated frames came from
+        @param name Name of the output (see outputNames())
+        """
+        self.isDir = os.path.isdir(path)
+        if self.isDir:
+            self.outPath = os.path.join(outDir, name)
+            if not os.path.isdir(self.outPath):
+                os.makedirs(self.outPath)
+        else:
+            self.outPath = os.path.join(outDir, name + ".avi")
+        self.writer = None
+
+    def write(self, frameNum, img):
+        if self.isDir:
+            fileName = "{0:06d}.png".format(frameNum)
+            cv2.imwrite(os.path.join(self.outPath, fileName), img)
+            return
+        if self.writer is None:
+            fourcc = cv2.VideoWriter_fourcc(*DEF_OUTPUT_FOURCC)
+            height, width = img.shape[:2]
+            self.writer = cv2.VideoWriter(self.outPath, fourcc,
+                                          DEF_OUTPUT_RATE, (width, height))
+        self.writer.write(img)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+
+
+def processSource(job):
+    """
+    Run the processing pipeline over all of the frames in a single input.
+
+    @param job Tuple of (path, config, outDir, outName, point)
+
+    Returns a dict with the per-frame results and timing for the input.
+    N.B. This is a top-level function so that it can be used in a Pool.
+    """
+    path, config, outDir, outName, point = job
+    config = copy.deepcopy(config)
+    ch = config['crosshair']
+    o = config['osd']
+
+    vidProc = video.VideoProcessing()
+    output = AnnotatedOutput(outDir, path, outName) if outDir else None
+    xhair = osd = measure = None
+    rows = []
+
+    start = time.time()
+    for frameNum, img in frameSource(path):
+        if measure is None:
+            # overlays are sized to the first frame of the input
+            height, width = img.shape[:2]
+            config['imgWidth'] = width
+            config['imgHeight'] = height
+            if ch['enable']:
+                xhair = video.Crosshair(width, height, ch)
+            if o['enable']:
+                osd = video.OnScreenDisplay(config)
+            measure = video.Measurement(width, height, None)
+            if point is not None:
+                measure.setValues(point[0], point[1])
+
+        vpOut = vidProc.processFrame(img)
+        dX, dY, dist = measure.getValues()
+        rows.append({'source': path, 'frame': frameNum,
+                     'variance': vpOut['variance'], 'deltaX': dX,
+                     'deltaY': dY, 'distance': dist})
+
+        if output:
+            if xhair:
+                xhair.overlay(img)
+            if osd:
+                cnc_video.drawMeasurements(img, osd,
+                                           video.OnScreenDisplay.TOP_LEFT,
+                                           dX, dY, dist)
+                text = "{0}: {1:.2f}".format("FOCUS", vpOut['variance'])
+                osd.overlay(img, video.OnScreenDisplay.BOTTOM_LEFT, 0, text)
+            output.write(frameNum, img)
+    elapsed = time.time() - start
+
+    if output:
+        output.close()
+    return {'source': path, 'frames': len(rows), 'elapsed': elapsed,
+            'rows': rows}
+
+
+def writeResults(path, results):
+    """
+    Write the per-frame results to a CSV or JSON file.
+
+    The format is selected by the file's extension ('.json', else CSV).
+    """
+    rows = [row for r in results for row in r['rows']]
+    if path.lower().endswith(".json"):
+        summary = [{k: r[k] for k in ('source', 'frames', 'elapsed')}
+                   for r in results]
+        with open(path, 'w') as f:
+            json.dump({'sources': summary, 'frames': rows}, f, indent=4,
+                      sort_keys=True)
+    else:
+        with open(path, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+#
+# MAIN
+#
+def main():
+    usage = sys.argv[0] + "[-v] [-C <confFile>] [-r <resultsFile>] "
+    usage += "[-a <annotatedDir>] [-j <numJobs>] [-p <x>,<y>] <input> ..."
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        'inputs', nargs='+',
+        help="video files and/or directories of images to process")
+    ap.add_argument(
+        '-C', '--configFile', action='store',
+        help="configuration input file")
+    ap.add_argument(
+        '-r', '--results', action='store', type=str,
+        help="results output file -- '.csv' or '.json'")
+    ap.add_argument(
+        '-a', '--annotate', action='store', type=str,
+        help="directory in which to write annotated frames")
+    ap.add_argument(
+        '-j', '--jobs', action='store', type=int, default=1,
+        help="number of inputs to process in parallel")
+    ap.add_argument(
+        '-p', '--point', action='store', type=str,
+        help="measurement point in pixels -- 'x,y'")
+    ap.add_argument(
+        '-v', '--verbose', action='count', default=0,
+        help="increase verbosity")
+    options = ap.parse_args()
+
+    config = copy.deepcopy(cnc_video.config)
+    if options.configFile:
+        if not os.path.isfile(options.configFile):
+            sys.stderr.write("Error: config file not found\n")
+            sys.exit(1)
+        with open(options.configFile, 'r') as ymlFile:
+            confFile = yaml.load(ymlFile)
+        util.dictMerge(config, confFile)
+
+    for path in options.inputs:
+        if not os.path.exists(path):
+            sys.stderr.write("Error: input not found: {0}\n".format(path))
+            sys.exit(1)
+
+    point = None
+    if options.point:
+        point = [int(v) for v in options.point.split(",")]
+
+    if options.annotate and not os.path.isdir(options.annotate):
+        os.makedirs(options.annotate)
+
+    jobs = [(path, config, options.annotate, name, point)
+            for path, name in zip(options.inputs,
+                                  outputNames(options.inputs))]
+    start = time.time()
+    if options.jobs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(processes=options.jobs)
+        try:
+            results = pool.map(processSource, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [processSource(job) for job in jobs]
+    elapsed = time.time() - start
+
+    if options.results:
+        writeResults(options.results, results)
+
+    if options.verbose:
+        totalFrames = 0
+        for r in results:
+            rate = (r['frames'] / r['elapsed']) if r['elapsed'] else 0.0
+            sys.stdout.write("    {0}: {1} frames, {2:.2f} secs, "
+                             "{3:.1f} fps\n".format(r['source'], r['frames'],
+                                                    r['elapsed'], rate))
+            totalFrames += r['frames']
+        rate = (totalFrames / elapsed) if elapsed else 0.0
+        sys.stdout.write("    Total: {0} frames, {1:.2f} secs, {2:.1f} fps\n".
+                         format(totalFrames, elapsed, rate))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
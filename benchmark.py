@@ -0,0 +1,485 @@
+#!/usr/bin/env python
+
+"""X-Carve Microscope Tool Video Pipeline Benchmarks"""
+
+import argparse
+import copy
+import ctypes
+import ctypes.util
+import json
+import math
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+import cnc_video
+import video
+import workers
+
+try:
+    import tracemalloc
+except ImportError:
+    # allocation tracing is only available in Python 3.4 and above
+    tracemalloc = None
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+'''
+DESIGN NOTES:
+  * Frames are synthetic, but are meant to look like what the microscope
+    sees: low-frequency texture with fine-grained noise, straight edges and
+    (drill hole) circles, all softened by a bit of defocus blur.
+  * Each stage is timed on its own (on a fresh copy of the frame), and then
+    the whole per-frame path is timed end to end.
+  * Results can be saved as a baseline, and later runs compared against it,
+    so that regressions show up as diffs.
+  * Allocations are traced with tracemalloc where it exists (Python 3.4+).
+    Otherwise (i.e., on Python 2) the peak RSS is reset on Linux (via
+    /proc/self/clear_refs) before a call, and the growth of the peak is
+    taken as what the call allocated -- this only counts pages that were
+    touched, but it includes the buffers that OpenCV allocates itself.
+    glibc reuses freed blocks from its (resident) heap, which the RSS doesn't
+    see, so the heap's free pages are released (with malloc_trim()) first.
+'''
+
+RESOLUTIONS = [(640, 480), (800, 600), (1920, 1080),
+               (video.MAX_VIDEO_WIDTH, video.MAX_VIDEO_HEIGHT)]
+
+DEF_ITERATIONS = 50
+DEF_WARMUP = 5
+DEF_THRESHOLD = 10.0    # percent change that counts as a regression
+
+STAGES = ["crosshair", "osd", "processFrame", "measurement", "endToEnd"]
+
+DETECTORS = ["lines", "corners", "circles"]
+DEF_SCALING_SIZE = (1920, 1080)
+DEF_SCALING_FRAMES = 64
+
+DEF_TARGET_RADIUS = 30      # radius of synthetic targets in pixels
+DEF_LOCATOR_TRIALS = 20
+
+
+def syntheticFrame(width, height, seed=0):
+    """
+    Generate a microscope-like BGR test frame of the given size.
+
+    @param width Frame width in pixels
+    @param height Frame height in pixels
+    @param seed Random number seed (so frames are reproducible)
+    """
+    rng = np.random.RandomState(seed)
+
+    # low-frequency texture (wasteboard/wood grain) plus sensor noise
+    coarse = rng.randint(0, 256, (max(height // 32, 2), max(width // 32, 2)))
+    gray = cv2.resize(coarse.astype(np.uint8), (width, height),
+                      interpolation=cv2.INTER_CUBIC)
+    noise = rng.randint(0, 32, (height, width)).astype(np.uint8)
+    gray = cv2.add(gray, noise)
+
+    # workpiece edges and drill holes
+    thick = max(width // 320, 1)
+    cv2.rectangle(gray, (width // 8, height // 8),
+                  ((width * 5) // 8, (height * 5) // 8), 230, thick)
+    cv2.line(gray, (0, (height * 7) // 8), (width, (height * 6) // 8), 200,
+             thick)
+    radius = min(width, height) // 10
+    cv2.circle(gray, ((width * 3) // 4, (height * 3) // 4), radius, 20, -1)
+    cv2.circle(gray, (width // 3, (height * 2) // 3), radius // 2, 40, -1)
+
+    # a little bit of defocus
+    gray = cv2.GaussianBlur(gray, (0, 0), max(width / 640.0, 1.0))
+
+    img = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
+    img[:, :, 2] = cv2.add(img[:, :, 2], 16)    # slightly warm tint
+    return img
+
+
+def drawTarget(img, x, y, radius=DEF_TARGET_RADIUS):
+    """
+    Draw a bullseye target (like a home-position decal) centered at a
+     subpixel location.
+    """
+    shift = 4
+    f = float(1 << shift)
+    center = (int(round(x * f)), int(round(y * f)))
+    for i, color in enumerate([(0, 0, 0), (255, 255, 255), (0, 0, 0),
+                               (255, 255, 255)]):
+        r = int(round(radius * (1.0 - (i / 4.0)) * f))
+        cv2.circle(img, center, r, color, -1, cv2.LINE_AA, shift)
+    cv2.line(img, (center[0] - int(radius * f), center[1]),
+             (center[0] + int(radius * f), center[1]), (0, 0, 0), 2,
+             cv2.LINE_AA, shift)
+    cv2.line(img, (center[0], center[1] - int(radius * f)),
+             (center[0], center[1] + int(radius * f)), (0, 0, 0), 2,
+             cv2.LINE_AA, shift)
+    return img
+
+
+def targetTemplate(radius=DEF_TARGET_RADIUS):
+    """
+    Return a (grayscale) template image of the synthetic target.
+    """
+    size = (2 * radius) + 4
+    img = np.full((size, size, 3), 128, np.uint8)
+    drawTarget(img, (size - 1) / 2.0, (size - 1) / 2.0, radius)
+    return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def runLocator(resolutions, trials):
+    """
+    Print the time per frame and the accuracy of the coarse-to-fine target
+     locator, compared with a full-resolution template match.
+    """
+    rng = np.random.RandomState(1)
+    template = targetTemplate()
+    tH, tW = template.shape[:2]
+    sys.stdout.write("{0:>12} {1:>10} {2:>10} {3:>10} {4:>10} {5:>6}\n".
+                     format("Size", "ms", "fullMs", "meanErr", "maxErr",
+                            "found"))
+    for width, height in resolutions:
+        locator = video.TargetLocator(template)
+        times, fullTimes, errors = [], [], []
+        for i in range(trials):
+            img = syntheticFrame(width, height, seed=i)
+            x = rng.uniform(tW, width - tW)
+            y = rng.uniform(tH, height - tH)
+            drawTarget(img, x, y)
+
+            start = time.time()
+            loc = locator.locate(img)
+            times.append((time.time() - start) * 1000.0)
+
+            start = time.time()
+            cv2.matchTemplate(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), template,
+                              cv2.TM_CCOEFF_NORMED)
+            fullTimes.append((time.time() - start) * 1000.0)
+
+            if loc is not None:
+                (lx, ly), score = loc
+                errors.append(math.hypot(lx - x, ly - y))
+        meanErr = np.mean(errors) if errors else float('nan')
+        maxErr = np.max(errors) if errors else float('nan')
+        sys.stdout.write("{0:>12} {1:>10.3f} {2:>10.3f} {3:>10.3f} "
+                         "{4:>10.3f} {5:>6}\n".
+                         format("{0}x{1}".format(width, height),
+                                float(np.median(times)),
+                                float(np.median(fullTimes)), meanErr, maxErr,
+                                "{0}/{1}".format(len(errors), trials)))
+        sys.stdout.flush()
+
+
+class PipelineBench(object):
+    """
+    Per-frame pipeline stages, set up for a given frame size.
+    """
+    def __init__(self, width, height):
+        config = copy.deepcopy(cnc_video.config)
+        config['imgWidth'] = width
+        config['imgHeight'] = height
+        self.pool = video.FramePool(width, height)
+        self.xhair = video.Crosshair(width, height, config['crosshair'],
+                                     pool=self.pool)
+        self.osd = video.OnScreenDisplay(config)
+        self.vidProc = video.VideoProcessing(pool=self.pool)
+        self.measure = video.Measurement(width, height, None)
+        self.clickX = width // 3
+        self.clickY = height // 3
+        self.vpOut = self.vidProc.processFrame(syntheticFrame(width, height))
+
+    def crosshair(self, img):
+        self.xhair.overlay(img)
+
+    def osdOverlay(self, img):
+        dX, dY, dist = self.measure.getValues()
+        cnc_video.drawMeasurements(img, self.osd,
+                                   video.OnScreenDisplay.TOP_LEFT,
+                                   dX, dY, dist)
+        text = "{0}: {1:.2f}".format("FOCUS", self.vpOut['variance'])
+        self.osd.overlay(img, video.OnScreenDisplay.BOTTOM_LEFT, 0, text)
+
+    def processFrame(self, img):
+        self.vpOut = self.vidProc.processFrame(img)
+
+    def measurement(self, img):
+        x, y = self.vidProc.getNearestFeature(self.clickX, self.clickY)
+        self.measure.setValues(x, y)
+        self.measure.getValues()
+
+    def endToEnd(self, img):
+        self.processFrame(img)
+        self.crosshair(img)
+        self.osdOverlay(img)
+        self.measurement(img)
+
+    def stages(self):
+        return [("crosshair", self.crosshair), ("osd", self.osdOverlay),
+                ("processFrame", self.processFrame),
+                ("measurement", self.measurement),
+                ("endToEnd", self.endToEnd)]
+
+
+def _trimHeap():
+    # release the free pages of glibc's heap, and return True if that worked
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'))
+        libc.malloc_trim(0)
+        return True
+    except (OSError, AttributeError):
+        return False
+
+
+def _resetPeakRss():
+    # reset the peak RSS to the current RSS (Linux only), and return True if
+    #  that worked
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def allocated(func, src, work):
+    """
+    Return the number of bytes allocated during a single call of func, or
+     None if allocations can't be measured.
+    """
+    if tracemalloc is None:
+        if resource is None or not _trimHeap() or not _resetPeakRss():
+            return None
+        np.copyto(work, src)
+        # N.B. after the reset the peak is the current RSS, and it's in KB
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        func(work)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return (peak - before) * 1024
+    np.copyto(work, src)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        func(work)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return peak - before
+
+
+def timeStage(func, src, work, iterations, warmup=DEF_WARMUP):
+    """
+    Return the per-call times (in msec) of func, each run on a fresh copy of
+     the source frame.
+    """
+    times = []
+    for i in range(warmup + iterations):
+        np.copyto(work, src)
+        start = time.time()
+        func(work)
+        t = (time.time() - start) * 1000.0
+        if i >= warmup:
+            times.append(t)
+    return times
+
+
+def runBenchmarks(resolutions, iterations):
+    """
+    Run all of the stage benchmarks at each of the given resolutions.
+
+    Returns a dict of results:
+     {"<w>x<h>": {<stage>: {ms, fps, allocKB, poolAllocs}}}
+    where poolAllocs is the number of FramePool buffers (re)allocated per
+     frame in steady state (i.e., after the warmup iterations), which is
+     nonzero if a stage keeps asking for a buffer of a different shape. It
+     doesn't count any other allocations (see allocKB for those).
+    """
+    results = {}
+    for width, height in resolutions:
+        src = syntheticFrame(width, height)
+        work = src.copy()
+        bench = PipelineBench(width, height)
+        res = {}
+        for name, func in bench.stages():
+            timeStage(func, src, work, 0)     # warm up the buffers
+            allocs = bench.pool.allocations
+            times = timeStage(func, src, work, iterations)
+            allocs = bench.pool.allocations - allocs
+            ms = float(np.median(times))
+            alloc = allocated(func, src, work)
+            res[name] = {
+                'poolAllocs': allocs / float(len(times) + DEF_WARMUP),
+                'ms': round(ms, 4),
+                'fps': round(1000.0 / ms, 1) if ms > 0 else None,
+                'allocKB': round(alloc / 1024.0, 1) if alloc is not None
+                else None
+            }
+        results["{0}x{1}".format(width, height)] = res
+    return results
+
+
+def inlineDetectionRate(width, height, frames):
+    """
+    Return the frames/s of running all the detectors in the calling process.
+    """
+    gray = cv2.cvtColor(syntheticFrame(width, height), cv2.COLOR_BGR2GRAY)
+    params = dict(video.DEF_DETECTOR_PARAMS)
+    start = time.time()
+    for i in range(frames):
+        video.runDetectors(gray, DETECTORS, params)
+    return frames / (time.time() - start)
+
+
+def workerDetectionRate(width, height, numWorkers, frames):
+    """
+    Return the frames/s of running all the detectors in a pool of workers,
+     keeping all of the shared-memory slots full.
+    """
+    gray = cv2.cvtColor(syntheticFrame(width, height), cv2.COLOR_BGR2GRAY)
+    params = dict(video.DEF_DETECTOR_PARAMS)
+    pool = workers.DetectorPool(width, height, numWorkers)
+    try:
+        # warm up the workers
+        pool.submit(gray, 0, DETECTORS, params)
+        pool.collect(30.0)
+
+        done = 0
+        frameId = 0
+        start = time.time()
+        while done < frames:
+            while frameId < frames and pool.submit(gray, frameId, DETECTORS,
+                                                   params):
+                frameId += 1
+            done += len(pool.collect(30.0))
+        return frames / (time.time() - start)
+    finally:
+        pool.close()
+
+
+def runScaling(width, height, maxWorkers, frames):
+    """
+    Print the detector throughput inline and with 1 to maxWorkers workers.
+    """
+    base = inlineDetectionRate(width, height, max(frames // 4, 1))
+    sys.stdout.write("Detector scaling at {0}x{1} ({2}):\n".
+                     format(width, height, ", ".join(DETECTORS)))
+    sys.stdout.write("{0:>10} {1:>9} {2:>8}\n".format("Workers", "fps",
+                                                      "speedup"))
+    sys.stdout.write("{0:>10} {1:>9.1f} {2:>8.2f}\n".format("inline", base,
+                                                            1.0))
+    for n in range(1, maxWorkers + 1):
+        rate = workerDetectionRate(width, height, n, frames)
+        sys.stdout.write("{0:>10} {1:>9.1f} {2:>8.2f}\n".
+                         format(n, rate, rate / base))
+        sys.stdout.flush()
+
+
+def printResults(results, baseline=None, threshold=DEF_THRESHOLD):
+    """
+    Print a table of the results, along with the (percent) change in per
+     stage time from the baseline if one is given.
+
+    Returns the number of stages that regressed by more than the threshold.
+    """
+    regressions = 0
+    sys.stdout.write("{0:>12} {1:>14} {2:>10} {3:>9} {4:>11} {5:>11} "
+                     "{6:>9}\n".format("Size", "Stage", "ms", "fps",
+                                       "alloc(KB)", "poolAllocs", "delta"))
+    for size in sorted(results.keys(), key=lambda s: int(s.split("x")[0])):
+        for stage in STAGES:
+            r = results[size][stage]
+            delta = ""
+            if baseline and size in baseline and stage in baseline[size]:
+                baseMs = baseline[size][stage]['ms']
+                if baseMs:
+                    pct = ((r['ms'] - baseMs) / baseMs) * 100.0
+                    delta = "{0:+.1f}%".format(pct)
+                    if pct > threshold:
+                        delta += " *"
+                        regressions += 1
+            alloc = r['allocKB'] if r['allocKB'] is not None else "n/a"
+            sys.stdout.write("{0:>12} {1:>14} {2:>10.3f} {3:>9} {4:>11} "
+                             "{5:>11} {6:>9}\n".format(size, stage, r['ms'],
+                                                       r['fps'], alloc,
+                                                       r.get('poolAllocs'),
+                                                       delta))
+    sys.stdout.flush()
+    return regressions
+
+
+#
+# MAIN
+#
+def main():
+    usage = sys.argv[0] + "[-n <iterations>] [-r <w>x<h>[,<w>x<h>...]] "
+    usage += "[-s <baselineFile>] [-b <baselineFile>] [-T <percent>] "
+    usage += "[-W <maxWorkers>] [-L]"
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        '-n', '--iterations', action='store', type=int,
+        default=DEF_ITERATIONS, help="number of timed iterations per stage")
+    ap.add_argument(
+        '-r', '--resolutions', action='store', type=str,
+        help="frame sizes to run -- e.g., '640x480,1920x1080'")
+    ap.add_argument(
+        '-s', '--save', action='store', type=str,
+        help="save results as a baseline (JSON) file")
+    ap.add_argument(
+        '-b', '--baseline', action='store', type=str,
+        help="baseline (JSON) file to compare results against")
+    ap.add_argument(
+        '-T', '--threshold', action='store', type=float,
+        default=DEF_THRESHOLD,
+        help="percent slowdown reported as a regression")
+    ap.add_argument(
+        '-W', '--workers', action='store', type=int,
+        help="run the detector worker scaling benchmark, up to this many "
+             "worker processes (at the first given resolution)")
+    ap.add_argument(
+        '-L', '--locator', action='store_true',
+        help="run the target locator time/accuracy benchmark")
+    options = ap.parse_args()
+
+    resolutions = RESOLUTIONS
+    if options.resolutions:
+        resolutions = [tuple(int(v) for v in r.split("x"))
+                       for r in options.resolutions.split(",")]
+
+    if options.locator:
+        runLocator(resolutions, DEF_LOCATOR_TRIALS)
+        return
+
+    if options.workers:
+        width, height = DEF_SCALING_SIZE
+        if options.resolutions:
+            width, height = resolutions[0]
+        runScaling(width, height, options.workers, DEF_SCALING_FRAMES)
+        return
+
+    baseline = None
+    if options.baseline:
+        if not os.path.isfile(options.baseline):
+            sys.stderr.write("Error: baseline file not found\n")
+            sys.exit(1)
+        with open(options.baseline, 'r') as f:
+            baseline = json.load(f)
+
+    results = runBenchmarks(resolutions, options.iterations)
+    regressions = printResults(results, baseline, options.threshold)
+
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+    if regressions:
+        sys.stderr.write("{0} stage(s) regressed by more than {1}%\n".
+                         format(regressions, options.threshold))
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
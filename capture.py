@@ -0,0 +1,293 @@
+"""X-Carve Microscope Tool Camera Capture -- Library"""
+
+import collections
+import logging
+
+import cv2
+import numpy as np
+
+from util import monotonic
+
+
+'''
+DESIGN NOTES:
+  * USB (UVC) cameras offer several capture modes, and which one delivers
+    frames the fastest depends on the camera and the bus -- MJPG frames are
+    small on the bus but have to be decoded, while YUYV frames don't, but
+    are bus-limited at high resolutions. So when the camera's opened, each
+    candidate mode is set and a few frames are read to measure the rate it
+    actually delivers, and the mode with the highest throughput (pixels/sec)
+    is used. That takes a while, so callers should cache the resulting mode
+    and only negotiate when asked to.
+  * When nothing downstream needs colour, frames are read raw (i.e., without
+    the backend's conversion to BGR), and only their luminance is taken --
+    the Y bytes of a YUYV frame, or a grayscale-only decode of an MJPG frame
+    -- which skips both the BGR decode and the BGR-to-gray conversion.
+  * If the backend doesn't hand back raw frames in a known format, capture
+    falls back to BGR frames.
+'''
+
+DEF_FOURCCS = ["MJPG", "YUYV"]
+DEF_PROBE_FRAMES = 10       # frames read to measure a mode's rate
+DEF_RATE_WINDOW = 30        # frames over which the delivered rate is measured
+
+JPEG_SOI = (0xFF, 0xD8)
+
+# Camera capture mode (format, frame size, and nominal frame rate)
+CaptureMode = collections.namedtuple('CaptureMode',
+                                     ['fourcc', 'width', 'height', 'fps'])
+
+
+def fourccString(code):
+    """
+    Return the four-character string of a (CAP_PROP_FOURCC) format code.
+    """
+    code = int(code)
+    return "".join(chr((code >> (8 * i)) & 0xFF) for i in range(4))
+
+
+def setMode(cap, fourcc, width, height, fps=None):
+    """
+    Ask for a capture mode, and return the mode that the camera actually set.
+
+    @param cap VideoCapture object
+    @param fourcc Four-character format code (e.g., 'MJPG'), or None
+    @param width Frame width in pixels
+    @param height Frame height in pixels
+    @param fps Frame rate, or None for the camera's default
+    """
+    # N.B. some backends only take the format if it's set before the size
+    if fourcc:
+        cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+    if fps:
+        cap.set(cv2.CAP_PROP_FPS, fps)
+    return CaptureMode(fourccString(cap.get(cv2.CAP_PROP_FOURCC)),
+                       int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                       int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                       cap.get(cv2.CAP_PROP_FPS))
+
+
+def probeRate(cap, numFrames=DEF_PROBE_FRAMES):
+    """
+    Return the frame rate that the camera delivers in its current mode, or
+     0.0 if it doesn't deliver frames.
+    """
+    # the first frame includes the time it takes the stream to start
+    if not cap.grab():
+        return 0.0
+    start = monotonic()
+    for i in range(numFrames):
+        if not cap.grab():
+            return 0.0
+    elapsed = monotonic() - start
+    return (numFrames / elapsed) if elapsed > 0.0 else 0.0
+
+
+def negotiate(cap, sizes, fourccs=DEF_FOURCCS, rates=None,
+              probeFrames=DEF_PROBE_FRAMES):
+    """
+    Find the capture mode with the best throughput.
+
+    @param cap VideoCapture object
+    @param sizes List of (width, height) frame sizes to try
+    @param fourccs List of formats to try
+    @param rates List of frame rates to try (None for the camera's default)
+    @param probeFrames Number of frames to read from each mode
+
+    Returns a tuple of the best mode (which is left set), the frame rate it
+     delivered, and a list of the (mode, delivered rate) of each mode tried.
+    N.B. a mode the camera substitutes another one for is only tried once.
+    """
+    tried = []
+    current = None      # the mode that was set last
+    for fourcc in fourccs or [None]:
+        for width, height in sizes:
+            for fps in rates or [None]:
+                current = setMode(cap, fourcc, width, height, fps)
+                if any(m == current for m, _ in tried):
+                    continue
+                tried.append((current, probeRate(cap, probeFrames)))
+    best, bestRate = max(tried, key=lambda t: t[1] * t[0].width *
+                         t[0].height)
+    # N.B. a substituted mode may have been set after the best one was tried
+    if current != best:
+        setMode(cap, best.fourcc, best.width, best.height, best.fps or None)
+    return best, bestRate, tried
+
+
+def lumaFromRaw(raw, width, height, dst=None):
+    """
+    Return the luminance (grayscale) image of a raw (unconverted) frame.
+
+    @param raw Frame from a VideoCapture with CAP_PROP_CONVERT_RGB off
+    @param width Frame width in pixels
+    @param height Frame height in pixels
+    @param dst Buffer for the grayscale image (for YUYV frames), or None
+
+    Returns None if the frame isn't in a known raw format.
+    """
+    if raw is None:
+        return None
+    if raw.ndim == 3 and raw.shape[2] == 3:
+        # the backend converted it anyway
+        return cv2.cvtColor(raw, cv2.COLOR_BGR2GRAY, dst=dst)
+    if raw.size == (width * height * 2):
+        # YUYV (4:2:2) -- the Y bytes alternate with the U/V bytes
+        luma = raw.reshape(height, width, 2)[:, :, 0]
+        if dst is None:
+            return luma.copy()
+        np.copyto(dst, luma)
+        return dst
+    flat = raw.reshape(-1)
+    if flat.size > 2 and tuple(flat[:2]) == JPEG_SOI:
+        # MJPG -- decoding just the luminance skips the colour conversion
+        return cv2.imdecode(flat, cv2.IMREAD_GRAYSCALE)
+    return None
+
+
+class Camera(object):
+    """
+    Video camera with capture-mode negotiation and a grayscale fast path.
+    """
+    def __init__(self, device, sizes, fourccs=DEF_FOURCCS, rates=None,
+                 gray=False, probeFrames=DEF_PROBE_FRAMES):
+        """
+        Instantiate Camera object, and open and set up the camera.
+
+        @param device Camera device index (or name)
+        @param sizes List of (width, height) frame sizes to try
+        @param fourccs List of formats (e.g., 'MJPG', 'YUYV') to try
+        @param rates List of frame rates to try (None for the default)
+        @param gray If True, read only the luminance of the frames (as
+         grayscale images), rather than BGR frames
+        @param probeFrames Number of frames to read from each mode (when
+         there's more than one candidate)
+        """
+        self.cap = cv2.VideoCapture(device)
+        if not self.cap.isOpened():
+            logging.error("Unable to open the camera: %s", device)
+            raise RuntimeError
+        sizes = [tuple(s) for s in sizes]
+        candidates = len(fourccs or [None]) * len(sizes) * len(rates or [None])
+        self.probeTime = 0.0    # secs spent negotiating the mode
+        if candidates > 1:
+            start = monotonic()
+            self.mode, self.probedRate, self.tried = negotiate(
+                self.cap, sizes, fourccs, rates, probeFrames)
+            self.probeTime = monotonic() - start
+        else:
+            self.mode = setMode(self.cap, (fourccs or [None])[0], sizes[0][0],
+                                sizes[0][1], (rates or [None])[0])
+            self.probedRate = None
+            self.tried = []
+        self.width = self.mode.width
+        self.height = self.mode.height
+        self.gray = gray
+        if gray:
+            self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 0)
+        self.readTimes = collections.deque(maxlen=DEF_RATE_WINDOW)
+        self.frames = 0
+        self.startTime = None
+
+    def read(self, pool):
+        """
+        Read a frame.
+
+        @param pool FramePool to get the frame's buffer from
+
+        Returns (ret, img), where img is a BGR frame, or a grayscale one on
+         the fast path.
+        """
+        if not self.gray:
+            ret, img = self.cap.read(image=pool.frame())
+        else:
+            ret, raw = self.cap.read()
+            img = None
+            if ret:
+                img = lumaFromRaw(raw, self.width, self.height,
+                                  pool.get('frameGray',
+                                           (self.height, self.width)))
+                if img is None:
+                    logging.warning("Unknown raw frame format, falling back "
+                                    "to BGR capture")
+                    self.gray = False
+                    self.cap.set(cv2.CAP_PROP_CONVERT_RGB, 1)
+                    ret, img = self.cap.read(image=pool.frame())
+        if ret:
+            now = monotonic()
+            if self.startTime is None:
+                self.startTime = now
+            self.readTimes.append(now)
+            self.frames += 1
+        return ret, img
+
+    def deliveredRate(self):
+        """
+        Return the frame rate delivered over the last few frames (or None if
+         there haven't been enough frames).
+        """
+        if len(self.readTimes) < 2:
+            return None
+        elapsed = self.readTimes[-1] - self.readTimes[0]
+        return ((len(self.readTimes) - 1) / elapsed) if elapsed else None
+
+    def averageRate(self):
+        """
+        Return the frame rate delivered since the first frame (or None).
+        """
+        if self.frames < 2:
+            return None
+        elapsed = self.readTimes[-1] - self.startTime
+        return ((self.frames - 1) / elapsed) if elapsed else None
+
+    def release(self):
+        self.cap.release()
+
+
+#
+# TEST
+#
+if __name__ == '__main__':
+    width, height = 640, 480
+    bgr = np.zeros((height, width, 3), np.uint8)
+    cv2.circle(bgr, (320, 240), 100, (40, 200, 90), -1)
+    gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+
+    # YUYV: Y bytes interleaved with (here, constant) chroma bytes
+    yuyv = np.empty((height, width, 2), np.uint8)
+    yuyv[:, :, 0] = gray
+    yuyv[:, :, 1] = 128
+    luma = lumaFromRaw(yuyv.reshape(1, -1), width, height)
+    print("YUYV luma matches: {0}".format(np.array_equal(luma, gray)))
+
+    # MJPG: a JPEG, decoded to grayscale only
+    ret, jpeg = cv2.imencode(".jpg", bgr, [cv2.IMWRITE_JPEG_QUALITY, 95])
+    luma = lumaFromRaw(jpeg.reshape(1, -1), width, height)
+    print("MJPG luma max error: {0}".format(
+        int(np.max(cv2.absdiff(luma, gray)))))
+
+    iterations = 200
+    start = monotonic()
+    for i in range(iterations):
+        cv2.cvtColor(cv2.imdecode(jpeg, cv2.IMREAD_COLOR), cv2.COLOR_BGR2GRAY)
+    bgrPath = (monotonic() - start) / iterations
+    start = monotonic()
+    for i in range(iterations):
+        lumaFromRaw(jpeg, width, height)
+    grayPath = (monotonic() - start) / iterations
+    print("MJPG decode: BGR+convert {0:.3f} msec, luma only {1:.3f} msec".
+          format(bgrPath * 1000.0, grayPath * 1000.0))
+    dst = np.empty((height, width), np.uint8)
+    raw = yuyv.reshape(1, -1)
+    start = monotonic()
+    for i in range(iterations):
+        cv2.cvtColor(yuyv, cv2.COLOR_YUV2BGR_YUYV)
+    yuyvBgr = (monotonic() - start) / iterations
+    start = monotonic()
+    for i in range(iterations):
+        lumaFromRaw(raw, width, height, dst)
+    yuyvGray = (monotonic() - start) / iterations
+    print("YUYV decode: to BGR {0:.3f} msec, luma only {1:.3f} msec".
+          format(yuyvBgr * 1000.0, yuyvGray * 1000.0))
@@ -1,8 +1,20 @@
 """X-Carve Microscope Tool CNC Library"""
 
+import logging
+import threading
+
+from util import monotonic
 from xcarve import XCarve
 
 
+'''
+DESIGN NOTES:
+  * Bringing up the GRBL device takes several seconds (waiting for the Arduino
+    to wake up, resetting, and reading its settings), so a Connection does it
+    on a background thread, and the video can be shown in the meantime.
+'''
+
+
 class CNC(XCarve):
     """
     ????
@@ -23,6 +35,49 @@ class CNC(XCarve):
         return None
 
 
+class Connection(threading.Thread):
+    """
+    Connect to the CNC machine in the background.
+    """
+    CONNECTING = "Connecting"
+    CONNECTED = "Connected"
+    FAILED = "Failed"
+
+    def __init__(self, config):
+        """
+        Instantiate Connection object, and start connecting.
+
+        @param config Config dict to construct the CNC object with
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.config = config
+        self.state = Connection.CONNECTING
+        self.mach = None
+        self.elapsed = None     # secs taken to connect (or fail)
+        self.start()
+
+    def run(self):
+        start = monotonic()
+        try:
+            mach = CNC(self.config)
+        except Exception:
+            logging.exception("Failed to connect to CNC machine")
+            self.state = Connection.FAILED
+        else:
+            self.mach = mach
+            self.state = Connection.CONNECTED
+        self.elapsed = monotonic() - start
+        logging.info("CNC connection %s after %.2f secs", self.state.lower(),
+                     self.elapsed)
+
+    def device(self):
+        """
+        Return the CNC object, or None if it isn't connected (yet).
+        """
+        return self.mach
+
+
 #
 # TEST
 #
@@ -4,14 +4,13 @@
 """X-Carve Microscope Tool"""
 
 import argparse
+import logging
 import os
 import signal
 import sys
-import yaml
 
 import cv2
 
-import cnc
 import util
 import video
 
@@ -75,6 +74,17 @@ TODO:
  * Allow optional camera adjustment inputs (e.g., contrast, exposure, etc.)
 '''
 
+'''
+DESIGN NOTES:
+  * Startup shows video as soon as the camera is open: the (slow) connection
+    to the GRBL device is made on a background thread, and its state is shown
+    in the OSD until it's done.
+  * Modules that are only needed on some paths (e.g., yaml, serial, cnc) are
+    imported when they're needed -- this includes the frame-loop subsystems
+    (capture, positions, recorder, etc.), so the config defaults below are
+    literal values rather than the subsystems' DEF_* constants.
+'''
+
 DEBUG_MODE = False
 
 DEF_VIDEO_DEVICE = 0
@@ -93,6 +103,19 @@ DEF_FONT_FACE = video.FONT_FACE_1 if (DEF_VIDEO_SIZE[0] < 512) else video.FONT_F
 DEF_FONT_SCALE = 1
 DEF_FONT_THICKNESS = 1 if (DEF_FONT_FACE == video.FONT_FACE_1) else 2
 
+# File that tuned parameters are saved to if no config file was given
+DEF_CONFIG_FILE = "cnc_video.yml"
+
+# Run-time adjustable parameters: (name, default, maxPos, scale, configPath)
+PARAMETERS = [
+    ('alpha', DEF_CROSSHAIR_ALPHA, 100, 0.01, ['crosshair', 'alpha'])
+] + [
+    (name, video.DEF_DETECTOR_PARAMS[name], maxPos, 1.0,
+     ['detection', 'params', name])
+    for name, maxPos in (('thrs1', 10000), ('thrs2', 10000), ('blkSize', 100),
+                         ('kernelSize', 30), ('kVal', 100))
+]
+
 
 # Initialize configuration with default values here
 # N.B. These get overridden by config file values, which are then overriden by
@@ -100,6 +123,14 @@ DEF_FONT_THICKNESS = 1 if (DEF_FONT_FACE == video.FONT_FACE_1) else 2
 config = {
     'device': DEF_VIDEO_DEVICE,                 # camera device name (string)
     'size': DEF_VIDEO_SIZE,                     # image width/height (tuple)
+    'capture': {
+        'fourccs': ["MJPG", "YUYV"],            # Formats to try (list)
+        'sizes': [],                            # Other sizes to try (list)
+        'rates': [],                            # Frame rates to try (list)
+        'probeFrames': 10,                      # Frames per trial (int)
+        'mode': None,                           # Negotiated mode (list)
+        'gray': False                           # Luminance only (boolean)
+    },
     'adjustments': False,                       # Enable/disable realtime input
     'crosshair': {
         'enable': False,                        # Enable/disable (boolean)
@@ -118,6 +149,77 @@ config = {
     'cnc': {
         'enable': False,                        # Enable CNC machine (boolean)
         'device': "COM4",                       # Serial device name (string)
+        'latency': 0.1,                         # Camera latency (secs)
+        'statusInterval': 0.05,                 # Extra poll secs (float)
+        'historySize': 256                      # Status reports kept (int)
+    },
+    'calibration': {
+        'mmPerPixel': None,                     # Camera scale (float)
+        'cameraOffset': [0.0, 0.0]              # Image center offset (mm)
+    },
+    'detection': {
+        'detectors': [],                        # Detectors to run (list)
+        'workers': 0,                           # Worker processes (0=inline)
+        'slots': None,                          # Shared frame slots (int)
+        'params': {}                            # Detector parameters (dict)
+    },
+    'locator': {
+        'template': None,                       # Target image file (string)
+        'minScore': 0.5                         # Min match score (float)
+    },
+    'recorder': {
+        'enable': False,                        # Enable recording (boolean)
+        'path': "recording",                    # Segment path prefix (string)
+        'fourcc': "MJPG",                       # Video codec (string)
+        'size': None,                           # Recording size (tuple)
+        'queueSize': 8,                         # Max queued frames (int)
+        'dropPolicy': "oldest",                 # 'oldest'/'newest'/'block'
+        'segmentSecs': 600.0,                   # Max segment secs (float)
+        'segmentBytes': None                    # Max segment bytes (int)
+    },
+    'ring': {
+        'enable': False,                        # Keep raw frames (boolean)
+        'path': "dump",                         # Dump path prefix (string)
+        'secs': 5.0,                            # Secs of frames kept (float)
+        'onAlarm': True                         # Dump on machine alarm
+    },
+    'changes': {
+        'enable': False,                        # Skip static scenes (boolean)
+        'threshold': video.ChangeDetector.DEF_NOISE_THRESHOLD,  # Gray levels
+        'refresh': video.ChangeDetector.DEF_REFRESH_INTERVAL    # Frames (int)
+    },
+    'tracker': {
+        'enable': False,                        # Track between keyframes
+        'maxAge': 30,                           # Max keyframe gap (frames)
+        'movingAge': 5,                         # Gap while moving (frames)
+        'minConfidence': 0.6                    # Features kept (fraction)
+    },
+    'scheduler': {
+        'enable': False,                        # Enable adaptive scheduling
+        'budgets': {}                           # Stage budgets (fraction)
+    },
+    'toolpath': {
+        'job': None,                            # G-code file to show (string)
+        'color': video.ToolpathOverlay.DEF_COLOR,   # Feed moves (tuple)
+        'rapidColor': video.ToolpathOverlay.DEF_RAPID_COLOR  # Rapids (tuple)
+    },
+    'server': {
+        'enable': False,                        # Enable streaming (boolean)
+        'host': "127.0.0.1",                    # Address to listen on (string)
+        'port': 8080,                           # TCP port (int)
+        'quality': 80                           # JPEG quality (int)
+    },
+    'telemetry': {
+        'enable': False,                        # Enable telemetry (boolean)
+        'path': None,                           # Session directory (string)
+        'chunkFrames': 65536                    # Rows per chunk file (int)
+    },
+    'profiler': {
+        'enable': False,                        # Enable profiling (boolean)
+        'osd': True,                            # Show stats in OSD (boolean)
+        'window': 256,                          # Frames of samples kept (int)
+        'dumpInterval': 10.0,                   # Secs between dumps (float)
+        'statsFile': None                       # Stats output file (string)
     }
 }
 
@@ -130,12 +232,18 @@ class KeyboardInput(object):
     def __init__(self):
         self.mode = None
         self.focus = False
+        self.locate = False
+        self.save = False
+        self.dump = False
         self.handlers = {ord('h'): self._hEdge,
                          ord('v'): self._vEdge,
                          ord('c'): self._corner,
                          ord('r'): self._circle,
                          ord('F'): self._focusOn,
                          ord('f'): self._focusOff,
+                         ord('l'): self._locate,
+                         ord('W'): self._save,
+                         ord('D'): self._dump,
                          27: self._reset}
 
     def input(self):
@@ -171,14 +279,46 @@ class KeyboardInput(object):
     def _focusOff(self):
         self.focus = False
 
+    # locate the target (once)
+    def _locate(self):
+        self.locate = True
+
+    # save the (tuned) parameters to the config file
+    def _save(self):
+        self.save = True
+
+    # dump the raw frame ring buffer
+    def _dump(self):
+        self.dump = True
+
     # reset feature mode
     def _reset(self):
         self.mode = None
 
 
-# Dummy callback (used in trackbars)
-def nullHandler(*arg):
-    pass
+# Create the registry of run-time adjustable parameters, with initial values
+#  taken from the config.
+def makeRegistry(config):
+    import params
+    registry = params.ParameterRegistry()
+    for name, default, maxPos, scale, path in PARAMETERS:
+        registry.define(name, default, maxPos, scale, path, config)
+    return registry
+
+
+# Save a (negotiated) capture mode in the given YAML config file, keeping the
+#  rest of the file's settings.
+def saveCaptureMode(path, mode):
+    import yaml
+
+    conf = {}
+    if os.path.isfile(path):
+        with open(path, 'r') as ymlFile:
+            conf = yaml.load(ymlFile) or {}
+    conf.setdefault('capture', {})['mode'] = list(mode)
+    with open(path, 'w') as ymlFile:
+        yaml.dump(conf, ymlFile, default_flow_style=False)
+    logging.info("Saved capture mode %s to '%s'", mode, path)
 
 
 # Generic signal handler
@@ -235,6 +375,48 @@ def main():
     ap.add_argument(
         '-o', '--osd', action='store_true',
         help="enable OSD overlay")
+    ap.add_argument(
+        '-D', '--detectors', action='store', type=str,
+        help="feature detectors to run -- e.g., 'lines,corners,circles'")
+    ap.add_argument(
+        '-w', '--workers', action='store', type=int,
+        help="number of detector worker processes (0 runs them inline)")
+    ap.add_argument(
+        '-R', '--record', action='store', type=str,
+        help="record the annotated view to files with this path prefix")
+    ap.add_argument(
+        '-b', '--ring', action='store', type=float,
+        help="keep this many secs of raw frames, to dump on an alarm (or "
+             "the 'D' key)")
+    ap.add_argument(
+        '-k', '--skipStatic', action='store_true',
+        help="reuse the previous results while the scene isn't changing")
+    ap.add_argument(
+        '-N', '--negotiate', action='store_true',
+        help="negotiate the fastest capture mode (and save it in the config "
+             "file), rather than using the saved one")
+    ap.add_argument(
+        '-G', '--gray', action='store_true',
+        help="capture grayscale (luminance-only) frames, if no stage needs "
+             "colour")
+    ap.add_argument(
+        '-L', '--track', action='store_true',
+        help="detect features on keyframes only, and track them in between")
+    ap.add_argument(
+        '-S', '--schedule', action='store_true',
+        help="adapt processing quality/rate to hold the camera frame rate")
+    ap.add_argument(
+        '-P', '--profile', action='store_true',
+        help="enable per-frame stage profiling")
+    ap.add_argument(
+        '-H', '--serve', action='store', type=int,
+        help="stream the view (MJPEG) and status (WebSocket) on this port")
+    ap.add_argument(
+        '-T', '--telemetry', action='store', type=str,
+        help="log per-frame telemetry to this session directory")
+    ap.add_argument(
+        '-J', '--job', action='store', type=str,
+        help="G-code file whose toolpath is overlaid on the view")
     ap.add_argument(
         '-v', '--verbose', action='count', default=0,
         help="increase verbosity")
@@ -243,6 +425,7 @@ def main():
         help="configuration input file (overridden by command-line args)")
     options = ap.parse_args()
 
+    startTime = util.monotonic()
     signal.signal(signal.SIGSEGV, sigHandler)
 
     #### TODO make it look for a default config file if one isn't given
@@ -250,16 +433,43 @@ def main():
         if not os.path.isfile(options.configFile):
             sys.stderr.write("Error: config file not found\n")
             sys.exit(1)
+        import yaml
         with open(options.configFile, 'r') as ymlFile:
             confFile = yaml.load(ymlFile)
         util.dictMerge(config, confFile)
 
+    if 'capture' not in config:
+        config['capture'] = {}
     if 'crosshair' not in config:
         config['crosshair'] = {'enable': False}
     if 'osd' not in config:
         config['osd'] = {'enable': False}
     if 'cnc' not in config:
         config['cnc'] = {'enable': False}
+    if 'calibration' not in config:
+        config['calibration'] = {}
+    if 'detection' not in config:
+        config['detection'] = {'detectors': []}
+    if 'locator' not in config:
+        config['locator'] = {'template': None}
+    if 'recorder' not in config:
+        config['recorder'] = {'enable': False}
+    if 'ring' not in config:
+        config['ring'] = {'enable': False}
+    if 'changes' not in config:
+        config['changes'] = {'enable': False}
+    if 'tracker' not in config:
+        config['tracker'] = {'enable': False}
+    if 'scheduler' not in config:
+        config['scheduler'] = {'enable': False}
+    if 'profiler' not in config:
+        config['profiler'] = {'enable': False}
+    if 'toolpath' not in config:
+        config['toolpath'] = {'job': None}
+    if 'server' not in config:
+        config['server'] = {'enable': False}
+    if 'telemetry' not in config:
+        config['telemetry'] = {'enable': False}
 
     if options.deviceIndex:
         config['device'] = options.deviceIndex
@@ -280,6 +490,34 @@ def main():
     if options.cnc:
         config['cnc']['enable'] = True
         config['cnc']['device'] = options.cnc
+    if options.detectors:
+        config['detection']['detectors'] = options.detectors.split(",")
+    if options.workers is not None:
+        config['detection']['workers'] = options.workers
+    if options.record:
+        config['recorder']['enable'] = True
+        config['recorder']['path'] = options.record
+    if options.ring:
+        config['ring']['enable'] = True
+        config['ring']['secs'] = options.ring
+    if options.skipStatic:
+        config['changes']['enable'] = True
+    if options.gray:
+        config['capture']['gray'] = True
+    if options.track:
+        config['tracker']['enable'] = True
+    if options.schedule:
+        config['scheduler']['enable'] = True
+    if options.profile:
+        config['profiler']['enable'] = True
+    if options.job:
+        config['toolpath']['job'] = options.job
+    if options.serve:
+        config['server']['enable'] = True
+        config['server']['port'] = options.serve
+    if options.telemetry:
+        config['telemetry']['enable'] = True
+        config['telemetry']['path'] = options.telemetry
 
     # Aliases for OSD locations
     TL = video.OnScreenDisplay.TOP_LEFT
@@ -287,36 +525,85 @@ def main():
     BL = video.OnScreenDisplay.BOTTOM_LEFT
     BR = video.OnScreenDisplay.BOTTOM_RIGHT
 
+    import positions
+
+    # start connecting to the CNC machine while the camera is being opened
+    c = config['cnc']
+    if c['enable']:
+        import cnc
+        conn = cnc.Connection(config)
+        # machine status reports, on the same clock as the frames
+        history = positions.StatusHistory(
+            c.get('historySize', positions.DEF_HISTORY_SIZE))
+    else:
+        conn = None
+        history = None
+    poller = None
+    latency = c.get('latency', positions.DEF_CAMERA_LATENCY)
+
+    # trackbars push their changes into the parameter registry
+    registry = makeRegistry(config)
     cv2.namedWindow('view')
     if config['adjustments']:
-        if config['crosshair']['enable']:
-            alpha = int(config['crosshair']['alpha'] * 100)
-            cv2.createTrackbar('alpha', 'view', alpha, 100, nullHandler)
-        cv2.createTrackbar('thrs1', 'view', 0, 10000, nullHandler)
-        cv2.createTrackbar('thrs2', 'view', 0, 10000, nullHandler)
-        blkSize = 5
-        kernelSize = 5
-        kVal = 5
-        cv2.createTrackbar('blkSize', 'view', blkSize, 100, nullHandler)
-        cv2.createTrackbar('kernelSize', 'view', kernelSize, 30, nullHandler)
-        cv2.createTrackbar('kVal', 'view', kVal, 100, nullHandler)
-    cap = cv2.VideoCapture(config['device'])
-
-    cap.set(cv2.CAP_PROP_FRAME_WIDTH, config['size'][0])
-    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, config['size'][1])
-
-    vidWidth = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    vidHeight = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    vidRate = cap.get(cv2.CAP_PROP_FPS)
-    vidFormat = cap.get(cv2.CAP_PROP_FOURCC)
+        names = [p[0] for p in PARAMETERS]
+        if not config['crosshair']['enable']:
+            names.remove('alpha')
+        registry.createTrackbars('view', names)
+    # the grayscale fast path is only taken if no stage needs colour frames
+    cp = config['capture']
+    gray = cp.get('gray', False)
+    if gray and (config['crosshair']['enable'] or
+                 config['toolpath'].get('job') or
+                 config['recorder']['enable']):
+        logging.warning("Grayscale capture disabled -- the crosshair, "
+                        "toolpath, and recorder need colour frames")
+        gray = False
+
+    # negotiating the capture mode takes a while, so it's only done when
+    #  asked for, and the result is saved -- otherwise the saved mode (or the
+    #  first format at the configured size) is used
+    import capture
+    fourccs = cp.get('fourccs', capture.DEF_FOURCCS)
+    sizes = [config['size']] + list(cp.get('sizes') or [])
+    rates = cp.get('rates')
+    if not options.negotiate:
+        if cp.get('mode'):
+            fourcc, width, height, fps = cp['mode']
+            fourccs, sizes, rates = [fourcc], [(width, height)], [fps]
+        else:
+            fourccs, sizes, rates = fourccs[:1], sizes[:1], (rates or [])[:1]
+    camStart = util.monotonic()
+    try:
+        cam = capture.Camera(
+            config['device'], sizes, fourccs, rates, gray,
+            cp.get('probeFrames', capture.DEF_PROBE_FRAMES))
+    except RuntimeError:
+        sys.stderr.write("Error: unable to open the camera\n")
+        sys.exit(1)
+
+    vidWidth = cam.width
+    vidHeight = cam.height
+    vidRate = cam.mode.fps
+    vidFormat = cam.mode.fourcc
+    camOpenTime = util.monotonic() - camStart - cam.probeTime
+    if options.negotiate:
+        cp['mode'] = [cam.mode.fourcc, cam.mode.width, cam.mode.height,
+                      cam.mode.fps]
+        if options.configFile:
+            saveCaptureMode(options.configFile, cp['mode'])
 
     # update the config with the actual width/height of the image
     config['imgWidth'] = vidWidth
     config['imgHeight'] = vidHeight
 
+    # preallocated image buffers that get reused on every frame
+    framePool = video.FramePool(vidWidth, vidHeight)
+    # derived images (gray, pyramid levels, ...) shared by the frame's stages
+    frameCtx = video.FrameContext(framePool)
+
     ch = config['crosshair']
     if ch['enable']:
-        xhair = video.Crosshair(vidWidth, vidHeight, ch, config['adjustments'])
+        xhair = video.Crosshair(vidWidth, vidHeight, ch, registry, framePool)
 
     o = config['osd']
     if o['enable']:
@@ -324,9 +611,129 @@ def main():
     else:
         osd = None
 
-    c = config['cnc']
-    if c['enable']:
-        mach = cnc.CNC(config)
+    d = config['detection']
+
+    cd = config['changes']
+    if cd['enable']:
+        changes = video.ChangeDetector(
+            threshold=cd.get('threshold',
+                             video.ChangeDetector.DEF_NOISE_THRESHOLD),
+            refresh=cd.get('refresh',
+                           video.ChangeDetector.DEF_REFRESH_INTERVAL))
+    else:
+        changes = None
+
+    tr = config['tracker']
+    if tr['enable']:
+        import tracker
+        track = tracker.FeatureTracker(
+            maxAge=tr.get('maxAge', tracker.FeatureTracker.DEF_MAX_AGE),
+            movingAge=tr.get('movingAge',
+                             tracker.FeatureTracker.DEF_MOVING_AGE),
+            minConfidence=tr.get('minConfidence',
+                                 tracker.FeatureTracker.DEF_MIN_CONFIDENCE))
+    else:
+        track = None
+
+    s = config['scheduler']
+    if s['enable']:
+        import scheduler
+        sched = scheduler.FrameScheduler(vidRate, s.get('budgets'))
+    else:
+        sched = None
+
+    # the job is parsed once, and only its visible parts are drawn per frame
+    tp = config['toolpath']
+    if tp.get('job'):
+        if not history:
+            sys.stderr.write("Error: toolpath overlay requires the CNC\n")
+            sys.exit(1)
+        import gcode
+        with open(tp['job'], 'r') as jobFile:
+            paths = gcode.toolpath(jobFile)
+        toolpath = video.ToolpathOverlay(
+            paths, vidWidth, vidHeight, config['calibration'],
+            tp.get('color', video.ToolpathOverlay.DEF_COLOR),
+            tp.get('rapidColor', video.ToolpathOverlay.DEF_RAPID_COLOR))
+    else:
+        toolpath = None
+
+    l = config['locator']
+    if l.get('template'):
+        template = cv2.imread(l['template'])
+        if template is None:
+            sys.stderr.write("Error: unable to read target template\n")
+            sys.exit(1)
+        locator = video.TargetLocator(template,
+                                      minScore=l.get('minScore', 0.5),
+                                      pool=framePool)
+    else:
+        locator = None
+
+    r = config['recorder']
+    if r['enable'] or config['ring']['enable']:
+        import recorder
+    if r['enable']:
+        rec = recorder.Recorder(
+            r.get('path', "recording"), vidRate,
+            r.get('fourcc', recorder.DEF_FOURCC), r.get('size'),
+            r.get('queueSize', recorder.DEF_QUEUE_SIZE),
+            r.get('dropPolicy', recorder.DEF_DROP_POLICY),
+            r.get('segmentSecs', recorder.DEF_SEGMENT_SECS),
+            r.get('segmentBytes', recorder.DEF_SEGMENT_BYTES))
+    else:
+        rec = None
+
+    rg = config['ring']
+    if rg['enable']:
+        # N.B. allocated for the first frame, as the camera may not deliver
+        #  the format that was asked for
+        ring = recorder.FrameRing(
+            rg.get('path', "dump"),
+            secs=rg.get('secs', recorder.DEF_RING_SECS), frameRate=vidRate)
+    else:
+        ring = None
+    # machine state the alarm trigger last saw
+    lastState = None
+
+    sv = config['server']
+    if sv['enable']:
+        import streamer
+        server = streamer.StreamServer(
+            sv.get('port', streamer.DEF_PORT),
+            sv.get('host', streamer.DEF_HOST),
+            sv.get('quality', streamer.DEF_QUALITY))
+    else:
+        server = None
+
+    p = config['profiler']
+    if p['enable'] or config['telemetry']['enable']:
+        import profiler
+    if p['enable']:
+        prof = profiler.StageProfiler(
+            window=p.get('window', profiler.DEF_WINDOW),
+            frameRate=vidRate,
+            dumpInterval=p.get('dumpInterval', profiler.DEF_DUMP_INTERVAL),
+            statsFile=p.get('statsFile'))
+        # encoder backlog and drops go in the periodic stats dumps, so a slow
+        #  encoder is noticed before the end of the run
+        if rec:
+            prof.addSource('recorder', rec.getStats, ['backlog', 'dropped'])
+        if ring:
+            prof.addSource('ring', ring.getStats, ['dropped'])
+    else:
+        prof = None
+
+    tl = config['telemetry']
+    if tl['enable']:
+        import telemetry
+        telem = telemetry.TelemetryWriter(
+            tl.get('path') or "telemetry",
+            prof.stages if prof else profiler.DEF_STAGES,
+            sorted(video.DETECTORS),
+            tl.get('chunkFrames', telemetry.DEF_CHUNK_FRAMES))
+    else:
+        telem = None
 
     if options.verbose:
         sys.stdout.write("    Video Device Index:  {0}\n".
@@ -335,6 +742,20 @@ def main():
                          format(vidWidth, vidHeight))
         sys.stdout.write("    Video Frame Rate:    {0}\n".format(vidRate))
         sys.stdout.write("    Video Format:        {0}\n".format(vidFormat))
+        if cam.tried:
+            sys.stdout.write("    Capture Modes Tried: (format, size, fps -> "
+                             "delivered fps, in {0:.3f} secs)\n".
+                             format(cam.probeTime))
+            for mode, rate in cam.tried:
+                sys.stdout.write("        {0} {1}x{2} {3:.1f} -> {4:.1f}{5}\n".
+                                 format(mode.fourcc, mode.width, mode.height,
+                                        mode.fps, rate,
+                                        " *" if mode == cam.mode else ""))
+        sys.stdout.write("    Grayscale Capture:   ")
+        if cam.gray:
+            sys.stdout.write("Enabled\n")
+        else:
+            sys.stdout.write("Disabled\n")
         sys.stdout.write("    On-Screen Display:   ")
         if o['enable']:
             sys.stdout.write("Enabled\n")
@@ -363,9 +784,77 @@ def main():
             sys.stdout.write("Disabled\n")
         sys.stdout.write("    X-Carve:             ")
         if c['enable']:
-            sys.stdout.write("Enabled")
+            sys.stdout.write("Enabled\n")
             sys.stdout.write("        Serial Port:         {0}\n".
-                             format(x['device']))
+                             format(c['device']))
+            sys.stdout.write("        Camera Latency:      {0} secs\n".
+                             format(latency))
+        else:
+            sys.stdout.write("Disabled\n")
+        sys.stdout.write("    Feature Detectors:   ")
+        if d['detectors']:
+            sys.stdout.write("{0}\n".format(", ".join(d['detectors'])))
+            sys.stdout.write("        Worker Processes:    {0}\n".
+                             format(d.get('workers', 0)))
+        else:
+            sys.stdout.write("None\n")
+        sys.stdout.write("    Target Locator:      {0}\n".
+                         format(l['template'] if locator else "Disabled"))
+        sys.stdout.write("    Toolpath Overlay:    {0}\n".
+                         format(tp['job'] if toolpath else "Disabled"))
+        sys.stdout.write("    Recorder:            ")
+        if r['enable']:
+            sys.stdout.write("Enabled\n")
+            sys.stdout.write("        Path Prefix:         {0}\n".
+                             format(rec.pathPrefix))
+            sys.stdout.write("        Codec:               {0}\n".
+                             format(rec.fourcc))
+            sys.stdout.write("        Drop Policy:         {0}\n".
+                             format(rec.dropPolicy))
+        else:
+            sys.stdout.write("Disabled\n")
+        sys.stdout.write("    Frame Ring:          ")
+        if ring:
+            sys.stdout.write("Enabled\n")
+            sys.stdout.write("        Frames:              {0}\n".
+                             format(ring.numFrames))
+            sys.stdout.write("        Dump on Alarm:       {0}\n".
+                             format(rg.get('onAlarm', True)))
+        else:
+            sys.stdout.write("Disabled\n")
+        sys.stdout.write("    Static Scene Skip:   ")
+        if cd['enable']:
+            sys.stdout.write("Enabled\n")
+        else:
+            sys.stdout.write("Disabled\n")
+        sys.stdout.write("    Feature Tracker:     ")
+        if track:
+            sys.stdout.write("Enabled\n")
+        else:
+            sys.stdout.write("Disabled\n")
+        sys.stdout.write("    Frame Scheduler:     ")
+        if s['enable']:
+            sys.stdout.write("Enabled\n")
+        else:
+            sys.stdout.write("Disabled\n")
+        sys.stdout.write("    Streaming Server:    ")
+        if server:
+            sys.stdout.write("http://{0}:{1}/\n".format(sv.get('host'),
+                                                       server.port))
+        else:
+            sys.stdout.write("Disabled\n")
+        sys.stdout.write("    Frame Profiler:      ")
+        if p['enable']:
+            sys.stdout.write("Enabled\n")
+            sys.stdout.write("        Window:              {0}\n".
+                             format(prof.window))
+            sys.stdout.write("        Stats File:          {0}\n".
+                             format(prof.statsFile))
+        else:
+            sys.stdout.write("Disabled\n")
+        sys.stdout.write("    Telemetry Log:       ")
+        if telem:
+            sys.stdout.write("{0}\n".format(telem.path))
         else:
             sys.stdout.write("Disabled\n")
         sys.stdout.write("    Realtime Controls ")
@@ -376,61 +865,243 @@ def main():
         sys.stdout.write("\n")
         sys.stdout.flush()
 
-    vidProc = video.VideoProcessing()
+    vidProc = video.VideoProcessing(d['detectors'], d.get('params'),
+                                    d.get('workers', 0), d.get('slots'),
+                                    framePool, sched, changes, registry,
+                                    track)
     kbd = KeyboardInput()
 
-    #### TODO get calibration data
-    cal = None
+    cal = config['calibration']
     measure = video.Measurement(vidWidth, vidHeight, cal)
 
+    # exposure time of the frame being displayed
+    shown = {'time': None}
+
+    def workPosition(t):
+        # the machine's work position (its machine position less the work
+        #  offset) at the given time, or None if it isn't known
+        if not history or t is None:
+            return None
+        machinePos = history.positionAt(t)
+        mach = conn.device() if conn else None
+        workOffset = mach.lastWorkOffset() if mach else None
+        if machinePos is None or workOffset is None:
+            return None
+        return tuple(p - w for p, w in zip(machinePos, workOffset))
+
     def clickHandler(event, x, y, flags, param):
         if flags & cv2.EVENT_LBUTTONDOWN:
             if flags & cv2.EVENT_FLAG_SHIFTKEY:
-                # select the feature nearest to the click
-                x, y = vidProc.getNearestFeature(x, y)
-            measure.setValues(x, y)
+                # select (and lock onto) the feature nearest to the click
+                x, y = vidProc.getNearestFeature(x, y, lock=True)
+            else:
+                vidProc.unlockFeature()
+            # where the machine was when the displayed frame was exposed
+            measure.setValues(x, y, workPosition(shown['time']))
 
     cv2.setMouseCallback('view', clickHandler)
 
+    firstFrame = True
     run = True
-    while (run):
-        # capture a frame of video from the camera
-        ret, img = cap.read()
-
-        # process video frame
-        vpOut = vidProc.processFrame(img)
-        ##print("VP_OUT: {0}".format(vpOut))
-
-        # add overlays to image
-        if ch['enable']:
-            xhair.overlay(img)
-        if o['enable']:
-            dX, dY, dist = measure.getValues()
-            drawMeasurements(img, osd, TL, dX, dY, dist)
-            if kbd.mode is not None:
-                text = "MODE: " + KeyboardInput.FEATURES[kbd.mode]
-                img = osd.overlay(img, TR, 0, text)
-            if kbd.focus:
-                text = "{0}: {1:.2f}".format("FOCUS", vpOut['variance'])
-                img = osd.overlay(img, BL, 0, text)
-
-        # display the processed and overlayed video frame
-        cv2.imshow('view', img)
-
-        if c['enable']:
-            # perform the desired CNC motions
-            if kbd.focus:
-                cncIn = {'variance': vpOut['variance']}
-                cncOut = mach.focus(cncIn)
-                if cncOut:
-                    print("CNC_OUT: {0}".format(cncOut))
-
-        # process keyboard input
-        run = kbd.input()
-
-    # clean up everything and exit
-    cap.release()
-    cv2.destroyAllWindows()
+    try:
+        while (run):
+            if prof:
+                prof.startFrame()
+
+            # capture a frame of video from the camera
+            ret, img = cam.read(framePool)
+            expTime = positions.frameTime(util.monotonic(), latency)
+            # keep the raw frame, in case something goes wrong
+            if ring and ret:
+                ring.write(img, expTime)
+            if prof:
+                prof.mark('capture')
+                if not ret:
+                    prof.dropFrame()
+
+            # process video frame
+            if (changes or track) and history:
+                state = history.stateAt(expTime)
+                if changes:
+                    changes.setMachineState(state)
+                if track:
+                    track.setMachineState(state)
+            frameCtx.reset(img)
+            vpOut = vidProc.processFrame(img, frameCtx)
+            # keep measuring the locked feature as it moves
+            locked = vidProc.getLockedFeature()
+            if locked:
+                measure.setValues(locked[0], locked[1],
+                                  workPosition(expTime))
+            ##print("VP_OUT: {0}".format(vpOut))
+            # find the target, and measure its offset from the crosshair
+            if kbd.locate:
+                kbd.locate = False
+                if locator and locator.measure(img, measure, frameCtx) is None:
+                    logging.warning("Target not found")
+            if prof:
+                prof.mark('process')
+
+            # add overlays to image
+            if sched:
+                overlayStart = util.monotonic()
+            if ch['enable']:
+                xhair.overlay(img)
+            if toolpath:
+                # the job is in work coordinates
+                machinePos = history.positionAt(expTime)
+                workOffset = conn.device().lastWorkOffset() \
+                    if conn.device() else None
+                if machinePos is not None and workOffset is not None:
+                    img = toolpath.overlay(img, machinePos, workOffset)
+            if o['enable']:
+                dX, dY, dist = measure.getValues()
+                drawMeasurements(img, osd, TL, dX, dY, dist)
+                if kbd.mode is not None:
+                    text = "MODE: " + KeyboardInput.FEATURES[kbd.mode]
+                    img = osd.overlay(img, TR, 0, text)
+                if conn:
+                    img = osd.overlay(img, TR, 1, "CNC: " + conn.state)
+                if kbd.focus:
+                    text = "{0}: {1:.2f}".format("FOCUS", vpOut['variance'])
+                    img = osd.overlay(img, BL, 0, text)
+                if measure.getWorkspace():
+                    text = "W: X{0:.3f} Y{1:.3f}mm".format(
+                        *measure.getWorkspace())
+                    img = osd.overlay(img, BL, 1, text)
+                if prof and p.get('osd', True):
+                    img = prof.overlay(img, osd, BR)
+            if sched:
+                sched.done('overlay', util.monotonic() - overlayStart)
+            if prof:
+                prof.mark('overlay')
+
+            # hand the annotated frame off to the recorder's encoder thread
+            if rec:
+                rec.write(img)
+                if prof:
+                    prof.mark('record')
+
+            # offer the annotated frame and the status to any remote viewers
+            if server and server.clients:
+                server.publish(img)
+                dX, dY, dist = measure.getValues()
+                latest = history.latest() if history else None
+                server.publishStatus({
+                    'time': expTime,
+                    'state': latest[1] if latest else None,
+                    'position': latest[2] if latest else None,
+                    'cnc': conn.state if conn else None,
+                    'measurement': {'deltaX': dX, 'deltaY': dY,
+                                    'distance': dist,
+                                    'workspace': measure.getWorkspace()},
+                    'focus': vpOut['variance']})
+
+            # display the processed and overlayed video frame
+            cv2.imshow('view', img)
+            shown['time'] = expTime
+            if firstFrame:
+                firstFrame = False
+                firstFrameTime = util.monotonic() - startTime
+                logging.info("Time to first frame: %.3f secs (camera open: "
+                             "%.3f secs, mode negotiation: %.3f secs)",
+                             firstFrameTime, camOpenTime, cam.probeTime)
+                if options.verbose:
+                    sys.stdout.write("    Time to First Frame: {0:.3f} secs "
+                                     "(camera open: {1:.3f} secs, mode "
+                                     "negotiation: {2:.3f} secs)\n".
+                                     format(firstFrameTime, camOpenTime,
+                                            cam.probeTime))
+                    sys.stdout.flush()
+            if prof:
+                prof.mark('display')
+
+            mach = conn.device() if conn else None
+            if mach and not poller:
+                poller = positions.StatusPoller(
+                    mach, history, c.get('statusInterval',
+                                         positions.DEF_POLL_INTERVAL))
+            if mach:
+                # perform the desired CNC motions
+                if kbd.focus:
+                    cncIn = {'variance': vpOut['variance']}
+                    cncOut = mach.focus(cncIn)
+                    if cncOut:
+                        print("CNC_OUT: {0}".format(cncOut))
+            # dump the frames leading up to an alarm
+            if ring and history and rg.get('onAlarm', True):
+                latest = history.latest()
+                state = latest[1] if latest else None
+                if state == "Alarm" and lastState != "Alarm":
+                    ring.trigger("alarm")
+                lastState = state
+            if prof:
+                prof.mark('cnc')
+
+            # process keyboard input
+            run = kbd.input()
+            if kbd.save:
+                kbd.save = False
+                registry.save(options.configFile or DEF_CONFIG_FILE)
+            if kbd.dump:
+                kbd.dump = False
+                if ring:
+                    ring.trigger("key")
+            if prof:
+                prof.mark('input')
+                prof.endFrame()
+
+            # log the frame's metrics
+            if telem:
+                feats = vpOut.get('features') or {}
+                telem.write(expTime, vpOut['frameId'], vpOut['variance'],
+                            vpOut['reused'],
+                            history.stateAt(expTime) if history else None,
+                            history.positionAt(expTime) if history else None,
+                            [len(feats[name]) if name in feats else 0
+                             for name in telem.detectors],
+                            prof.frameTimes() if prof else None)
+    finally:
+        # clean up everything and exit (even if the loop failed, so the
+        #  recordings, dumps, and telemetry are finished)
+        # N.B. a dump is most needed when something went wrong, so its
+        #  (daemon) thread is waited for first
+        if ring:
+            ring.close()
+            stats = ring.getStats()
+            logging.info("Frame ring: %d frames written, %d dropped, "
+                         "%d dumps", stats['written'], stats['dropped'],
+                         len(stats['dumps']))
+        if poller:
+            poller.stop()
+        vidProc.close()
+        stats = frameCtx.getStats()
+        logging.info("Derived images: %d hits, %d misses, %.3f secs saved",
+                     stats['hits'], stats['misses'], stats['saved'])
+        if rec:
+            rec.close()
+            stats = rec.getStats()
+            logging.info("Recorder: %d frames written, %d dropped, "
+                         "%d segments", stats['written'], stats['dropped'],
+                         len(stats['segments']))
+        if server:
+            server.close()
+        if prof:
+            prof.dump()
+        if telem:
+            # N.B. the telemetry session is only complete once it's closed
+            telem.close()
+            logging.info("Telemetry: %d frames logged to %s", telem.frames,
+                         telem.path)
+        rate = cam.averageRate()
+        if rate:
+            logging.info("Camera: %d frames delivered at %.2f fps "
+                         "(nominal %.2f)", cam.frames, rate, vidRate)
+            if options.verbose:
+                sys.stdout.write("    Delivered Frame Rate: {0:.2f} fps\n".
+                                 format(rate))
+        cam.release()
+        cv2.destroyAllWindows()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,683 @@
+#!/usr/bin/env python
+
+"""X-Carve Microscope Tool G-Code Processing -- Library"""
+
+import argparse
+import json
+import logging
+import re
+import sys
+
+import numpy as np
+
+from grbl import DEF_SERIAL_SPEED
+from util import monotonic
+
+
+'''
+DESIGN NOTES:
+  * Jobs can be much bigger than RAM, so G-code is processed as a stream of
+    lines -- transforms are generators that take an iterable of lines and
+    yield lines, and they can be chained in front of GrblDevice.writeGcodes().
+  * The Z-warp transform splits long (G1) moves into short segments and adds
+    the surface height (from a probed height map) at each segment's end to
+    its Z. Lines are collected into fixed-size batches, and the segmenting
+    and bilinear interpolation are done with NumPy over a whole batch at once,
+    so memory use is constant and the per-line cost is just the parsing and
+    formatting.
+  * Height maps and jobs are both in work coordinates (i.e., those of the
+    G-code), and lines whose axis words aren't a move (e.g., G10, G43.1) or
+    that change the work coordinates leave the position unknown until it's
+    set again, rather than being taken for moves.
+  * Only absolute-mode (G90) moves can be warped. Arcs (G2/G3) aren't
+    segmented, so only their end points get corrected -- i.e., they become
+    helical arcs -- and they should be linearized upstream where that's not
+    good enough.
+  * A re-fixtured workpiece is registered by a rigid (rotation and
+    translation) transform, fitted to where its fiducials were found, and
+    the G-code is transformed (in batches, like the Z-warp) as it's streamed.
+    Rotating an arc's end point and its (I/J) center offset keeps its shape
+    and direction, so arcs needn't be linearized. Z is untouched, so the two
+    transforms can be chained.
+'''
+
+DEF_SEGMENT_LENGTH = 2.0    # max length (mm) of a warped G1 move segment
+DEF_BATCH_SIZE = 256        # lines per vectorized batch
+
+MM_PER_INCH = 25.4
+
+WORD_PATTERN = re.compile(r"([A-Z])\s*([-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+))")
+COMMENT_PATTERN = re.compile(r"\([^)]*\)|;.*$")
+
+# Words that the rigid transform rewrites
+XY_WORDS = "XYIJ"
+
+# G-codes after which the (program) position isn't known -- including those
+#  that change the work coordinates (offsets) of the current position
+UNKNOWN_POSITION_CODES = (10.0, 28.0, 30.0, 38.2, 38.3, 38.4, 38.5, 43.1, 53.0,
+                          92.0, 92.1)
+
+# G-codes whose axis words aren't a move (e.g., G10 L20 P1 X0 Y0)
+NON_MOTION_CODES = (10.0, 28.1, 30.1, 43.1, 92.1)
+
+
+def parseWords(line):
+    """
+    Return the list of (letter, valueString) words in a line of G-code, with
+     comments removed.
+    """
+    return WORD_PATTERN.findall(COMMENT_PATTERN.sub("", line.upper()))
+
+
+class GcodeState(object):
+    """
+    Modal state of a G-code program -- motion mode, distance mode, units, and
+     (program) position.
+    """
+    def __init__(self):
+        self.motion = None      # current motion mode (0-3), or None
+        self.absolute = True    # G90 (True) or G91 (False)
+        self.scale = 1.0        # mm per program unit (G21 or G20)
+        self.pos = [None, None, None]   # X/Y/Z in mm (None if unknown)
+
+    def update(self, words):
+        """
+        Update the state with a line's words.
+
+        Returns the motion mode and the start and end positions (in mm) if the
+         line is a (G0-G3) move, else None.
+        """
+        axes = {}
+        unknown = nonMotion = False
+        for letter, value in words:
+            if letter == 'G':
+                code = float(value)
+                if code in (0.0, 1.0, 2.0, 3.0):
+                    self.motion = int(code)
+                elif code == 80.0:
+                    self.motion = None
+                elif code == 90.0:
+                    self.absolute = True
+                elif code == 91.0:
+                    self.absolute = False
+                elif code == 20.0:
+                    self.scale = MM_PER_INCH
+                elif code == 21.0:
+                    self.scale = 1.0
+                if code in UNKNOWN_POSITION_CODES:
+                    unknown = True
+                if code in NON_MOTION_CODES:
+                    nonMotion = True
+            elif letter in "XYZ":
+                axes[letter] = float(value)
+        # N.B. a line's unit mode applies to its own words
+        axes = {axis: (v * self.scale) for axis, v in axes.items()}
+        if unknown:
+            self.pos = [None, None, None]
+            return None
+        if nonMotion or not axes:
+            return None
+        start = list(self.pos)
+        for i, axis in enumerate("XYZ"):
+            if axis not in axes:
+                continue
+            if self.absolute:
+                self.pos[i] = axes[axis]
+            elif self.pos[i] is not None:
+                self.pos[i] += axes[axis]
+        if self.motion is None:
+            return None
+        return self.motion, start, list(self.pos)
+
+
+class HeightMap(object):
+    """
+    Surface height map, with bilinear interpolation.
+    """
+    def __init__(self, heights, reference=None, workOffset=None):
+        """
+        Instantiate HeightMap object.
+
+        @param heights (numY, numX, 3) array of (x, y, z) probed positions in
+         mm, in work coordinates (as returned by XCarve.probeGrid()), or the
+         path of a .npy file containing one
+        @param reference Height (in mm) that gets no correction (defaults to
+         the height of the first probed point -- i.e., where Z was zeroed)
+        @param workOffset (x, y, z) work coordinate offset (in mm) of a map
+         whose positions are in machine coordinates, or None
+
+        N.B. The map is looked up with the G-code's (work) X/Y, so a map in
+         machine coordinates has to be given the work offset to convert it.
+        """
+        if not isinstance(heights, np.ndarray):
+            heights = np.load(heights)
+        if workOffset is not None:
+            heights = heights - np.array(workOffset, np.float64)
+        if heights.ndim != 3 or heights.shape[2] != 3 or \
+           heights.shape[0] < 2 or heights.shape[1] < 2:
+            logging.error("Invalid height map shape: %s", heights.shape)
+            raise ValueError
+        if reference is None:
+            reference = heights[0, 0, 2]
+        # make the grid coordinates increasing (for interpolation)
+        if heights[0, -1, 0] < heights[0, 0, 0]:
+            heights = heights[:, ::-1]
+        if heights[-1, 0, 1] < heights[0, 0, 1]:
+            heights = heights[::-1]
+        self.xs = heights[0, :, 0].copy()
+        self.ys = heights[:, 0, 1].copy()
+        self.z = heights[:, :, 2] - reference
+        if np.isnan(self.z).any():
+            logging.error("Height map has unprobed points")
+            raise ValueError
+
+    def offsets(self, x, y):
+        """
+        Return the height offsets (in mm) at arrays of x/y positions (in mm).
+
+        Positions outside of the map get the height at the nearest edge.
+        """
+        nx, ny = len(self.xs), len(self.ys)
+        fx = np.interp(x, self.xs, np.arange(nx, dtype=np.float64))
+        fy = np.interp(y, self.ys, np.arange(ny, dtype=np.float64))
+        ix = np.minimum(fx.astype(np.intp), nx - 2)
+        iy = np.minimum(fy.astype(np.intp), ny - 2)
+        tx = fx - ix
+        ty = fy - iy
+        z = self.z
+        top = (z[iy, ix] * (1.0 - tx)) + (z[iy, ix + 1] * tx)
+        bottom = (z[iy + 1, ix] * (1.0 - tx)) + (z[iy + 1, ix + 1] * tx)
+        return (top * (1.0 - ty)) + (bottom * ty)
+
+
+def _formatMove(motion, x, y, z, extra):
+    line = "G{0} X{1:.4f} Y{2:.4f} Z{3:.4f}".format(motion, x, y, z)
+    if extra:
+        line = extra + " " + line
+    return line
+
+
+def _warpBatch(batch, heightMap, segLength):
+    # batch entries are either (line,) or (line, motion, start, end, extra,
+    #  scale), where start/end are X/Y/Z in mm
+    moves = [e for e in batch if len(e) > 1]
+    if not moves:
+        for entry in batch:
+            yield entry[0]
+        return
+
+    starts = np.array([e[2] for e in moves], np.float64)
+    ends = np.array([e[3] for e in moves], np.float64)
+    scales = np.array([e[5] for e in moves], np.float64)
+
+    # only G1 moves from a known X/Y are segmented
+    lengths = np.hypot(ends[:, 0] - starts[:, 0], ends[:, 1] - starts[:, 1])
+    segmented = (np.array([e[1] == 1 for e in moves]) &
+                 ~np.isnan(starts).any(axis=1))
+    counts = np.ones(len(moves), np.intp)
+    counts[segmented] = np.maximum(
+        np.ceil(lengths[segmented] / segLength), 1).astype(np.intp)
+    starts[~segmented] = ends[~segmented]
+
+    # end points of every segment of every move in the batch
+    owner = np.repeat(np.arange(len(moves)), counts)
+    firsts = np.cumsum(counts) - counts
+    t = ((np.arange(len(owner)) - firsts[owner] + 1.0) /
+         counts[owner])[:, np.newaxis]
+    points = starts[owner] + ((ends[owner] - starts[owner]) * t)
+    points[:, 2] += heightMap.offsets(points[:, 0], points[:, 1])
+    # back to program units
+    points /= scales[owner][:, np.newaxis]
+
+    n = 0
+    for entry in batch:
+        if len(entry) == 1:
+            yield entry[0]
+            continue
+        motion, extra = entry[1], entry[4]
+        first = firsts[n]
+        for i in range(first, first + counts[n]):
+            x, y, z = points[i]
+            yield _formatMove(motion, x, y, z, extra if i == first else "")
+        n += 1
+
+
+def zWarp(lines, heightMap, segLength=DEF_SEGMENT_LENGTH,
+          batchSize=DEF_BATCH_SIZE):
+    """
+    Generator that corrects G-code for an uneven surface.
+
+    @param lines Iterable of G-code lines
+    @param heightMap HeightMap of the surface
+    @param segLength Max length (in mm) of the segments that G1 moves are
+     split into
+    @param batchSize Number of lines to process at a time
+
+    Yields the (stripped) lines of the corrected G-code. Lines that aren't
+     moves (or whose position isn't fully known yet) are passed through.
+    """
+    if segLength <= 0.0:
+        logging.error("Invalid segment length: %f", segLength)
+        raise ValueError
+    state = GcodeState()
+    batch = []
+    for line in lines:
+        line = line.strip()
+        words = parseWords(line)
+        move = state.update(words) if words else None
+        if move is not None and not state.absolute:
+            logging.error("Can't warp relative (G91) moves: %s", line)
+            raise ValueError
+        if move is None or None in move[2]:
+            batch.append((line,))
+        else:
+            motion, start, end = move
+            # everything but the motion code and end point goes on the first
+            #  segment
+            extra = " ".join(l + v for l, v in words
+                             if l not in "XYZ" and not
+                             (l == 'G' and float(v) in (0.0, 1.0, 2.0, 3.0)))
+            start = [np.nan if v is None else v for v in start]
+            batch.append((line, motion, start, end, extra, state.scale))
+        if len(batch) >= batchSize:
+            for out in _warpBatch(batch, heightMap, segLength):
+                yield out
+            batch = []
+    for out in _warpBatch(batch, heightMap, segLength):
+        yield out
+
+
+def fitRigid(nominal, measured):
+    """
+    Fit the rigid (rotation and translation) transform that maps nominal
+     points onto where they were measured, by least squares.
+
+    @param nominal (N, 2) array-like of the points' nominal (job) X/Y, in mm
+    @param measured (N, 2) array-like of their measured (machine) X/Y, in mm
+
+    Returns the (2, 3) transform matrix, and the distance (in mm) between each
+     measured point and its transformed nominal point.
+    """
+    nominal = np.array(nominal, np.float64).reshape(-1, 2)
+    measured = np.array(measured, np.float64).reshape(-1, 2)
+    if len(nominal) < 2 or len(nominal) != len(measured):
+        logging.error("Need two or more pairs of points: %d nominal, "
+                      "%d measured", len(nominal), len(measured))
+        raise ValueError
+    nomMean = nominal.mean(axis=0)
+    measMean = measured.mean(axis=0)
+    p = nominal - nomMean
+    q = measured - measMean
+    if not np.any(p):
+        logging.error("Nominal points must not all coincide")
+        raise ValueError
+    # the (2D) rotation that best aligns the centered points
+    angle = np.arctan2(np.sum((p[:, 0] * q[:, 1]) - (p[:, 1] * q[:, 0])),
+                       np.sum((p[:, 0] * q[:, 0]) + (p[:, 1] * q[:, 1])))
+    c, s = np.cos(angle), np.sin(angle)
+    rotation = np.array([[c, -s], [s, c]])
+    matrix = np.hstack((rotation,
+                        (measMean - rotation.dot(nomMean))[:, np.newaxis]))
+    residuals = np.hypot(*(applyRigid(matrix, nominal) - measured).T)
+    return matrix, residuals
+
+
+def applyRigid(matrix, points):
+    """
+    Return an (N, 2) array of X/Y points transformed by a (2, 3) matrix.
+    """
+    points = np.asarray(points, np.float64)
+    return points.dot(matrix[:, :2].T) + matrix[:, 2]
+
+
+def rigidAngle(matrix):
+    """
+    Return the rotation (in degrees) of a rigid transform matrix.
+    """
+    return np.degrees(np.arctan2(matrix[1, 0], matrix[0, 0]))
+
+
+def saveRigid(path, matrix, residuals=None, **info):
+    """
+    Save a rigid transform (and how it was fitted) to a JSON file.
+    """
+    data = dict(info, matrix=np.asarray(matrix).tolist(),
+                angle=float(rigidAngle(matrix)))
+    if residuals is not None:
+        data['residuals'] = np.asarray(residuals).tolist()
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=4, sort_keys=True)
+
+
+def loadRigid(path):
+    """
+    Return the (2, 3) transform matrix saved in a JSON file.
+    """
+    with open(path, 'r') as f:
+        data = json.load(f)
+    matrix = np.array(data.get('matrix'), np.float64)
+    if matrix.shape != (2, 3):
+        logging.error("Invalid rigid transform in '%s'", path)
+        raise ValueError
+    return matrix
+
+
+def _rigidBatch(batch, matrix):
+    # batch entries are either (line,) or (line, extra, end, ij, scale), where
+    #  end is X/Y in mm (or None for an arc without an end point, i.e., a
+    #  full circle), and ij is the arc center offset (or None)
+    moves = [e for e in batch if len(e) > 1]
+    if not moves:
+        for entry in batch:
+            yield entry[0]
+        return
+
+    ends = np.array([(0.0, 0.0) if e[2] is None else e[2] for e in moves],
+                    np.float64)
+    scales = np.array([e[4] for e in moves], np.float64)[:, np.newaxis]
+    # back to program units
+    ends = applyRigid(matrix, ends) / scales
+    # the center offsets are relative, so they're only rotated
+    ijs = np.array([(0.0, 0.0) if e[3] is None else e[3] for e in moves],
+                   np.float64).dot(matrix[:, :2].T)
+
+    n = 0
+    for entry in batch:
+        if len(entry) == 1:
+            yield entry[0]
+            continue
+        extra, end, ij = entry[1], entry[2], entry[3]
+        words = []
+        if end is not None:
+            words.append("X{0:.4f} Y{1:.4f}".format(ends[n, 0], ends[n, 1]))
+        if ij is not None:
+            words.append("I{0:.4f} J{1:.4f}".format(ijs[n, 0], ijs[n, 1]))
+        line = " ".join(words)
+        yield (extra + " " + line) if extra else line
+        n += 1
+
+
+def rigidTransform(lines, matrix, batchSize=DEF_BATCH_SIZE):
+    """
+    Generator that rotates and translates G-code in X/Y.
+
+    @param lines Iterable of G-code lines
+    @param matrix (2, 3) transform matrix in mm (e.g., from fitRigid())
+    @param batchSize Number of lines to process at a time
+
+    Yields the (stripped) lines of the transformed G-code. Lines without X/Y
+     (or I/J) words are passed through, and moves that have them always get
+     both X and Y (so a move along one axis may become a move along both).
+     Lines whose X/Y words aren't work positions (e.g., G10, G28.1, G43.1,
+     G53 and G92) are passed through untouched, and an arc without X/Y words
+     (a full circle) only has its center offset rotated.
+    """
+    matrix = np.asarray(matrix, np.float64)
+    if matrix.shape != (2, 3):
+        logging.error("Invalid rigid transform shape: %s", matrix.shape)
+        raise ValueError
+    state = GcodeState()
+    batch = []
+    for line in lines:
+        line = line.strip()
+        words = parseWords(line)
+        move = state.update(words) if words else None
+        offsets = dict((l, float(v)) for l, v in words if l in "IJ")
+        if not any(l in XY_WORDS for l, v in words):
+            batch.append((line,))
+        elif any(l == 'G' and float(v) in (UNKNOWN_POSITION_CODES +
+                                           NON_MOTION_CODES)
+                 for l, v in words):
+            # e.g., offsets (G10/G92) or machine coordinates (G53), which
+            #  mustn't be transformed
+            batch.append((line,))
+        elif not any(l in "XY" for l, v in words) and state.motion in (2, 3):
+            # a full circle -- its start (and end) was already transformed
+            extra = " ".join(l + v for l, v in words if l not in XY_WORDS)
+            batch.append((line, extra, None,
+                          (offsets.get('I', 0.0), offsets.get('J', 0.0)),
+                          state.scale))
+        elif move is None:
+            logging.error("Can't transform a non-move: %s", line)
+            raise ValueError
+        elif not state.absolute:
+            logging.error("Can't transform relative (G91) moves: %s", line)
+            raise ValueError
+        elif None in move[2][:2]:
+            logging.error("Can't transform a move from an unknown X/Y: %s",
+                          line)
+            raise ValueError
+        else:
+            motion, start, end = move
+            ij = None
+            if motion in (2, 3) and offsets:
+                ij = (offsets.get('I', 0.0), offsets.get('J', 0.0))
+            extra = " ".join(l + v for l, v in words if l not in XY_WORDS)
+            batch.append((line, extra, end[:2], ij, state.scale))
+        if len(batch) >= batchSize:
+            for out in _rigidBatch(batch, matrix):
+                yield out
+            batch = []
+    for out in _rigidBatch(batch, matrix):
+        yield out
+
+
+def toolpath(lines):
+    """
+    Parse a G-code program into polylines in machine (mm) coordinates.
+
+    @param lines Iterable of G-code lines
+
+    Returns a list of (rapid, points) tuples -- one for each run of
+     consecutive rapid (G0) or feed (G1-G3) moves -- where points is an
+     (N, 3) float32 array of X/Y/Z positions. Arcs are approximated by their
+     chords, and moves from an unknown position are skipped.
+    """
+    state = GcodeState()
+    paths = []
+    rapid, points = None, []
+    for line in lines:
+        words = parseWords(line)
+        move = state.update(words) if words else None
+        if move is None:
+            if None in state.pos and len(points) > 1:
+                # the position became unknown, so end the polyline
+                paths.append((rapid, np.array(points, np.float32)))
+                points = []
+            continue
+        motion, start, end = move
+        if None in start or None in end:
+            continue
+        if (motion == 0) != rapid or not points:
+            if len(points) > 1:
+                paths.append((rapid, np.array(points, np.float32)))
+            rapid, points = (motion == 0), [start]
+        points.append(end)
+    if len(points) > 1:
+        paths.append((rapid, np.array(points, np.float32)))
+    return paths
+
+
+#
+# MAIN
+#
+def syntheticMap(size, numPoints):
+    """
+    Return a synthetic height map -- a tilted plane with a bump in the middle.
+    """
+    xs = np.linspace(0.0, size, numPoints)
+    xv, yv = np.meshgrid(xs, xs)
+    z = (0.002 * xv) - (0.001 * yv) + \
+        (0.3 * np.exp(-(((xv - size / 2) ** 2) + ((yv - size / 2) ** 2)) /
+                      ((size / 4) ** 2)))
+    return np.dstack((xv, yv, z))
+
+
+def syntheticJob(size, step):
+    """
+    Generator for a synthetic (raster) job over a size x size mm area.
+    """
+    yield "G21 G90"
+    yield "G0 Z5.0"
+    yield "G0 X0 Y0"
+    yield "G1 Z-1.0 F300"
+    y = 0.0
+    row = 0
+    while y <= size:
+        x = size if (row % 2) == 0 else 0.0
+        yield "G1 X{0:.3f} Y{1:.3f} F1000".format(x, y)
+        y += step
+        row += 1
+        if y <= size:
+            yield "G1 Y{0:.3f}".format(y)
+    yield "G0 Z5.0"
+    yield "M2"
+
+
+def syntheticRegistration(size, angle, offset, noise, numFiducials=4):
+    """
+    Return a rigid transform fitted to synthetic fiducials -- the corners of
+     a size x size mm area (then its middle), moved by a known rotation (in
+     degrees) and offset, and measured with Gaussian noise (in mm).
+
+    Returns the fitted matrix, the fit residuals, and the true matrix.
+    """
+    corners = [(0.0, 0.0), (size, 0.0), (size, size), (0.0, size),
+               (size / 2, size / 2)]
+    nominal = np.array(corners[:numFiducials], np.float64)
+    theta = np.radians(angle)
+    c, s = np.cos(theta), np.sin(theta)
+    truth = np.array([[c, -s, offset[0]], [s, c, offset[1]]])
+    rng = np.random.RandomState(1)
+    measured = applyRigid(truth, nominal) + rng.normal(0.0, noise,
+                                                       nominal.shape)
+    matrix, residuals = fitRigid(nominal, measured)
+    return matrix, residuals, truth
+
+
+def main():
+    usage = sys.argv[0] + "[-v] [-m <heightMap> [-w <x>,<y>,<z>] | -S] "
+    usage += "[-r <registration> | -R] [-l <segLength>] [-o <outFile>] "
+    usage += "[<inFile>]"
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        'inFile', nargs='?',
+        help="G-code input file (a synthetic job is used if not given)")
+    ap.add_argument(
+        '-m', '--heightMap', action='store', type=str,
+        help="height map (.npy) file")
+    ap.add_argument(
+        '-w', '--workOffset', action='store', type=str,
+        help="work offset of a height map in machine coordinates -- "
+             "'<x>,<y>,<z>'")
+    ap.add_argument(
+        '-S', '--synthetic', action='store_true', default=False,
+        help="use a synthetic height map")
+    ap.add_argument(
+        '-r', '--registration', action='store', type=str,
+        help="rigid transform (.json) file (e.g., from registration.py)")
+    ap.add_argument(
+        '-R', '--syntheticRegistration', action='store_true', default=False,
+        help="use a rigid transform fitted to synthetic fiducials")
+    ap.add_argument(
+        '-l', '--segLength', action='store', type=float,
+        default=DEF_SEGMENT_LENGTH,
+        help="max segment length in mm")
+    ap.add_argument(
+        '-o', '--outFile', action='store', type=str,
+        help="G-code output file")
+    ap.add_argument(
+        '-v', '--verbose', action='count', default=0,
+        help="increase verbosity")
+    options = ap.parse_args()
+
+    heightMap = None
+    if options.heightMap:
+        workOffset = None
+        if options.workOffset:
+            workOffset = [float(v) for v in options.workOffset.split(",")]
+        heightMap = HeightMap(options.heightMap, workOffset=workOffset)
+    elif options.synthetic:
+        heightMap = HeightMap(syntheticMap(200.0, 20))
+    matrix = truth = None
+    if options.registration:
+        matrix = loadRigid(options.registration)
+    elif options.syntheticRegistration:
+        matrix, residuals, truth = syntheticRegistration(
+            200.0, 1.5, (3.2, -1.7), 0.01)
+    if heightMap is None and matrix is None:
+        sys.stderr.write("Error: must give a height map (or use -S) and/or "
+                         "a registration (or use -R)\n")
+        sys.exit(1)
+
+    if options.inFile:
+        inFile = open(options.inFile, 'r')
+        lines = inFile
+    else:
+        inFile = None
+        lines = syntheticJob(200.0, 1.0)
+    outFile = open(options.outFile, 'w') if options.outFile else None
+
+    inLines = [0]
+    outLines = outChars = 0
+
+    def counted(lines):
+        for line in lines:
+            inLines[0] += 1
+            yield line
+
+    # the height map was probed on the workpiece as it's now fixtured, so the
+    #  job is registered before it's warped
+    lines = counted(lines)
+    if matrix is not None:
+        lines = rigidTransform(lines, matrix)
+    if heightMap is not None:
+        lines = zWarp(lines, heightMap, options.segLength)
+
+    start = monotonic()
+    for line in lines:
+        outLines += 1
+        outChars += len(line) + 1
+        if outFile:
+            outFile.write(line + "\n")
+    elapsed = monotonic() - start
+    if inFile:
+        inFile.close()
+    if outFile:
+        outFile.close()
+
+    if options.verbose:
+        # 10 bits per character (8-N-1)
+        lineRate = (DEF_SERIAL_SPEED / 10.0) / (outChars / float(outLines))
+        rate = outLines / elapsed if elapsed else 0.0
+        sys.stdout.write("    Input Lines:     {0}\n".format(inLines[0]))
+        sys.stdout.write("    Output Lines:    {0}\n".format(outLines))
+        if heightMap is not None:
+            sys.stdout.write("    Max Offset:      {0:.3f} mm\n".
+                             format(np.abs(heightMap.z).max()))
+        if matrix is not None:
+            sys.stdout.write("    Rotation:        {0:.4f} deg\n".
+                             format(rigidAngle(matrix)))
+            sys.stdout.write("    Translation:     X{0:.4f} Y{1:.4f} mm\n".
+                             format(matrix[0, 2], matrix[1, 2]))
+        if truth is not None:
+            # how far the fitted transform moves the job's corners from where
+            #  the true one does
+            corners = np.array([(0.0, 0.0), (200.0, 0.0), (200.0, 200.0),
+                                (0.0, 200.0)])
+            error = np.hypot(*(applyRigid(matrix, corners) -
+                               applyRigid(truth, corners)).T).max()
+            sys.stdout.write("    Fit Residuals:   {0:.4f} mm (max)\n".
+                             format(residuals.max()))
+            sys.stdout.write("    Transform Error: {0:.4f} mm (max)\n".
+                             format(error))
+        sys.stdout.write("    Elapsed:         {0:.3f} secs\n".format(elapsed))
+        sys.stdout.write("    Output Rate:     {0:.0f} lines/sec\n".
+                         format(rate))
+        sys.stdout.write("    Serial Rate:     {0:.0f} lines/sec\n".
+                         format(lineRate))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
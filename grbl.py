@@ -3,12 +3,12 @@
 import argparse
 import logging
 import re
-import serial
 import sys
+import threading
 import time
 from Queue import Queue
 
-from util import Alarm, typeCast
+from util import Alarm, monotonic, typeCast
 
 
 '''
@@ -37,6 +37,8 @@ DEF_SERIAL_DEV = "COM3"
 DEF_SERIAL_SPEED = 115200
 DEF_SERIAL_TIMEOUT = 0.1    # serial port timeout (secs)
 DEF_SERIAL_DELAY = 0.1      # inter-character TX delay (secs)
+DEF_STATUS_INTERVAL = 0.05  # secs between status requests while streaming
+DEF_STREAM_TIMEOUT = 10.0   # max secs without a response while streaming
 
 DEF_STARTUP_CMDS = ["$H", "G21", "G90"]    # home, mm, absolute mode
 DEF_STARTUP_CMDS = [] #### TMP TMP TMP
@@ -190,9 +192,16 @@ class SerialDevice(object):
         @param delay ?
         @param timeout How long to wait for CR on readline() (in msec)
         """
+        # N.B. imported here so that users of the library that never open a
+        #  device don't pay for it
+        import serial
+
         self.speed = speed
         self.delay = delay
         self.dev = None
+        # held for each whole command/response exchange, so that another
+        #  thread's exchange (e.g., a status poller's) can't take its responses
+        self.lock = threading.RLock()
         try:
             self.dev = serial.Serial(serialDev, speed, timeout=timeout)
         except:
@@ -214,9 +223,10 @@ class SerialDevice(object):
         line, wait for "delay" msecs for a response from the device.
         Return the response (or "" if none received within the delay time).
         """
-        self.sendLineRaw(line)
-        time.sleep(delay)
-        return self.getResponse()
+        with self.lock:
+            self.sendLineRaw(line)
+            time.sleep(delay)
+            return self.getResponse()
 
     def sendLineRaw(self, line):
         """
@@ -256,6 +266,24 @@ class SerialDevice(object):
             return None
         return out.strip()
 
+    def readLine(self, timeout):
+        """
+        Read a complete response line, without any fixed delays.
+
+        Returns the (stripped) line as soon as it's received, or None if no
+         complete line is received before the timeout (in secs) expires.
+        """
+        end = monotonic() + timeout
+        line = ""
+        while monotonic() < end:
+            # N.B. returns early (with a partial line) on the port's timeout
+            line += self.dev.readline()
+            if line.endswith("\n"):
+                return line.strip()
+        if line:
+            logging.warning("Incomplete response line: %s", line)
+        return None
+
     def waitForResponse(self, timeout):
         """
         Wait for up to 'timeout' seconds for a response line.
@@ -285,10 +313,11 @@ class SerialDevice(object):
         Returns an empty list if no response lines received before the timeout.
         """
         resps = []
-        r = self.waitForResponse(timeout)
-        while r is not None:
-            resps.append(r)
+        with self.lock:
             r = self.waitForResponse(timeout)
+            while r is not None:
+                resps.append(r)
+                r = self.waitForResponse(timeout)
         return resps
 
 
@@ -360,12 +389,13 @@ class GrblDevice(SerialDevice):
 
     def getSettings(self):
         resps = []
-        r = self.sendDollarCmd(DLR_VIEW_SETTINGS)
-        if r:
-            resps.append(r)
-        r = self.gatherResponses(3.0)
-        if r:
-            resps += r
+        with self.lock:
+            r = self.sendDollarCmd(DLR_VIEW_SETTINGS)
+            if r:
+                resps.append(r)
+            r = self.gatherResponses(3.0)
+            if r:
+                resps += r
         if len(resps) < 1:
             return None
         if resps[-1].startswith("ok"):
@@ -397,28 +427,32 @@ class GrblDevice(SerialDevice):
         return self.sendDollarCmd(DLR_VIEW_PARAMETERS)
 
     def getCurrentStatus(self):
-        self.dev.write(RT_CURRENT_STATUS)
-        self.dev.flush()
-        time.sleep(self.delay)
-        return self.getResponse()
+        with self.lock:
+            self.dev.write(RT_CURRENT_STATUS)
+            self.dev.flush()
+            time.sleep(self.delay)
+            return self.getResponse()
 
     def cycleStart(self):
-        self.dev.write(RT_CYCLE_START)
-        self.dev.flush()
-        time.sleep(self.delay)
-        return self.getResponse()
+        with self.lock:
+            self.dev.write(RT_CYCLE_START)
+            self.dev.flush()
+            time.sleep(self.delay)
+            return self.getResponse()
 
     def feedHold(self):
-        self.dev.write(RT_FEED_HOLD)
-        self.dev.flush()
-        time.sleep(self.delay)
-        return self.getResponse()
+        with self.lock:
+            self.dev.write(RT_FEED_HOLD)
+            self.dev.flush()
+            time.sleep(self.delay)
+            return self.getResponse()
 
     def resetGrbl(self):
-        self.dev.write(RT_RESET_GRBL)
-        self.dev.flush()
-        time.sleep(1.0)
-        return self.gatherResponses(1.0)
+        with self.lock:
+            self.dev.write(RT_RESET_GRBL)
+            self.dev.flush()
+            time.sleep(1.0)
+            return self.gatherResponses(1.0)
 
     def writeSettings(self, settings):
         for line in settings:
@@ -428,22 +462,92 @@ class GrblDevice(SerialDevice):
             logging.debug("Send line response: %s", resp)
             # FIXME fix return values
 
-    def writeGcodes(self, gcodes):
+    def handleStatus(self, t, report):
+        """
+        Handle a status report that was read while streaming G-code.
+
+        @param t Time (on the monotonic clock) the report was requested at
+        @param report Status report line (e.g., "<Run|MPos:...>")
+
+        N.B. This does nothing, subclasses override it (e.g., to keep a
+         position history up to date during a job).
+        """
+        pass
+
+    def writeGcodes(self, gcodes, transform=None,
+                    statusInterval=DEF_STATUS_INTERVAL):
+        """
+        Stream lines of G-code to the device.
+
+        @param gcodes Iterable of G-code lines
+        @param transform Generator function that's applied to the lines before
+         they're sent (e.g., a Z-warp -- see gcode.zWarp())
+        @param statusInterval Secs between status requests during the stream
+
+        Lines are sent as soon as there's room for them in GRBL's RX buffer
+         (i.e., by counting the characters of the lines that haven't been
+         acknowledged yet), without any fixed delays, and this returns once
+         every line has been acknowledged.
+        N.B. The device is locked for the whole stream (the lines in GRBL's RX
+         buffer are still waiting for their responses between lines), so other
+         threads' status polls wait until the stream is done. Instead, the
+         stream requests status reports itself (with the realtime '?', which
+         doesn't use the RX buffer), and hands them to handleStatus().
+        """
+        if transform:
+            gcodes = transform(gcodes)
         responses = []
         lineLengths = []
-        for line in gcodes:
-            line = line.strip()
-            lineLengths.append(len(line) + 1)   # sendLine appends '\n' char
-            while ((sum(lineLengths) >= (GRBL_RX_BUFFER_SIZE - 1)) or
-                   self.dev.inWaiting()):
-                resp = self.dev.readline().strip()
-                if resp.find("ok") < 0 and resp.find("error") < 0:
+        now = monotonic()
+        # next status request time, the time of the outstanding request (if
+        #  any), and the time anything was last heard from the device
+        status = {'next': now, 'requested': None, 'heard': now}
+
+        def readResponse():
+            # request a status report if one's due, and read a response line
+            #  (handling status reports), or return None
+            now = monotonic()
+            if status['requested'] is not None and \
+                    (now - status['requested']) > 1.0:
+                # the report was lost
+                status['requested'] = None
+            if now >= status['next'] and status['requested'] is None:
+                self.dev.write(RT_CURRENT_STATUS)
+                status['requested'] = now
+                status['next'] = now + statusInterval
+            resp = self.dev.readline().strip()
+            if resp:
+                status['heard'] = monotonic()
+            elif (monotonic() - status['heard']) > DEF_STREAM_TIMEOUT:
+                logging.error("No response from GRBL while streaming")
+                raise RuntimeError
+            if resp.startswith("<"):
+                self.handleStatus(status['requested'] or now, resp)
+                status['requested'] = None
+                return None
+            if resp.find("ok") < 0 and resp.find("error") < 0:
+                if resp:
                     logging.error("Unknown GRBL response: %s", resp)
-                else:
+                return None
+            return resp
+
+        with self.lock:
+            for line in gcodes:
+                line = line.strip()
+                lineLengths.append(len(line) + 1)   # sendLineRaw adds '\n'
+                while ((sum(lineLengths) >= (GRBL_RX_BUFFER_SIZE - 1)) or
+                       self.dev.inWaiting()):
+                    resp = readResponse()
+                    if resp is not None:
+                        responses.append(resp)
+                        del lineLengths[0]
+                self.sendLineRaw(line)
+            # wait for the rest of the lines to be acknowledged
+            while lineLengths:
+                resp = readResponse()
+                if resp is not None:
                     responses.append(resp)
                     del lineLengths[0]
-            resp = self.sendLine(line, self.delay)
-            responses.append(resp)
         logging.debug("Write GCODE responses: %s", responses)
         #### FIXME fix return values
 
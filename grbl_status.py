@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+"""X-Carve GRBL Status Report Parser -- Library"""
+
+import argparse
+import random
+import re
+import sys
+
+from util import monotonic
+
+
+'''
+DESIGN NOTES:
+  * Status reports are polled continuously, so parsing them is on the hot
+    path -- a (GRBL 1.1) report is parsed in a single pass: one pre-compiled
+    pattern pulls out the state and the position (which is always the first
+    field), and the rest of the fields are split off and looked up in a
+    table of already decoded field strings (they have few distinct values).
+  * The results go into a reusable MachineState object (with __slots__), so no
+    dicts or other objects are built per report other than the tuples of
+    axis values.
+  * GRBL 1.1 reports are '|'-separated, and only include some fields (e.g.,
+    WCO, Ov) every so often, so those values are kept in the MachineState
+    until they're updated. GRBL 0.9 reports are ','-separated, and include
+    both MPos and WPos.
+
+    1.1: <Idle|MPos:0.000,0.000,0.000|FS:0,0|WCO:0.000,0.000,0.000>
+    0.9: <Idle,MPos:0.000,0.000,0.000,WPos:0.000,0.000,0.000,Buf:0,RX:0>
+'''
+
+
+class MachineState(object):
+    """
+    Machine state from a GRBL status report.
+    """
+    __slots__ = ('state', 'subState', 'mpos', 'wpos', 'wco', 'feed',
+                 'spindle', 'planner', 'rxBuffer', 'line', 'overrides',
+                 'pins', 'accessories', 'reports')
+
+    def __init__(self):
+        self.state = None       # e.g., 'Idle', 'Run', 'Hold', 'Alarm'
+        self.subState = None    # e.g., the 0 in 'Hold:0' (int)
+        self.mpos = None        # machine position (x, y, z)
+        self.wpos = None        # work position (x, y, z)
+        self.wco = None         # work coordinate offset (x, y, z)
+        self.feed = None        # current feed rate
+        self.spindle = None     # current spindle speed
+        self.planner = None     # free planner buffer blocks
+        self.rxBuffer = None    # free serial RX buffer bytes
+        self.line = None        # line number being executed
+        self.overrides = None   # (feed, rapid, spindle) override percentages
+        self.pins = ""          # input pins that are triggered
+        self.accessories = ""   # accessory states
+        self.reports = 0        # number of reports parsed
+
+    def machinePosition(self):
+        """
+        Return the machine position, from the WPos and WCO if there's no
+         MPos, or None if it's not known.
+        """
+        if self.mpos is not None:
+            return self.mpos
+        if self.wpos is not None and self.wco is not None:
+            return (self.wpos[0] + self.wco[0], self.wpos[1] + self.wco[1],
+                    self.wpos[2] + self.wco[2])
+        return None
+
+    def workPosition(self):
+        """
+        Return the work position, from the MPos and WCO if there's no WPos,
+         or None if it's not known.
+        """
+        if self.wpos is not None:
+            return self.wpos
+        if self.mpos is not None and self.wco is not None:
+            return (self.mpos[0] - self.wco[0], self.mpos[1] - self.wco[1],
+                    self.mpos[2] - self.wco[2])
+        return None
+
+    def __repr__(self):
+        return "MachineState({0})".format(", ".join(
+            "{0}={1!r}".format(name, getattr(self, name))
+            for name in self.__slots__))
+
+
+# State, sub-state, position type, position, and the rest of the fields of a
+#  GRBL 1.1 report -- the position is always the first field
+REPORT_11 = re.compile(r"<([A-Za-z]+)(?::([0-9]+))?\|([MW])Pos:"
+                       r"([-.0-9]+),([-.0-9]+),([-.0-9]+)\|?([^>]*)>$")
+
+# kinds of (non-position) fields
+FS, F, BF, LN, OV, WCO, PN, A, UNKNOWN = range(9)
+
+# decoded (non-position) fields, by field string -- these have few distinct
+#  values (e.g., 'Bf:15,128', 'Ov:100,100,100'), so they're decoded once
+_fieldCache = {}
+MAX_CACHED_FIELDS = 4096
+
+
+def _decodeField(field):
+    name, _, value = field.partition(":")
+    try:
+        if name == "FS":
+            feed, speed = value.split(",", 1)
+            return FS, (float(feed), float(speed))
+        if name == "Bf":
+            planner, rx = value.split(",", 1)
+            return BF, (int(planner), int(rx))
+        if name == "Ov":
+            feed, rapid, spindle = value.split(",", 2)
+            return OV, (int(feed), int(rapid), int(spindle))
+        if name == "WCO":
+            x, y, z = value.split(",", 2)
+            return WCO, (float(x), float(y), float(z))
+        if name == "Ln":
+            return LN, int(value)
+        if name == "F":
+            return F, float(value)
+    except ValueError:
+        pass
+    else:
+        if name == "Pn":
+            return PN, value
+        if name == "A":
+            return A, value
+    return UNKNOWN, None
+
+
+def parse(report, ms):
+    """
+    Parse a status report into a MachineState.
+
+    @param report Status report line (e.g., '<Idle|MPos:1.0,2.0,3.0|FS:0,0>')
+    @param ms MachineState to fill in
+
+    Returns True if the report was parsed, or False if it's not a (valid)
+     status report (in which case the MachineState isn't changed).
+    N.B. malformed fields other than the position are ignored.
+    """
+    m = REPORT_11.match(report)
+    if m is None:
+        if report.startswith("<") and report.endswith(">") and \
+           "|" not in report:
+            return _parse09(report[1:-1], ms)
+        return False
+    state, sub, posType, x, y, z, rest = m.groups()
+    try:
+        pos = (float(x), float(y), float(z))
+    except ValueError:
+        return False
+
+    ms.state = state
+    ms.subState = int(sub) if sub else None
+    # a report has either an MPos or a WPos
+    if posType == "M":
+        ms.mpos = pos
+        ms.wpos = None
+    else:
+        ms.wpos = pos
+        ms.mpos = None
+    # these are only present when they're non-empty
+    ms.pins = ""
+    ms.accessories = ""
+    if rest:
+        cache = _fieldCache
+        for field in rest.split("|"):
+            decoded = cache.get(field)
+            if decoded is None:
+                decoded = _decodeField(field)
+                if len(cache) < MAX_CACHED_FIELDS:
+                    cache[field] = decoded
+            kind, value = decoded
+            if kind == FS:
+                ms.feed, ms.spindle = value
+            elif kind == BF:
+                ms.planner, ms.rxBuffer = value
+            elif kind == OV:
+                ms.overrides = value
+            elif kind == WCO:
+                ms.wco = value
+            elif kind == LN:
+                ms.line = value
+            elif kind == F:
+                ms.feed = value
+            elif kind == PN:
+                ms.pins = value
+            elif kind == A:
+                ms.accessories = value
+    ms.reports += 1
+    return True
+
+
+def _parse09(body, ms):
+    tokens = body.split(",")
+    mpos = wpos = None
+    planner, rxBuffer, line, feed = ms.planner, ms.rxBuffer, ms.line, ms.feed
+    n, numTokens = 1, len(tokens)
+    try:
+        while n < numTokens:
+            name, _, value = tokens[n].partition(":")
+            if name == "MPos" or name == "WPos":
+                pos = (float(value), float(tokens[n + 1]),
+                       float(tokens[n + 2]))
+                if name == "MPos":
+                    mpos = pos
+                else:
+                    wpos = pos
+                n += 3
+                continue
+            if name == "Buf":
+                planner = int(value)
+            elif name == "RX":
+                rxBuffer = int(value)
+            elif name == "Ln":
+                line = int(value)
+            elif name == "F":
+                feed = float(value)
+            n += 1
+    except (ValueError, IndexError):
+        return False
+    ms.state = tokens[0]
+    ms.subState = None
+    ms.mpos, ms.wpos = mpos, wpos
+    ms.planner, ms.rxBuffer, ms.line, ms.feed = planner, rxBuffer, line, feed
+    ms.reports += 1
+    return True
+
+
+#
+# TEST
+#
+TEST_REPORTS = [
+    "<Idle|MPos:0.000,0.000,0.000|FS:0,0|WCO:-10.000,-20.000,-5.000>",
+    "<Run|MPos:12.345,67.890,-1.250|Bf:15,128|FS:500,8000|Ov:100,100,100>",
+    "<Hold:0|WPos:22.345,87.890,3.750|Bf:14,100|Ln:99|FS:0,0|Pn:XZ|A:SF>",
+    "<Jog|MPos:100.000,20.000,-3.000|FS:1000,0>",
+    "<Idle,MPos:5.529,0.560,7.000,WPos:1.529,-5.440,-0.000,Buf:0,RX:0>",
+    "<Run,MPos:12.000,3.500,-1.000,WPos:2.000,0.500,-1.000,Ln:7,F:300.>"
+]
+
+if __name__ == '__main__':
+    usage = sys.argv[0] + "[-v] [-n <numReports>]"
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        '-n', '--numReports', action='store', type=int, default=200000,
+        help="number of reports to parse in the benchmark")
+    ap.add_argument(
+        '-v', '--verbose', action='count', default=0,
+        help="increase verbosity")
+    options = ap.parse_args()
+
+    ms = MachineState()
+    for report in TEST_REPORTS:
+        parse(report, ms)
+        sys.stdout.write("{0}\n    state={1} sub={2} mpos={3} wpos={4}\n".
+                         format(report, ms.state, ms.subState,
+                                ms.machinePosition(), ms.workPosition()))
+        if options.verbose:
+            sys.stdout.write("    {0}\n".format(ms))
+
+    # microbenchmark -- GRBL 1.1 reports from a moving machine
+    numReports = options.numReports
+    batch = []
+    for i in range(numReports):
+        pos = (random.uniform(0.0, 260.0), random.uniform(0.0, 260.0),
+               random.uniform(-50.0, 0.0))
+        if (i % 10) == 0:
+            fmt = ("<Run|MPos:{0:.3f},{1:.3f},{2:.3f}|FS:500,8000|"
+                   "Ov:100,100,100>")
+        else:
+            fmt = "<Run|MPos:{0:.3f},{1:.3f},{2:.3f}|Bf:15,128|FS:500,8000>"
+        batch.append(fmt.format(*pos))
+    ms = MachineState()
+    start = monotonic()
+    for report in batch:
+        parse(report, ms)
+    elapsed = monotonic() - start
+    sys.stdout.write("Parsed {0} reports in {1:.3f} secs: {2:.0f} "
+                     "reports/sec\n".format(numReports, elapsed,
+                                            numReports / elapsed))
@@ -0,0 +1,401 @@
+#!/usr/bin/env python
+
+"""X-Carve Microscope Tool Wasteboard Mosaic -- Library"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+
+import cv2
+import numpy as np
+
+import xcarve
+
+
+'''
+DESIGN NOTES:
+  * The mosaic covers the whole work area (MAX_X by MAX_Y mm) at the camera's
+    resolution, which is far too big to keep in RAM, so each pyramid level is
+    kept in a memory-mapped file.
+  * The files are laid out tile-major -- i.e., (tileRow, tileCol, y, x, bgr)
+    -- so each tile is contiguous on disk, and only the pages of the tiles
+    that get written or viewed are ever touched.
+  * Each placed frame dirties some level 0 tiles, and only their ancestors
+    are re-computed (by 2x2 downsampling) in the higher pyramid levels.
+  * Machine Y increases away from the operator, and mosaic rows increase
+    downward, so the mosaic's top row is at MAX_Y.
+  * Frames are placed by their work position -- the machine moves in work
+    coordinates, so the (machine) position that GRBL reports has the work
+    coordinate offset taken off.
+'''
+
+DEF_TILE_SIZE = 256
+DEF_OVERLAP = 0.2           # fraction of a frame that adjacent frames overlap
+DEF_SETTLE_FRAMES = 3       # stale frames to discard after each move
+DEF_VIEW_SIZE = (800, 600)
+
+METADATA_FILE = "mosaic.json"
+
+
+class TiledMosaic(object):
+    """
+    Multi-resolution, tiled image of the work area, stored in memory-mapped
+     files.
+    """
+    def __init__(self, path, mmPerPixel=None, width=xcarve.MAX_X,
+                 height=xcarve.MAX_Y, tileSize=DEF_TILE_SIZE):
+        """
+        Instantiate TiledMosaic object, creating a new mosaic or opening an
+         existing one.
+
+        @param path Directory where the mosaic's files are kept
+        @param mmPerPixel Scale of the (level 0) mosaic -- i.e., of the camera
+         frames -- or None to open an existing mosaic
+        @param width Width of the mosaic area in mm
+        @param height Height of the mosaic area in mm
+        @param tileSize Width/height of a tile in pixels
+        """
+        self.path = path
+        metaPath = os.path.join(path, METADATA_FILE)
+        if mmPerPixel is None:
+            if not os.path.isfile(metaPath):
+                logging.error("No mosaic found in '%s'", path)
+                raise ValueError
+            with open(metaPath, 'r') as f:
+                meta = json.load(f)
+            mode = 'r+'
+        else:
+            if mmPerPixel <= 0.0 or tileSize < 2 or (tileSize % 2):
+                logging.error("Invalid mosaic scale/tile size: %f/%d",
+                              mmPerPixel, tileSize)
+                raise ValueError
+            meta = {'mmPerPixel': mmPerPixel, 'width': width,
+                    'height': height, 'tileSize': tileSize}
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            with open(metaPath, 'w') as f:
+                json.dump(meta, f, indent=4, sort_keys=True)
+            mode = 'w+'
+        self.mmPerPixel = meta['mmPerPixel']
+        self.width = meta['width']
+        self.height = meta['height']
+        self.tileSize = meta['tileSize']
+        self.pixWidth = int(math.ceil(self.width / self.mmPerPixel))
+        self.pixHeight = int(math.ceil(self.height / self.mmPerPixel))
+
+        # each level has half as many tiles (in each direction) as the one
+        #  below it, up to a level that's a single tile
+        T = self.tileSize
+        tilesX = int(math.ceil(self.pixWidth / float(T)))
+        tilesY = int(math.ceil(self.pixHeight / float(T)))
+        self.levels = []
+        self.filled = []
+        while True:
+            lvl = len(self.levels)
+            tiles = np.memmap(os.path.join(path, "level{0}.dat".format(lvl)),
+                              dtype=np.uint8, mode=mode,
+                              shape=(tilesY, tilesX, T, T, 3))
+            filled = np.memmap(os.path.join(path, "level{0}.map".format(lvl)),
+                               dtype=np.uint8, mode=mode,
+                               shape=(tilesY, tilesX))
+            self.levels.append(tiles)
+            self.filled.append(filled)
+            if tilesX == 1 and tilesY == 1:
+                break
+            tilesX = (tilesX + 1) // 2
+            tilesY = (tilesY + 1) // 2
+
+    def flush(self):
+        for tiles, filled in zip(self.levels, self.filled):
+            tiles.flush()
+            filled.flush()
+
+    def toPixels(self, x, y):
+        """
+        Return the level 0 (col, row) pixel coordinates of an (x, y) position
+         in mm.
+        """
+        return (x / self.mmPerPixel), ((self.height - y) / self.mmPerPixel)
+
+    def place(self, img, x, y):
+        """
+        Put a frame into the mosaic.
+
+        @param img Camera frame (must be at the mosaic's scale)
+        @param x X machine position (in mm) of the center of the frame
+        @param y Y machine position (in mm) of the center of the frame
+        """
+        T = self.tileSize
+        h, w = img.shape[:2]
+        col, row = self.toPixels(x, y)
+        c0 = int(round(col - (w / 2.0)))
+        r0 = int(round(row - (h / 2.0)))
+
+        # clip the frame to the mosaic
+        fc0, fr0 = max(-c0, 0), max(-r0, 0)
+        fc1 = min(w, self.pixWidth - c0)
+        fr1 = min(h, self.pixHeight - r0)
+        if fc0 >= fc1 or fr0 >= fr1:
+            logging.warning("Frame at (%f, %f) is outside of the mosaic", x, y)
+            return
+
+        # copy the frame into each of the level 0 tiles that it covers
+        tiles = self.levels[0]
+        dirty = set()
+        for ty in range((r0 + fr0) // T, ((r0 + fr1 - 1) // T) + 1):
+            for tx in range((c0 + fc0) // T, ((c0 + fc1 - 1) // T) + 1):
+                # intersection of the frame and the tile in mosaic coordinates
+                mr0 = max(ty * T, r0 + fr0)
+                mr1 = min((ty + 1) * T, r0 + fr1)
+                mc0 = max(tx * T, c0 + fc0)
+                mc1 = min((tx + 1) * T, c0 + fc1)
+                tiles[ty, tx, (mr0 - ty * T):(mr1 - ty * T),
+                      (mc0 - tx * T):(mc1 - tx * T)] = \
+                    img[(mr0 - r0):(mr1 - r0), (mc0 - c0):(mc1 - c0)]
+                self.filled[0][ty, tx] = 1
+                dirty.add((ty, tx))
+        self._updatePyramid(dirty)
+
+    def _updatePyramid(self, dirty):
+        # rebuild the ancestors of the given dirty level 0 tiles
+        T = self.tileSize
+        half = T // 2
+        for lvl in range(1, len(self.levels)):
+            below = self.levels[lvl - 1]
+            tiles = self.levels[lvl]
+            parents = set((ty // 2, tx // 2) for ty, tx in dirty)
+            for ty, tx in parents:
+                tile = tiles[ty, tx]
+                for dy in range(2):
+                    for dx in range(2):
+                        cy, cx = (ty * 2) + dy, (tx * 2) + dx
+                        quad = tile[(dy * half):((dy + 1) * half),
+                                    (dx * half):((dx + 1) * half)]
+                        if cy >= below.shape[0] or cx >= below.shape[1] or \
+                           not self.filled[lvl - 1][cy, cx]:
+                            quad[:] = 0
+                            continue
+                        cv2.resize(np.asarray(below[cy, cx]), (half, half),
+                                   dst=quad, interpolation=cv2.INTER_AREA)
+                self.filled[lvl][ty, tx] = 1
+            dirty = parents
+
+    def view(self, x0, y0, x1, y1, size=DEF_VIEW_SIZE):
+        """
+        Return an image of the given region of the mosaic.
+
+        @param x0 Left edge of the region (mm)
+        @param y0 Bottom edge of the region (mm)
+        @param x1 Right edge of the region (mm)
+        @param y1 Top edge of the region (mm)
+        @param size (width, height) of the returned image
+
+        Only the tiles that overlap the region, in the coarsest pyramid level
+         that has enough resolution for the requested image size, are read.
+        """
+        T = self.tileSize
+        c0, r0 = self.toPixels(x0, y1)
+        c1, r1 = self.toPixels(x1, y0)
+        scale = max((c1 - c0) / float(size[0]), (r1 - r0) / float(size[1]))
+        lvl = 0
+        if scale > 1.0:
+            lvl = min(int(math.floor(math.log(scale, 2))),
+                      len(self.levels) - 1)
+        f = float(2 ** lvl)
+        c0, r0, c1, r1 = (c0 / f), (r0 / f), (c1 / f), (r1 / f)
+
+        tiles = self.levels[lvl]
+        tilesY, tilesX = tiles.shape[:2]
+        tx0 = min(max(int(c0 // T), 0), tilesX - 1)
+        ty0 = min(max(int(r0 // T), 0), tilesY - 1)
+        tx1 = min(max(int(c1 // T), 0), tilesX - 1)
+        ty1 = min(max(int(r1 // T), 0), tilesY - 1)
+        region = np.zeros((((ty1 - ty0) + 1) * T, ((tx1 - tx0) + 1) * T, 3),
+                          np.uint8)
+        for ty in range(ty0, ty1 + 1):
+            for tx in range(tx0, tx1 + 1):
+                if self.filled[lvl][ty, tx]:
+                    region[((ty - ty0) * T):((ty - ty0 + 1) * T),
+                           ((tx - tx0) * T):((tx - tx0 + 1) * T)] = \
+                        tiles[ty, tx]
+
+        # affine map from the region's pixels to the output image
+        sx = size[0] / (c1 - c0)
+        sy = size[1] / (r1 - r0)
+        M = np.float32([[sx, 0, -sx * (c0 - (tx0 * T))],
+                        [0, sy, -sy * (r0 - (ty0 * T))]])
+        return cv2.warpAffine(region, M, tuple(size), flags=cv2.INTER_LINEAR)
+
+
+def scan(mach, cap, mosaic, region, overlap=DEF_OVERLAP,
+         settleFrames=DEF_SETTLE_FRAMES):
+    """
+    Drive the machine over a raster of positions, and put a frame from each
+     position into the mosaic.
+
+    @param mach XCarve object
+    @param cap VideoCapture object for the (spindle-mounted) camera
+    @param mosaic TiledMosaic object to put the frames into
+    @param region (x0, y0, x1, y1) of the area to scan, in mm (in work
+     coordinates)
+    @param overlap Fraction of a frame that adjacent frames overlap
+    @param settleFrames Number of (stale) frames to discard after each move
+
+    The raster is serpentine, to minimize the travel between positions.
+    Returns the number of frames placed.
+    """
+    x0, y0, x1, y1 = region
+    x0, x1 = max(min(x0, x1), 0.0), min(max(x0, x1), xcarve.MAX_X)
+    y0, y1 = max(min(y0, y1), 0.0), min(max(y0, y1), xcarve.MAX_Y)
+
+    ret, img = cap.read()
+    if not ret:
+        logging.error("Unable to read frame from camera")
+        raise RuntimeError
+    h, w = img.shape[:2]
+    stepX = w * mosaic.mmPerPixel * (1.0 - overlap)
+    stepY = h * mosaic.mmPerPixel * (1.0 - overlap)
+    xs = np.arange(x0, x1 + (stepX / 2.0), stepX)
+    ys = np.arange(y0, y1 + (stepY / 2.0), stepY)
+
+    wco = mach.getWorkOffset()
+    if wco is None:
+        logging.error("Unable to get the work coordinate offset")
+        raise RuntimeError
+
+    count = 0
+    for row, y in enumerate(ys):
+        for x in (xs if (row % 2) == 0 else xs[::-1]):
+            mach.moveTo(min(x, x1), min(y, y1))
+            pos = mach.waitForIdle()
+            if pos is None:
+                logging.error("Move to (%f, %f) didn't finish", x, y)
+                raise RuntimeError
+            for i in range(settleFrames):
+                cap.grab()
+            ret, img = cap.read()
+            if not ret:
+                logging.warning("Dropped frame at (%f, %f)", x, y)
+                continue
+            mosaic.place(img, pos[0] - wco[0], pos[1] - wco[1])
+            count += 1
+    mosaic.flush()
+    return count
+
+
+class MosaicViewer(object):
+    """
+    Interactive (zoom and pan) viewer for a mosaic.
+
+    Keys: '+'/'-' zoom in/out, 'w'/'a'/'s'/'d' pan, 'q' quits.
+    """
+    PAN_STEP = 0.25     # fraction of the view to pan per key press
+    ZOOM_STEP = 1.5
+
+    def __init__(self, mosaic, size=DEF_VIEW_SIZE):
+        self.mosaic = mosaic
+        self.size = size
+        self.centerX = mosaic.width / 2.0
+        self.centerY = mosaic.height / 2.0
+        # mm per screen pixel, starting with the whole mosaic in view
+        self.zoom = max(mosaic.width / float(size[0]),
+                        mosaic.height / float(size[1]))
+
+    def render(self):
+        halfW = (self.size[0] * self.zoom) / 2.0
+        halfH = (self.size[1] * self.zoom) / 2.0
+        return self.mosaic.view(self.centerX - halfW, self.centerY - halfH,
+                                self.centerX + halfW, self.centerY + halfH,
+                                self.size)
+
+    def run(self, window='mosaic'):
+        cv2.namedWindow(window)
+        while True:
+            cv2.imshow(window, self.render())
+            key = cv2.waitKey(0) & 0xFF
+            panX = self.size[0] * self.zoom * MosaicViewer.PAN_STEP
+            panY = self.size[1] * self.zoom * MosaicViewer.PAN_STEP
+            if key == ord('q'):
+                break
+            elif key in (ord('+'), ord('=')):
+                self.zoom /= MosaicViewer.ZOOM_STEP
+            elif key == ord('-'):
+                self.zoom *= MosaicViewer.ZOOM_STEP
+            elif key == ord('a'):
+                self.centerX -= panX
+            elif key == ord('d'):
+                self.centerX += panX
+            elif key == ord('w'):
+                self.centerY += panY
+            elif key == ord('s'):
+                self.centerY -= panY
+        cv2.destroyWindow(window)
+
+
+#
+# MAIN
+#
+def main():
+    usage = sys.argv[0] + "[-v] -m <mosaicDir> [-S <mmPerPixel>] "
+    usage += "[-r <x0>,<y0>,<x1>,<y1> -c <serialDev> [-d <devIndx>]] [-V]"
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        '-m', '--mosaic', action='store', type=str, required=True,
+        help="mosaic directory")
+    ap.add_argument(
+        '-S', '--scale', action='store', type=float,
+        help="camera scale in mm/pixel (creates a new mosaic)")
+    ap.add_argument(
+        '-t', '--tileSize', action='store', type=int, default=DEF_TILE_SIZE,
+        help="tile width/height in pixels")
+    ap.add_argument(
+        '-r', '--region', action='store', type=str,
+        help="region to scan in mm -- 'x0,y0,x1,y1'")
+    ap.add_argument(
+        '-c', '--cnc', action='store', type=str,
+        help="name of CNC's serial port -- 'COM3', '/dev/tty1', etc.")
+    ap.add_argument(
+        '-d', '--deviceIndex', action='store', type=int, default=0,
+        help="video input device index")
+    ap.add_argument(
+        '-V', '--view', action='store_true',
+        help="view the mosaic")
+    ap.add_argument(
+        '-v', '--verbose', action='count', default=0,
+        help="increase verbosity")
+    options = ap.parse_args()
+
+    mosaic = TiledMosaic(options.mosaic, options.scale,
+                         tileSize=options.tileSize)
+    if options.verbose:
+        sys.stdout.write("    Mosaic:       {0}\n".format(options.mosaic))
+        sys.stdout.write("    Scale:        {0} mm/pixel\n".
+                         format(mosaic.mmPerPixel))
+        sys.stdout.write("    Size:         {0} x {1} pixels\n".
+                         format(mosaic.pixWidth, mosaic.pixHeight))
+        sys.stdout.write("    Levels:       {0}\n".format(len(mosaic.levels)))
+        sys.stdout.flush()
+
+    if options.region:
+        if not options.cnc:
+            sys.stderr.write("Error: must give CNC serial port to scan\n")
+            sys.exit(1)
+        region = [float(v) for v in options.region.split(",")]
+        mach = xcarve.XCarve({'cnc': {'device': options.cnc}})
+        cap = cv2.VideoCapture(options.deviceIndex)
+        try:
+            count = scan(mach, cap, mosaic, region)
+        finally:
+            cap.release()
+        if options.verbose:
+            sys.stdout.write("    Frames:       {0}\n".format(count))
+
+    if options.view:
+        MosaicViewer(mosaic).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+"""X-Carve Microscope Tool Runtime Parameter Registry -- Library"""
+
+import logging
+import os
+
+
+'''
+DESIGN NOTES:
+  * Run-time adjustable values (crosshair alpha, detector thresholds, etc.)
+    live in a single registry. Changes are pushed into it (e.g., by trackbar
+    callbacks) rather than polled on every frame, and consumers subscribe to
+    the values they care about so they only rebuild their derived state when
+    a value actually changes.
+  * Each parameter can be tied to a location in the config dict, so values are
+    loaded from the (YAML) config, and tuned values can be saved back to it.
+'''
+
+
+class Parameter(object):
+    """
+    A single run-time adjustable value.
+    """
+    def __init__(self, name, value, maxPos, scale=1.0, configPath=None):
+        """
+        Instantiate Parameter object.
+
+        @param name Parameter name (also used as the trackbar name)
+        @param value Initial value
+        @param maxPos Max trackbar position
+        @param scale Value of one trackbar step (value = position * scale)
+        @param configPath List of keys of the value's location in the config
+        """
+        self.name = name
+        self.value = value
+        self.maxPos = maxPos
+        self.scale = scale
+        self.configPath = list(configPath) if configPath else None
+
+    def toPos(self, value):
+        return int(round(value / self.scale))
+
+    def fromPos(self, pos):
+        if self.scale == 1.0:
+            return int(pos)
+        return pos * self.scale
+
+
+class ParameterRegistry(object):
+    """
+    Registry of run-time adjustable parameters, with change notification.
+    """
+    def __init__(self):
+        self.params = {}
+        self.subscribers = {}   # parameter name -> list of callbacks
+
+    def define(self, name, value, maxPos, scale=1.0, configPath=None,
+               config=None):
+        """
+        Define a parameter.
+
+        @param name Parameter name
+        @param value Default value
+        @param maxPos Max trackbar position
+        @param scale Value of one trackbar step
+        @param configPath List of keys of the value's location in the config
+        @param config Config dict to get the initial value from (if present)
+        """
+        if config is not None and configPath:
+            value = _getPath(config, configPath, value)
+        self.params[name] = Parameter(name, value, maxPos, scale, configPath)
+        self.subscribers.setdefault(name, [])
+
+    def get(self, name):
+        return self.params[name].value
+
+    def values(self, names=None):
+        """
+        Return a dict of the (given) parameters' current values.
+        """
+        if names is None:
+            names = self.params.keys()
+        return {name: self.params[name].value for name in names}
+
+    def set(self, name, value):
+        """
+        Set a parameter's value, notifying its subscribers if it changed.
+
+        Returns True if the value changed.
+        """
+        param = self.params[name]
+        if value == param.value:
+            return False
+        param.value = value
+        for callback in self.subscribers[name]:
+            callback(name, value)
+        return True
+
+    def subscribe(self, names, callback):
+        """
+        Register a callback to be called (with name and value) whenever any of
+         the given parameters change.
+        """
+        for name in names:
+            if name not in self.params:
+                logging.error("Unknown parameter: %s", name)
+                raise ValueError
+            self.subscribers[name].append(callback)
+
+    def createTrackbars(self, window, names=None):
+        """
+        Create a trackbar in the given window for each of the (given)
+         parameters, which pushes its changes into the registry.
+        """
+        import cv2
+
+        if names is None:
+            names = sorted(self.params.keys())
+        for name in names:
+            param = self.params[name]
+            cv2.createTrackbar(name, window, param.toPos(param.value),
+                               param.maxPos, self._trackbarHandler(name))
+
+    def _trackbarHandler(self, name):
+        param = self.params[name]
+
+        def handler(pos):
+            self.set(name, param.fromPos(pos))
+        return handler
+
+    def updateConfig(self, config):
+        """
+        Write the current parameter values into a config dict.
+        """
+        for param in self.params.values():
+            if param.configPath:
+                _setPath(config, param.configPath, param.value)
+
+    def save(self, path):
+        """
+        Save the current parameter values to a YAML config file.
+
+        Values are merged into the file's existing contents (if any), so the
+         rest of the file's settings are preserved.
+        """
+        import yaml
+
+        conf = {}
+        if os.path.isfile(path):
+            with open(path, 'r') as ymlFile:
+                conf = yaml.load(ymlFile) or {}
+        self.updateConfig(conf)
+        with open(path, 'w') as ymlFile:
+            yaml.dump(conf, ymlFile, default_flow_style=False)
+        logging.info("Saved parameters to '%s'", path)
+
+
+def _getPath(conf, path, default=None):
+    for key in path:
+        if not isinstance(conf, dict) or key not in conf:
+            return default
+        conf = conf[key]
+    return conf
+
+
+def _setPath(conf, path, value):
+    for key in path[:-1]:
+        if key not in conf or not isinstance(conf[key], dict):
+            conf[key] = {}
+        conf = conf[key]
+    conf[path[-1]] = value
+
+
+#
+# TEST
+#
+if __name__ == '__main__':
+    import tempfile
+
+    reg = ParameterRegistry()
+    reg.define('alpha', 0.5, 100, 0.01, ['crosshair', 'alpha'])
+    reg.define('thrs1', 3000, 10000, configPath=['detection', 'params',
+                                                 'thrs1'])
+
+    def changed(name, value):
+        print("Changed: {0} = {1}".format(name, value))
+    reg.subscribe(['alpha', 'thrs1'], changed)
+
+    reg._trackbarHandler('alpha')(75)
+    reg._trackbarHandler('alpha')(75)   # no change, so no notification
+    reg.set('thrs1', 2500)
+
+    path = os.path.join(tempfile.mkdtemp(), "test.yml")
+    reg.save(path)
+    with open(path, 'r') as f:
+        print(f.read())
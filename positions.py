@@ -0,0 +1,240 @@
+"""X-Carve Microscope Tool Machine Position History -- Library"""
+
+import logging
+import threading
+import time
+
+import numpy as np
+
+
+'''
+DESIGN NOTES:
+  * Frames and machine status reports are both timestamped on the same
+    (monotonic) clock, so the machine position can be found for the instant a
+    frame was exposed, and measurements can be made while the gantry moves.
+  * Status reports are polled on a background thread and kept in a fixed-size
+    ring buffer, and the position at a frame's time is linearly interpolated
+    between the reports on either side of it.
+  * While G-code is being streamed the device is locked, so the poller can't
+    poll -- the stream requests status reports itself, and the poller
+    listens for them.
+  * A frame is exposed some (roughly constant) time before cap.read() returns
+    it, so frame timestamps are corrected by a calibrated camera latency.
+  * The poller sleeps between polls, so that other users of the device (e.g.,
+    jogging, or starting a stream) can get its lock.
+'''
+
+DEF_HISTORY_SIZE = 256      # number of status reports kept
+DEF_MAX_HOLD = 0.25         # max secs past the newest report to use it for
+DEF_POLL_INTERVAL = 0.05    # extra secs between status polls
+
+DEF_CAMERA_LATENCY = 0.1    # secs from exposure to cap.read() returning
+
+
+class StatusHistory(object):
+    """
+    Ring buffer of timestamped machine status reports.
+    """
+    def __init__(self, size=DEF_HISTORY_SIZE, maxHold=DEF_MAX_HOLD):
+        """
+        Instantiate StatusHistory object.
+
+        @param size Number of status reports to keep
+        @param maxHold Max secs past the newest report for which its position
+         is returned (rather than None)
+        """
+        if size < 2:
+            logging.error("Status history must hold at least 2 reports")
+            raise ValueError
+        self.size = size
+        self.maxHold = maxHold
+        self.times = np.zeros(size, np.float64)
+        self.positions = np.zeros((size, 3), np.float64)
+        self.states = [None] * size
+        self.head = 0       # index of the next slot to be written
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, t, state, pos):
+        """
+        Add a status report.
+
+        @param t Time of the report (on the monotonic clock)
+        @param state GRBL machine state (e.g., 'Idle', 'Run')
+        @param pos Machine (x, y, z) position in mm
+        """
+        with self.lock:
+            if self.count:
+                last = self.times[(self.head - 1) % self.size]
+                if t < (last - self.maxHold):
+                    # N.B. only if the clock isn't monotonic (see util) --
+                    #  otherwise every report would be dropped until it caught
+                    #  up
+                    logging.warning("Clock went back %.3f secs, clearing the "
+                                    "status history", last - t)
+                    self.count = 0
+                elif t <= last:
+                    logging.debug("Discarding out-of-order status report")
+                    return
+            self.times[self.head] = t
+            self.positions[self.head] = pos
+            self.states[self.head] = state
+            self.head = (self.head + 1) % self.size
+            self.count = min(self.count + 1, self.size)
+
+    def _ordered(self):
+        # indices of the reports, oldest first
+        return (self.head - self.count + np.arange(self.count)) % self.size
+
+    def latest(self):
+        """
+        Return the newest (t, state, (x, y, z)) report, or None if there is
+         none.
+        """
+        with self.lock:
+            if not self.count:
+                return None
+            i = (self.head - 1) % self.size
+            return self.times[i], self.states[i], tuple(self.positions[i])
+
+    def positionAt(self, t):
+        """
+        Return the machine (x, y, z) position at the given time, interpolated
+         between the status reports before and after it.
+
+        Returns None if the time isn't covered by the history.
+        """
+        with self.lock:
+            if not self.count:
+                return None
+            idx = self._ordered()
+            times = self.times[idx]
+            if t < times[0] or t > (times[-1] + self.maxHold):
+                return None
+            n = np.searchsorted(times, t)
+            if n >= len(idx):
+                return tuple(self.positions[idx[-1]])
+            if n == 0 or times[n] == t:
+                return tuple(self.positions[idx[n]])
+            t0, t1 = times[n - 1], times[n]
+            p0, p1 = self.positions[idx[n - 1]], self.positions[idx[n]]
+            return tuple(p0 + (p1 - p0) * ((t - t0) / (t1 - t0)))
+
+    def stateAt(self, t):
+        """
+        Return the machine state of the last status report at or before the
+         given time, or None if there is none.
+        """
+        with self.lock:
+            if not self.count:
+                return None
+            idx = self._ordered()
+            n = np.searchsorted(self.times[idx], t, side='right')
+            if n == 0:
+                return None
+            return self.states[idx[n - 1]]
+
+
+class StatusPoller(threading.Thread):
+    """
+    Poll the machine's status on a background thread, and add the reports to
+     a StatusHistory.
+    """
+    def __init__(self, mach, history, interval=DEF_POLL_INTERVAL):
+        """
+        Instantiate StatusPoller object, and start polling.
+
+        @param mach XCarve object to poll
+        @param history StatusHistory to add the reports to
+        @param interval Extra secs to wait between polls
+        """
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.mach = mach
+        self.history = history
+        self.interval = interval
+        self.polls = 0
+        self.failures = 0
+        self.running = True
+        mach.statusListeners.append(self.history.add)
+        self.start()
+
+    def run(self):
+        while self.running:
+            t, state, pos = self.mach.getTimedState()
+            self.polls += 1
+            if pos is None:
+                self.failures += 1
+            else:
+                self.history.add(t, state, pos)
+            if self.interval:
+                time.sleep(self.interval)
+
+    def stop(self):
+        self.running = False
+        self.join()
+        self.mach.statusListeners.remove(self.history.add)
+
+
+def frameTime(readTime, latency=DEF_CAMERA_LATENCY):
+    """
+    Return the (monotonic clock) time at which a frame was exposed, given the
+     time at which cap.read() returned it.
+    """
+    return readTime - latency
+
+
+def estimateLatency(history, readTimes, imageShifts, mmPerPixel,
+                    candidates=None):
+    """
+    Estimate the camera latency from frames captured as the machine starts
+     a move from rest.
+
+    @param history StatusHistory covering the move
+    @param readTimes List of times at which cap.read() returned each frame
+     (the first frame must be captured before the move starts)
+    @param imageShifts List of (dx, dy) image shifts (in pixels) of each frame
+     relative to the first one (e.g., from cv2.phaseCorrelate())
+    @param mmPerPixel Camera scale
+    @param candidates Latency values (in secs) to try
+
+    Returns the candidate latency for which the machine's (interpolated)
+     motion best matches the motion seen by the camera.
+    """
+    if candidates is None:
+        candidates = np.arange(0.0, 0.5, 0.005)
+    seen = np.asarray(imageShifts, np.float64) * mmPerPixel
+    best, bestErr = None, None
+    for latency in candidates:
+        positions = [history.positionAt(t - latency) for t in readTimes]
+        valid = [i for i, p in enumerate(positions) if p is not None]
+        if len(valid) < 2 or positions[0] is None:
+            continue
+        moved = np.array([positions[i][:2] for i in valid]) - positions[0][:2]
+        err = np.mean(np.sum((moved - seen[valid]) ** 2, axis=1))
+        if bestErr is None or err < bestErr:
+            best, bestErr = latency, err
+    return best
+
+
+#
+# TEST
+#
+if __name__ == '__main__':
+    history = StatusHistory(64)
+    # machine starts moving along X at 10 mm/sec at 1.0 secs, with reports
+    #  every 0.05 secs
+    def machX(t):
+        return max(t - 1.0, 0.0) * 10.0
+    for i in range(60):
+        history.add(i * 0.05, "Run", (machX(i * 0.05), 20.0, -5.0))
+    print("Position at 1.22 secs: {0}".format(history.positionAt(1.22)))
+    print("Position at 10.0 secs: {0}".format(history.positionAt(10.0)))
+
+    # camera frames that are returned 0.12 secs after they were exposed
+    latency = 0.12
+    readTimes = [0.8 + i / 30.0 for i in range(45)]
+    shifts = [((machX(t - latency) - machX(readTimes[0] - latency)) / 0.01,
+               0.0) for t in readTimes]
+    print("Estimated latency: {0:.3f} secs".format(
+        estimateLatency(history, readTimes, shifts, 0.01)))
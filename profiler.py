@@ -0,0 +1,217 @@
+"""X-Carve Microscope Tool Frame Loop Profiler -- Library"""
+
+import json
+import logging
+
+import numpy as np
+
+from util import monotonic
+
+
+'''
+DESIGN NOTES:
+  * Each frame is timestamped at the start and at the end of each stage, and
+    the per-stage durations are stored in a fixed-size (preallocated) ring
+    buffer, so there's no per-frame allocation.
+  * Percentiles are only computed when the stats are refreshed (for the OSD)
+    or dumped, never on every frame, so the overhead is a clock read and an
+    array store per stage.
+  * Other components' counters (e.g., the recorder's backlog and dropped
+    frames) can be added as sources, so they're dumped periodically along
+    with the frame stats, rather than only being logged at exit. (They're
+    not shown in the OSD, as its corner is full.)
+'''
+
+DEF_STAGES = ["capture", "process", "overlay", "record", "display", "cnc",
+              "input"]
+DEF_WINDOW = 256            # number of frames kept in the ring buffer
+DEF_REFRESH_INTERVAL = 0.5  # secs between recomputing displayed stats
+DEF_DUMP_INTERVAL = 10.0    # secs between stats dumps
+
+PERCENTILES = [50, 95, 99]
+
+# a frame interval more than this many frame periods counts as a drop
+DROP_FACTOR = 1.5
+
+
+class StageProfiler(object):
+    """
+    Lightweight per-frame, per-stage timing instrumentation for the frame loop.
+
+    Usage, for each frame: startFrame(), then mark(<stage>) at the end of each
+     stage, then endFrame().
+    """
+    def __init__(self, stages=DEF_STAGES, window=DEF_WINDOW, frameRate=None,
+                 dumpInterval=DEF_DUMP_INTERVAL, statsFile=None):
+        """
+        Instantiate StageProfiler object.
+
+        @param stages List of stage names, in the order they run in the loop
+        @param window Number of frames of samples to keep
+        @param frameRate Nominal frame rate of the camera (used to detect
+         dropped frames), or None to not count drops
+        @param dumpInterval Secs between stats dumps (None to disable)
+        @param statsFile File to append stats to (as JSON lines), or None to
+         write them to the log
+        """
+        self.stages = list(stages)
+        self.index = {name: i for i, name in enumerate(self.stages)}
+        self.window = window
+        self.framePeriod = (1.0 / frameRate) if frameRate else None
+        self.dumpInterval = dumpInterval
+        self.statsFile = statsFile
+
+        # per-stage durations plus the total frame time and frame interval
+        self.samples = np.zeros((window, len(self.stages) + 2))
+        self.totalCol = len(self.stages)
+        self.intervalCol = len(self.stages) + 1
+        self.row = self.samples[0]
+        self.count = 0
+        self.frames = 0
+        self.dropped = 0
+
+        # (name, getStats, keys) of other components whose stats are reported
+        self.sources = []
+
+        self.frameStart = None
+        self.lastMark = None
+        self.stats = None
+        self.statsTime = None
+        self.dumpTime = monotonic()
+
+    def addSource(self, name, getStats, keys):
+        """
+        Report another component's stats along with the frame stats.
+
+        @param name Key under which the component's stats are reported
+        @param getStats Function that returns a dict of the component's stats
+        @param keys Keys of the (scalar) stats to report
+        """
+        self.sources.append((name, getStats, list(keys)))
+
+    def startFrame(self):
+        """
+        Mark the start of a frame.
+        """
+        now = monotonic()
+        self.row = self.samples[self.count % self.window]
+        self.row[:] = 0.0
+        if self.frameStart is not None:
+            interval = now - self.frameStart
+            self.row[self.intervalCol] = interval
+            if self.framePeriod and \
+               interval > (DROP_FACTOR * self.framePeriod):
+                self.dropped += int(round(interval / self.framePeriod)) - 1
+        self.frameStart = now
+        self.lastMark = now
+
+    def mark(self, stage):
+        """
+        Mark the end of the given stage (which started at the previous mark).
+        """
+        now = monotonic()
+        self.row[self.index[stage]] += now - self.lastMark
+        self.lastMark = now
+
+    def dropFrame(self):
+        """
+        Count a frame that was lost -- e.g., the camera read failed.
+        """
+        self.dropped += 1
+
+    def endFrame(self):
+        """
+        Mark the end of a frame, and dump the stats if it's time to.
+        """
+        self.row[self.totalCol] = self.lastMark - self.frameStart
+        self.count += 1
+        self.frames += 1
+        if self.dumpInterval and \
+           (self.lastMark - self.dumpTime) >= self.dumpInterval:
+            self.dump()
+            self.dumpTime = self.lastMark
+
+    def frameTimes(self):
+        """
+        Return the last frame's stage durations followed by its total time
+         (a view that's reused, so it's only valid until the next frame).
+        """
+        return self.row[:self.intervalCol]
+
+    def getStats(self):
+        """
+        Return a dict of the current stats.
+
+        Per-stage (and total) percentile latencies are in msec.
+        """
+        n = min(self.count, self.window)
+        stats = {'frames': self.frames, 'dropped': self.dropped, 'fps': None,
+                 'stages': {}}
+        for name, getStats, keys in self.sources:
+            values = getStats()
+            stats[name] = {key: values[key] for key in keys}
+        if n < 1:
+            return stats
+        samples = self.samples[:n] * 1000.0
+        pcts = np.percentile(samples, PERCENTILES, axis=0)
+        names = self.stages + ["total"]
+        for col, name in enumerate(names):
+            stats['stages'][name] = {"p{0}".format(p): round(pcts[i][col], 3)
+                                     for i, p in enumerate(PERCENTILES)}
+        intervals = samples[:, self.intervalCol]
+        intervals = intervals[intervals > 0.0]
+        if len(intervals):
+            stats['fps'] = round(1000.0 / intervals.mean(), 1)
+        return stats
+
+    def dump(self):
+        """
+        Write the current stats to the stats file, or to the log.
+        """
+        stats = self.getStats()
+        if self.statsFile:
+            with open(self.statsFile, 'a') as f:
+                f.write(json.dumps(stats, sort_keys=True) + "\n")
+        else:
+            logging.info("Frame stats: %s", json.dumps(stats, sort_keys=True))
+
+    def overlay(self, img, osd, corner, refresh=DEF_REFRESH_INTERVAL):
+        """
+        Overlay the frame rate and total frame latency on the image.
+
+        @param img Image onto which the stats are overlayed
+        @param osd OnScreenDisplay object to use
+        @param corner OSD corner in which to put the stats
+        @param refresh Secs between recomputing the displayed stats
+        """
+        now = self.lastMark
+        if self.statsTime is None or (now - self.statsTime) >= refresh:
+            self.stats = self.getStats()
+            self.statsTime = now
+        stats = self.stats
+        if stats['fps'] is None:
+            return img
+        total = stats['stages']['total']
+        img = osd.overlay(img, corner, 0, "FPS {0:.1f}".format(stats['fps']))
+        img = osd.overlay(img, corner, 1, "p95 {0:.1f}".format(total['p95']))
+        img = osd.overlay(img, corner, 2, "DRP {0}".format(stats['dropped']))
+        return img
+
+
+#
+# TEST
+#
+if __name__ == '__main__':
+    import time
+
+    prof = StageProfiler(frameRate=100.0, dumpInterval=None)
+    prof.addSource('recorder', lambda: {'backlog': 2, 'dropped': 0,
+                                        'segments': []},
+                   ['backlog', 'dropped'])
+    for i in range(50):
+        prof.startFrame()
+        for stage in prof.stages:
+            time.sleep(0.001)
+            prof.mark(stage)
+        prof.endFrame()
+    print(json.dumps(prof.getStats(), indent=4, sort_keys=True))
@@ -0,0 +1,452 @@
+"""X-Carve Microscope Tool Background Video Recorder -- Library"""
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+from Queue import Queue, Empty, Full
+
+import cv2
+import numpy as np
+
+
+'''
+DESIGN NOTES:
+  * The frame loop only copies the (annotated) frame into a preallocated
+    buffer and queues the buffer's index -- all of the resizing, encoding,
+    and file I/O is done by a dedicated encoder thread (N.B. OpenCV releases
+    the GIL while encoding).
+  * The queue is bounded, and what happens when it's full is set by the drop
+    policy: 'oldest' drops the oldest queued frame, 'newest' drops the frame
+    being written, and 'block' waits for the encoder (which stalls the loop).
+  * Recordings are split into segments by time and/or file size.
+  * The pre-trigger ring keeps the last few seconds of raw frames in a single
+    preallocated block, so capturing a frame is just a copy into the next
+    slot. When it's triggered (e.g., by a machine alarm), a background thread
+    copies the slots, oldest first, into a memory-mapped .npy file. The frame
+    loop keeps going meanwhile, but a frame that would overwrite a slot that
+    hasn't been dumped yet is dropped instead.
+  * The ring's block can be allocated when the first frame arrives, as the
+    camera may not deliver the format it was asked for (e.g., color frames
+    when grayscale isn't supported). If the frame shape changes later, the
+    block is reallocated (and the frames in it are lost).
+'''
+
+DROP_OLDEST = "oldest"
+DROP_NEWEST = "newest"
+DROP_BLOCK = "block"
+DROP_POLICIES = [DROP_OLDEST, DROP_NEWEST, DROP_BLOCK]
+
+DEF_FOURCC = "MJPG"
+DEF_FRAME_RATE = 30.0
+DEF_QUEUE_SIZE = 8
+DEF_DROP_POLICY = DROP_OLDEST
+DEF_SEGMENT_SECS = 600.0    # start a new segment every 10 mins
+DEF_SEGMENT_BYTES = None    # no limit on segment file size
+DEF_RING_SECS = 5.0         # secs of raw frames kept for a dump
+
+# file name extensions for the supported codecs
+CODEC_EXTENSIONS = {
+    'MJPG': ".avi",
+    'XVID': ".avi",
+    'mp4v': ".mp4",
+    'avc1': ".mp4",
+    'H264': ".mkv"
+}
+
+
+class Recorder(object):
+    """
+    Records frames to (segmented) video files from a background thread.
+    """
+    def __init__(self, pathPrefix, frameRate=DEF_FRAME_RATE, fourcc=DEF_FOURCC,
+                 size=None, queueSize=DEF_QUEUE_SIZE,
+                 dropPolicy=DEF_DROP_POLICY, segmentSecs=DEF_SEGMENT_SECS,
+                 segmentBytes=DEF_SEGMENT_BYTES):
+        """
+        Instantiate Recorder object, and start its encoder thread.
+
+        @param pathPrefix Path (and file name prefix) of the segment files
+        @param frameRate Frame rate of the recording
+        @param fourcc Four character code of the video codec
+        @param size Recording (width, height), or None for the input frame size
+        @param queueSize Max number of frames waiting to be encoded
+        @param dropPolicy What to do when the queue is full (see DROP_POLICIES)
+        @param segmentSecs Max duration of a segment (None for no limit)
+        @param segmentBytes Max size of a segment file (None for no limit)
+        """
+        if dropPolicy not in DROP_POLICIES:
+            logging.error("Invalid drop policy: %s", dropPolicy)
+            raise ValueError
+        if len(fourcc) != 4:
+            logging.error("Invalid codec: %s", fourcc)
+            raise ValueError
+        self.pathPrefix = pathPrefix
+        self.frameRate = frameRate if frameRate else DEF_FRAME_RATE
+        self.fourcc = fourcc
+        self.extension = CODEC_EXTENSIONS.get(fourcc, ".avi")
+        self.size = tuple(size) if size else None
+        self.dropPolicy = dropPolicy
+        self.segmentSecs = segmentSecs
+        self.segmentBytes = segmentBytes
+
+        dirName = os.path.dirname(pathPrefix)
+        if dirName and not os.path.isdir(dirName):
+            os.makedirs(dirName)
+
+        # one buffer for each queue entry, plus one being encoded and one
+        #  being filled
+        self.numBuffers = queueSize + 2
+        self.buffers = None
+        self.free = collections.deque()
+        self.queue = Queue(queueSize)
+
+        self.written = 0
+        self.dropped = 0
+        self.segments = []
+        self.writer = None
+        self.segmentStart = None
+        self.segmentPath = None
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _allocate(self, img):
+        self.buffers = [np.empty_like(img) for i in range(self.numBuffers)]
+        self.free.extend(range(self.numBuffers))
+
+    def write(self, img):
+        """
+        Queue a frame to be recorded.
+
+        Returns False if the frame (or an older one) was dropped.
+        """
+        if self.buffers is None or self.buffers[0].shape != img.shape:
+            if self.buffers is not None:
+                logging.error("Recorder frame size changed")
+                raise ValueError
+            self._allocate(img)
+        if not self.free:
+            # N.B. shouldn't happen, there's a buffer for every frame in flight
+            self.dropped += 1
+            return False
+        indx = self.free.popleft()
+        np.copyto(self.buffers[indx], img)
+
+        ok = True
+        if self.dropPolicy == DROP_BLOCK:
+            self.queue.put(indx)
+            return ok
+        while True:
+            try:
+                self.queue.put_nowait(indx)
+                return ok
+            except Full:
+                ok = False
+                self.dropped += 1
+                if self.dropPolicy == DROP_NEWEST:
+                    self.free.append(indx)
+                    return ok
+                try:
+                    self.free.append(self.queue.get_nowait())
+                except Empty:
+                    pass
+
+    def backlog(self):
+        """
+        Return the number of frames waiting to be encoded.
+        """
+        return self.queue.qsize()
+
+    def getStats(self):
+        """
+        Return a dict of the recorder's stats.
+        """
+        return {'written': self.written, 'dropped': self.dropped,
+                'backlog': self.backlog(), 'segments': list(self.segments)}
+
+    def close(self):
+        """
+        Finish encoding the queued frames, and close the current segment.
+        """
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+
+    def _newSegment(self, size):
+        if self.writer is not None:
+            self.writer.release()
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        self.segmentPath = "{0}_{1}_{2:03d}{3}".format(self.pathPrefix, stamp,
+                                                       len(self.segments),
+                                                       self.extension)
+        self.writer = cv2.VideoWriter(self.segmentPath,
+                                      cv2.VideoWriter_fourcc(*self.fourcc),
+                                      self.frameRate, size)
+        if not self.writer.isOpened():
+            logging.error("Unable to open video writer: %s", self.segmentPath)
+            self.writer = None
+            return
+        self.segments.append(self.segmentPath)
+        self.segmentStart = time.time()
+        logging.info("Recording segment: %s", self.segmentPath)
+
+    def _segmentDone(self):
+        if self.segmentSecs and \
+           (time.time() - self.segmentStart) >= self.segmentSecs:
+            return True
+        if self.segmentBytes and \
+           os.path.getsize(self.segmentPath) >= self.segmentBytes:
+            return True
+        return False
+
+    def _run(self):
+        # encoder thread
+        resized = None
+        while True:
+            indx = self.queue.get()
+            if indx is None:
+                break
+            img = self.buffers[indx]
+            if self.size and (img.shape[1], img.shape[0]) != self.size:
+                if resized is None:
+                    resized = np.empty((self.size[1], self.size[0]) +
+                                       img.shape[2:], img.dtype)
+                cv2.resize(img, self.size, dst=resized,
+                           interpolation=cv2.INTER_AREA)
+                frame = resized
+            else:
+                frame = img
+            if self.writer is None or self._segmentDone():
+                self._newSegment((frame.shape[1], frame.shape[0]))
+            if self.writer is not None:
+                self.writer.write(frame)
+                self.written += 1
+            self.free.append(indx)
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+
+
+class FrameRing(object):
+    """
+    Ring buffer of the most recent raw frames, which is dumped to disk (from
+     a background thread) when triggered.
+    """
+    def __init__(self, pathPrefix, shape=None, dtype=np.uint8,
+                 secs=DEF_RING_SECS, frameRate=DEF_FRAME_RATE):
+        """
+        Instantiate FrameRing object, and allocate its buffer.
+
+        @param pathPrefix Path (and file name prefix) of the dump files
+        @param shape Shape of a frame -- (height, width) or (height, width, 3)
+         -- or None to allocate the buffer for the first frame that's written
+        @param dtype Element type of a frame
+        @param secs Number of seconds of frames to keep
+        @param frameRate Frame rate of the camera
+        """
+        frameRate = frameRate if frameRate else DEF_FRAME_RATE
+        numFrames = int(np.ceil(secs * frameRate))
+        if numFrames < 1:
+            logging.error("Invalid ring buffer duration: %f secs", secs)
+            raise ValueError
+        self.pathPrefix = pathPrefix
+        dirName = os.path.dirname(pathPrefix)
+        if dirName and not os.path.isdir(dirName):
+            os.makedirs(dirName)
+
+        # one contiguous block for all of the frames
+        self.frames = None
+        self.times = np.zeros(numFrames, np.float64)
+        self.numFrames = numFrames
+        self.head = 0           # slot the next frame goes into
+        self.count = 0          # number of valid slots
+        if shape is not None:
+            self._allocate(tuple(shape), dtype)
+
+        # dump in progress: the first slot, number of slots, and number of
+        #  slots copied so far
+        self.dumpStart = 0
+        self.dumpCount = 0
+        self.dumpDone = 0
+        self.thread = None
+
+        self.written = 0
+        self.dropped = 0
+        self.dumps = []
+
+    def _allocate(self, shape, dtype):
+        self.frames = np.empty((self.numFrames,) + shape, dtype)
+        self.head = 0
+        self.count = 0
+
+    def write(self, img, t):
+        """
+        Copy a frame into the ring.
+
+        @param img Frame
+        @param t Frame (exposure) time
+
+        Returns False if the frame was dropped (because its slot hasn't been
+         dumped yet, or its shape changed while a dump is in progress).
+        """
+        if self.frames is None:
+            self._allocate(img.shape, img.dtype)
+        elif (self.frames.shape[1:] != img.shape or
+              self.frames.dtype != img.dtype):
+            if self.dumping():
+                self.dropped += 1
+                return False
+            logging.warning("Frame shape changed from %s to %s, frame ring "
+                            "cleared", self.frames.shape[1:], img.shape)
+            self._allocate(img.shape, img.dtype)
+        if self.thread is not None:
+            pos = (self.head - self.dumpStart) % self.numFrames
+            if self.dumpDone <= pos < self.dumpCount:
+                self.dropped += 1
+                return False
+        np.copyto(self.frames[self.head], img)
+        self.times[self.head] = t
+        self.head = (self.head + 1) % self.numFrames
+        self.count = min(self.count + 1, self.numFrames)
+        self.written += 1
+        return True
+
+    def dumping(self):
+        """
+        Return True if a dump is in progress.
+        """
+        return self.thread is not None and self.thread.is_alive()
+
+    def trigger(self, reason):
+        """
+        Start dumping the frames in the ring to a file.
+
+        @param reason Why the ring was triggered (e.g., 'alarm' or 'key'),
+         which is recorded with the dump
+
+        Returns the path of the dump file, or None if there's nothing to dump
+         or a dump is already in progress.
+        """
+        if self.dumping():
+            logging.warning("Frame ring dump already in progress, %s trigger "
+                            "ignored", reason)
+            return None
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if not self.count:
+            return None
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        path = "{0}_{1}_{2:03d}_{3}.npy".format(self.pathPrefix, stamp,
+                                                len(self.dumps), reason)
+        self.dumpStart = (self.head - self.count) % self.numFrames
+        self.dumpCount = self.count
+        self.dumpDone = 0
+        self.thread = threading.Thread(target=self._dump, args=(path, reason))
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.dumps.append(path)
+        logging.info("Dumping %d frames (%s): %s", self.dumpCount, reason,
+                     path)
+        return path
+
+    def _dump(self, path, reason):
+        # dump thread
+        start = time.time()
+        out = np.lib.format.open_memmap(
+            path, mode='w+', dtype=self.frames.dtype,
+            shape=(self.dumpCount,) + self.frames.shape[1:])
+        slots = (self.dumpStart + np.arange(self.dumpCount)) % self.numFrames
+        times = self.times[slots]
+        for i, slot in enumerate(slots):
+            out[i] = self.frames[slot]
+            # N.B. frees the slot for the frame loop
+            self.dumpDone = i + 1
+        out.flush()
+        del out
+        meta = {'reason': reason, 'triggerTime': float(times[-1]),
+                'times': times.tolist()}
+        with open(os.path.splitext(path)[0] + ".json", 'w') as f:
+            json.dump(meta, f, indent=4, sort_keys=True)
+        logging.info("Dumped %d frames in %.3f secs: %s", len(slots),
+                     time.time() - start, path)
+
+    def getStats(self):
+        """
+        Return a dict of the ring's stats.
+        """
+        nbytes = self.frames.nbytes if self.frames is not None else 0
+        return {'frames': self.numFrames, 'bytes': nbytes,
+                'written': self.written, 'dropped': self.dropped,
+                'dumps': list(self.dumps)}
+
+    def close(self):
+        """
+        Wait for any dump in progress to finish.
+        """
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def loadDump(path):
+    """
+    Load a frame ring dump (memory-mapped).
+
+    Returns an (N, height, width[, 3]) array of the frames, oldest first, and
+     a dict with the trigger reason and the frame times.
+    """
+    frames = np.load(path, mmap_mode='r')
+    with open(os.path.splitext(path)[0] + ".json", 'r') as f:
+        meta = json.load(f)
+    return frames, meta
+
+
+#
+# TEST
+#
+if __name__ == '__main__':
+    import tempfile
+
+    prefix = os.path.join(tempfile.mkdtemp(), "test")
+    rec = Recorder(prefix, size=(320, 240), segmentSecs=1.0)
+    img = np.zeros((480, 640, 3), np.uint8)
+    start = time.time()
+    for i in range(90):
+        img[:] = i
+        rec.write(img)
+        time.sleep(1.0 / 30)
+    loopTime = time.time() - start
+    rec.close()
+    print("Loop time: {0:.2f} secs".format(loopTime))
+    print(json.dumps(rec.getStats(), indent=4))
+
+    # keep the last second, trigger, and keep writing while it's dumped
+    ring = FrameRing(prefix + "_ring", secs=1.0, frameRate=30.0)
+    writeTime = 0.0
+    for i in range(120):
+        img[:] = i
+        start = time.time()
+        ring.write(img, i / 30.0)
+        writeTime += time.time() - start
+        if i == 89:
+            path = ring.trigger("test")
+        time.sleep(1.0 / 30)
+    ring.close()
+    frames, meta = loadDump(path)
+    print("Ring write: {0:.3f} msec/frame".format((writeTime / 120) * 1000.0))
+    print("Dumped frames {0}..{1} ({2} frames, in order: {3})".format(
+        frames[0, 0, 0, 0], frames[-1, 0, 0, 0], len(frames),
+        list(frames[:, 0, 0, 0]) == list(range(60, 90))))
+    print(json.dumps(ring.getStats(), indent=4))
+
+    # a change of frame shape (e.g., a camera that won't do grayscale)
+    ring.write(np.zeros((480, 640), np.uint8), 4.0)
+    print("Reallocated for {0}: {1} frame".format(ring.frames.shape[1:],
+                                                  ring.count))
@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+
+"""X-Carve Microscope Tool Workpiece Fiducial Registration"""
+
+import argparse
+import copy
+import logging
+import os
+import sys
+
+import cv2
+import numpy as np
+
+import capture
+import cnc_video
+import gcode
+import util
+import video
+from util import monotonic
+
+
+'''
+DESIGN NOTES:
+  * A workpiece is registered by visiting two or more fiducials (e.g., drill
+    holes or corners) that are marked at known positions in the job's
+    coordinates. The camera is moved over where each one should be, the
+    detected feature nearest to the image center is taken as the fiducial,
+    and its position comes from the camera calibration (see
+    video.Measurement).
+  * Everything is done in work coordinates -- the camera is moved with
+    work-coordinate (G90) moves, GRBL's (machine) positions have the work
+    coordinate offset taken off, and the fitted transform maps the job's
+    coordinates onto the work coordinates, which is the frame the
+    transformed G-code runs in.
+  * The first two fiducials are taken wherever they are in the view (the
+    rotation isn't known until there are two), and after that the transform
+    fitted so far predicts where the rest are, so only a small search radius
+    is needed even when the workpiece is rotated.
+  * A fiducial found far from the image center is measured again with the
+    camera centered on it, to keep lens distortion out of the measurement.
+  * The result is a rigid (rotation and translation) transform, which is
+    saved as JSON and applied to the job as it's streamed -- see
+    gcode.rigidTransform().
+'''
+
+DEF_DETECTORS = ["circles"]
+DEF_SETTLE_FRAMES = 5       # frames discarded after a move (exposure/latency)
+DEF_AVERAGE_FRAMES = 5      # frames a fiducial's position is averaged over
+DEF_SEARCH_RADIUS = 3.0     # max mm of a fiducial from where it's expected
+DEF_CENTER_TOLERANCE = 0.5  # max mm of a fiducial from the image center
+DEF_MAX_RESIDUAL = 0.1      # max mm of a fiducial from the fitted transform
+
+
+class FiducialRegistration(object):
+    """
+    Finds a workpiece's fiducials with the camera, and fits the transform
+     from the job's coordinates to the (current) work coordinates.
+    """
+    def __init__(self, mach, camera, measurement, detectors=DEF_DETECTORS,
+                 params=None, pool=None, safeZ=None,
+                 settleFrames=DEF_SETTLE_FRAMES,
+                 averageFrames=DEF_AVERAGE_FRAMES,
+                 searchRadius=DEF_SEARCH_RADIUS,
+                 centerTolerance=DEF_CENTER_TOLERANCE):
+        """
+        Instantiate FiducialRegistration object.
+
+        @param mach Machine to move the camera with (e.g., an XCarve)
+        @param camera Camera to read frames from (e.g., a capture.Camera)
+        @param measurement Calibrated video.Measurement for the camera's
+         frames (must have an 'mmPerPixel' scale)
+        @param detectors Names of the feature detectors that find fiducials
+        @param params Dict of detector parameters (see DEF_DETECTOR_PARAMS)
+        @param pool FramePool to read the frames into
+        @param safeZ Z position (in mm) to move the camera at, or None to
+         stay at the current height
+        @param settleFrames Number of frames to discard after each move
+        @param averageFrames Number of frames to average a fiducial over
+        @param searchRadius Max distance (in mm) of a fiducial from where
+         it's expected (once the rotation's known)
+        @param centerTolerance Max distance (in mm) of a fiducial from the
+         image center before it's measured again, centered
+        """
+        if not measurement.mmPerPixel:
+            logging.error("Registration requires a calibrated camera")
+            raise ValueError
+        unknown = [name for name in detectors if name not in video.DETECTORS]
+        if not detectors or unknown:
+            logging.error("Invalid fiducial detectors: %s", detectors)
+            raise ValueError
+        self.mach = mach
+        self.camera = camera
+        self.measure = measurement
+        self.detectors = list(detectors)
+        self.params = dict(video.DEF_DETECTOR_PARAMS)
+        if params:
+            self.params.update(params)
+        self.pool = pool or video.FramePool(measurement.width,
+                                            measurement.height)
+        self.context = video.FrameContext(self.pool)
+        self.safeZ = safeZ
+        self.settleFrames = settleFrames
+        self.averageFrames = max(averageFrames, 1)
+        self.searchRadius = searchRadius
+        self.centerTolerance = centerTolerance
+        self.frameId = 0
+        self.workOffset = None
+
+    def _moveOver(self, x, y):
+        # put the image center over the given (work) position, and return
+        #  the work position the machine got to
+        offset = self.measure.cameraOffset
+        self.mach.moveTo(x - offset[0], y - offset[1], self.safeZ)
+        pos = self.mach.waitForIdle()
+        if pos is None:
+            logging.error("Camera move didn't finish")
+            raise RuntimeError
+        return tuple(p - w for p, w in zip(pos, self.workOffset))
+
+    def _find(self, expected, workPos, radius):
+        # return the work position of the feature nearest to the expected
+        #  position in one frame, or None
+        ret, img = self.camera.read(self.pool)
+        if not ret:
+            logging.error("Unable to read a frame")
+            raise RuntimeError
+        self.frameId += 1
+        self.context.reset(img, self.frameId)
+        features = video.runDetectors(self.context.gray(), self.detectors,
+                                      self.params, self.context.derived)
+        scale = self.measure.mmPerPixel
+        offset = self.measure.cameraOffset
+        # N.B. image Y is down, machine Y is up
+        x = self.measure.originX + ((expected[0] - workPos[0] -
+                                     offset[0]) / scale)
+        y = self.measure.originY - ((expected[1] - workPos[1] -
+                                     offset[1]) / scale)
+        nearest = video.nearestFeature(features, x, y)
+        if nearest is None:
+            return None
+        self.measure.setValues(nearest[2][0], nearest[2][1], workPos)
+        found = np.array(self.measure.getWorkspace())
+        if radius is not None and np.hypot(*(found - expected)) > radius:
+            return None
+        return found
+
+    def locate(self, expected, radius=None):
+        """
+        Find a fiducial.
+
+        @param expected (x, y) work position (in mm) where the fiducial is
+         expected to be
+        @param radius Max distance (in mm) of the fiducial from the expected
+         position, or None to take the nearest feature in the view
+
+        Returns the fiducial's measured (x, y) work position, or None if it
+         wasn't found in most of the frames.
+        N.B. register() sets the work offset that this uses.
+        """
+        target = np.array(expected, np.float64)
+        found = None
+        for attempt in range(2):
+            workPos = self._moveOver(target[0], target[1])
+            for i in range(self.settleFrames):
+                self.camera.read(self.pool)
+            hits = [self._find(target, workPos, radius)
+                    for i in range(self.averageFrames)]
+            hits = [h for h in hits if h is not None]
+            if len(hits) * 2 <= self.averageFrames:
+                logging.warning("Fiducial not found near X%.3f Y%.3f (%d of "
+                                "%d frames)", target[0], target[1], len(hits),
+                                self.averageFrames)
+                return found
+            found = np.mean(hits, axis=0)
+            center = np.array(workPos[:2]) + self.measure.cameraOffset
+            if np.hypot(*(found - center)) <= self.centerTolerance:
+                break
+            # measure it again from directly above
+            target = found
+            radius = self.searchRadius
+        return found
+
+    def register(self, fiducials, initial=None):
+        """
+        Find the fiducials, and fit the job-to-work-coordinates transform.
+
+        @param fiducials List of (x, y) fiducial positions (in mm) in the
+         job's coordinates
+        @param initial (2, 3) matrix that (roughly) maps the job's
+         coordinates to the work coordinates, or None for the identity
+
+        Returns the (2, 3) transform matrix, the residual (in mm) of each
+         fiducial, and an (N, 2) array of their measured work positions.
+        """
+        nominal = np.array(fiducials, np.float64).reshape(-1, 2)
+        if len(nominal) < 2:
+            logging.error("Need two or more fiducials: %d", len(nominal))
+            raise ValueError
+        # GRBL reports machine positions, but moves in work coordinates
+        wco = self.mach.getWorkOffset()
+        if wco is None:
+            logging.error("Unable to get the work coordinate offset")
+            raise RuntimeError
+        self.workOffset = tuple(wco)
+        matrix = np.eye(2, 3) if initial is None else \
+            np.array(initial, np.float64)
+        measured = np.full(nominal.shape, np.nan)
+        start = monotonic()
+        for i, point in enumerate(nominal):
+            expected = gcode.applyRigid(matrix, point[np.newaxis])[0]
+            found = self.locate(expected,
+                                self.searchRadius if i >= 2 else None)
+            if found is None:
+                logging.error("Fiducial %d (X%.3f Y%.3f) not found", i,
+                              point[0], point[1])
+                raise RuntimeError
+            measured[i] = found
+            if i >= 1:
+                matrix, residuals = gcode.fitRigid(nominal[:i + 1],
+                                                   measured[:i + 1])
+            else:
+                # until there's a rotation, just translate
+                matrix = matrix.copy()
+                matrix[:, 2] += found - expected
+        logging.info("Registered %d fiducials in %.1f secs (max residual "
+                     "%.4f mm)", len(nominal), monotonic() - start,
+                     residuals.max())
+        return matrix, residuals, measured
+
+
+#
+# MAIN
+#
+class SimulatedRig(object):
+    """
+    Machine and camera over a (rotated and shifted) workpiece with drill-hole
+     fiducials, for testing registration offline.
+    """
+    def __init__(self, truth, fiducials, measurement, radius=1.0,
+                 noise=4.0, workOffset=(-120.0, -35.0, -40.0)):
+        """
+        Instantiate SimulatedRig object.
+
+        @param truth (2, 3) matrix of the workpiece's true pose (in work
+         coordinates)
+        @param fiducials List of (x, y) fiducial positions in job coordinates
+        @param measurement Calibrated video.Measurement of the camera
+        @param radius Fiducial (hole) radius in mm
+        @param noise Standard deviation of the image noise (gray levels)
+        @param workOffset Work coordinate offset of the simulated machine
+        """
+        self.holes = gcode.applyRigid(truth, fiducials)
+        self.workOffset = tuple(workOffset)
+        self.measure = measurement
+        self.radius = radius
+        self.noise = noise
+        self.pos = (0.0, 0.0, 0.0)     # work position
+        self.rng = np.random.RandomState(1)
+        self.moves = 0
+
+    def moveTo(self, x=None, y=None, z=None, feed=None):
+        self.pos = tuple(p if v is None else v
+                         for p, v in zip(self.pos, (x, y, z)))
+        self.moves += 1
+
+    def waitForIdle(self):
+        # N.B. GRBL reports machine positions
+        return tuple(p + w for p, w in zip(self.pos, self.workOffset))
+
+    def getWorkOffset(self):
+        return self.workOffset
+
+    def read(self, pool):
+        m = self.measure
+        img = pool.get('simFrame', (m.height, m.width))
+        img.fill(200)
+        center = np.array(self.pos[:2]) + m.cameraOffset
+        shift = 4   # fractional bits of the drawing coordinates
+        for hole in self.holes:
+            x = m.originX + ((hole[0] - center[0]) / m.mmPerPixel)
+            y = m.originY - ((hole[1] - center[1]) / m.mmPerPixel)
+            if -m.width < x < (2 * m.width) and -m.height < y < (2 * m.height):
+                cv2.circle(img, (int(round(x * (1 << shift))),
+                                 int(round(y * (1 << shift)))),
+                           int(round((self.radius / m.mmPerPixel) *
+                                     (1 << shift))),
+                           40, -1, cv2.LINE_AA, shift)
+        noise = self.rng.normal(0.0, self.noise, img.shape)
+        np.copyto(img, np.clip(img + noise, 0, 255).astype(np.uint8))
+        return True, img
+
+
+def parsePoints(values):
+    return [tuple(float(v) for v in value.split(",")) for value in values]
+
+
+def main():
+    usage = sys.argv[0] + "[-v] [-C <confFile>] [-o <outFile>] "
+    usage += "[-d <detectors>] [-z <safeZ>] [-r <radius>] "
+    usage += "(-f <x>,<y> -f <x>,<y> ... | -S)"
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        '-f', '--fiducial', action='append', default=[],
+        help="fiducial position in the job's coordinates -- '<x>,<y>' (mm)")
+    ap.add_argument(
+        '-i', '--initial', action='store', type=str,
+        help="rough position (in mm) of the job's origin on the machine -- "
+             "'<x>,<y>' (default: 0,0)")
+    ap.add_argument(
+        '-S', '--synthetic', action='store_true', default=False,
+        help="register a simulated workpiece (no machine or camera)")
+    ap.add_argument(
+        '-C', '--configFile', action='store',
+        help="configuration file (camera, CNC, calibration, and detection)")
+    ap.add_argument(
+        '-o', '--outFile', action='store', type=str,
+        help="file to save the transform to (JSON)")
+    ap.add_argument(
+        '-d', '--detectors', action='store', type=str,
+        default=",".join(DEF_DETECTORS),
+        help="comma-separated list of detectors that find the fiducials")
+    ap.add_argument(
+        '-z', '--safeZ', action='store', type=float,
+        help="Z position (mm) to move the camera at")
+    ap.add_argument(
+        '-r', '--radius', action='store', type=float,
+        default=DEF_SEARCH_RADIUS,
+        help="max distance (mm) of a fiducial from where it's expected")
+    ap.add_argument(
+        '-v', '--verbose', action='count', default=0,
+        help="increase verbosity")
+    options = ap.parse_args()
+
+    config = copy.deepcopy(cnc_video.config)
+    if options.configFile:
+        if not os.path.isfile(options.configFile):
+            sys.stderr.write("Error: config file not found\n")
+            sys.exit(1)
+        import yaml
+        with open(options.configFile, 'r') as ymlFile:
+            util.dictMerge(config, yaml.load(ymlFile) or {})
+    detection = config.get('detection') or {}
+    initial = np.eye(2, 3)
+    if options.initial:
+        initial[:, 2] = parsePoints([options.initial])[0]
+
+    if options.synthetic:
+        width, height = 800, 600
+        cal = {'mmPerPixel': 0.02, 'cameraOffset': (42.0, -3.5)}
+        fiducials = parsePoints(options.fiducial) or \
+            [(5.0, 5.0), (195.0, 5.0), (195.0, 145.0), (5.0, 145.0)]
+        truth = np.eye(2, 3)
+        theta = np.radians(1.2)
+        truth[:, :2] = [[np.cos(theta), -np.sin(theta)],
+                        [np.sin(theta), np.cos(theta)]]
+        truth[:, 2] = initial[:, 2] + (2.1, -1.4)
+        measure = video.Measurement(width, height, cal)
+        rig = SimulatedRig(truth, fiducials, measure)
+        mach = camera = rig
+    else:
+        if not options.fiducial:
+            sys.stderr.write("Error: must give fiducials (or use -S)\n")
+            sys.exit(1)
+        fiducials = parsePoints(options.fiducial)
+        truth = None
+        cap = config['capture']
+        camera = capture.Camera(config['device'], [config['size']],
+                                cap.get('fourccs'), cap.get('rates'),
+                                probeFrames=cap.get('probeFrames',
+                                                    capture.DEF_PROBE_FRAMES))
+        measure = video.Measurement(camera.width, camera.height,
+                                    config['calibration'])
+        from xcarve import XCarve
+        mach = XCarve(config)
+
+    reg = FiducialRegistration(mach, camera, measure,
+                               options.detectors.split(","),
+                               detection.get('params'),
+                               safeZ=options.safeZ,
+                               searchRadius=options.radius)
+    start = monotonic()
+    try:
+        matrix, residuals, measured = reg.register(fiducials, initial)
+    finally:
+        if not options.synthetic:
+            camera.release()
+    elapsed = monotonic() - start
+
+    if options.outFile:
+        gcode.saveRigid(options.outFile, matrix, residuals,
+                        workOffset=list(reg.workOffset),
+                        fiducials=[list(f) for f in fiducials],
+                        measured=measured.tolist())
+    sys.stdout.write("    Fiducials:       {0}\n".format(len(fiducials)))
+    sys.stdout.write("    Rotation:        {0:.4f} deg\n".
+                     format(gcode.rigidAngle(matrix)))
+    sys.stdout.write("    Translation:     X{0:.4f} Y{1:.4f} mm\n".
+                     format(matrix[0, 2], matrix[1, 2]))
+    sys.stdout.write("    Max Residual:    {0:.4f} mm\n".
+                     format(residuals.max()))
+    if residuals.max() > DEF_MAX_RESIDUAL:
+        sys.stdout.write("    Warning: fiducials don't fit a rigid transform "
+                         "-- check for misdetections\n")
+    if truth is not None:
+        error = np.hypot(*(gcode.applyRigid(matrix, fiducials) -
+                           gcode.applyRigid(truth, fiducials)).T)
+        sys.stdout.write("    True Error:      {0:.4f} mm (max)\n".
+                         format(error.max()))
+        sys.stdout.write("    Moves:           {0}\n".format(rig.moves))
+    if options.verbose:
+        for f, m, r in zip(fiducials, measured, residuals):
+            sys.stdout.write("        X{0:8.3f} Y{1:8.3f} -> X{2:8.3f} "
+                             "Y{3:8.3f}  ({4:.4f} mm)\n".format(
+                                 f[0], f[1], m[0], m[1], r))
+        sys.stdout.write("    Elapsed:         {0:.3f} secs\n".format(elapsed))
+
+
+if __name__ == '__main__':
+    main()
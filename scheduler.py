@@ -0,0 +1,230 @@
+"""X-Carve Microscope Tool Frame-Deadline Scheduler -- Library"""
+
+import collections
+import logging
+
+import cv2
+
+
+'''
+DESIGN NOTES:
+  * Each stage of the frame loop gets a time budget (a fraction of the camera's
+    frame period). The display must keep up with the camera, so when an
+    analysis stage overruns its budget it steps down a ladder of quality
+    levels -- process a smaller central ROI, on a downscaled copy, and/or only
+    on every Nth frame -- and it steps back up once there's headroom again.
+  * Stages that can't be degraded (e.g., the overlays) are just measured, and
+    any overrun of theirs is taken out of the analysis stages' budgets.
+  * On frames where a stage doesn't run its last result is carried over.
+  * The focus metric (the Laplacian's variance) depends on how much of the
+    frame it's taken over and at what scale, so its values are only
+    comparable at the same ROI and scale -- the focus ladder just runs it
+    less often.
+'''
+
+# Quality level of an analysis stage
+#  scale: downscale factor applied to the image before processing
+#  interval: the stage runs on every interval'th frame
+#  roi: fraction of the (central) width/height of the frame that's processed
+Quality = collections.namedtuple('Quality', ['scale', 'interval', 'roi'])
+
+# quality ladders, from best to worst
+FOCUS_LADDER = [Quality(1.0, 1, 1.0), Quality(1.0, 2, 1.0),
+                Quality(1.0, 4, 1.0), Quality(1.0, 8, 1.0)]
+DETECT_LADDER = [Quality(1.0, 1, 1.0), Quality(0.5, 1, 1.0),
+                 Quality(0.5, 2, 1.0), Quality(0.25, 4, 1.0),
+                 Quality(0.25, 8, 1.0)]
+FIXED_LADDER = [Quality(1.0, 1, 1.0)]
+
+# stage budgets as fractions of the frame period
+DEF_BUDGETS = {
+    'focus': 0.15,
+    'detect': 0.35,
+    'overlay': 0.15
+}
+DEF_LADDERS = {
+    'focus': FOCUS_LADDER,
+    'detect': DETECT_LADDER,
+    'overlay': FIXED_LADDER
+}
+DEF_FRAME_RATE = 30.0
+
+EWMA_ALPHA = 0.2            # weight of the newest sample in the cost average
+UPGRADE_HEADROOM = 0.5      # cost (fraction of budget) that allows upgrading
+UPGRADE_RUNS = 30           # runs with headroom needed before upgrading
+SETTLE_RUNS = 5             # runs after a level change before adapting again
+
+
+class Stage(object):
+    """
+    Budget, cost, quality level, and last result of a scheduled stage.
+    """
+    def __init__(self, name, budget, ladder):
+        self.name = name
+        self.budget = budget    # time budget in secs
+        self.ladder = ladder
+        self.level = 0
+        self.cost = None        # (EWMA) secs per run at the current level
+        self.runs = 0           # runs at the current level
+        self.goodRuns = 0       # consecutive runs with headroom
+        self.result = None
+
+    def quality(self):
+        return self.ladder[self.level]
+
+    def adaptive(self):
+        return len(self.ladder) > 1
+
+    def _setLevel(self, level):
+        logging.debug("Stage '%s' quality level %d -> %d (%.2f ms)", self.name,
+                      self.level, level, (self.cost or 0.0) * 1000.0)
+        self.level = level
+        self.cost = None
+        self.runs = 0
+        self.goodRuns = 0
+
+    def update(self, elapsed, budget):
+        if self.cost is None:
+            self.cost = elapsed
+        else:
+            self.cost += EWMA_ALPHA * (elapsed - self.cost)
+        self.runs += 1
+        if not self.adaptive() or self.runs < SETTLE_RUNS:
+            return
+        if self.cost > budget:
+            if self.level < (len(self.ladder) - 1):
+                self._setLevel(self.level + 1)
+        elif self.cost < (budget * UPGRADE_HEADROOM):
+            self.goodRuns += 1
+            if self.goodRuns >= UPGRADE_RUNS and self.level > 0:
+                self._setLevel(self.level - 1)
+        else:
+            self.goodRuns = 0
+
+
+class FrameScheduler(object):
+    """
+    Decides which analysis stages run on each frame, and at what quality, so
+     the frame loop keeps up with the camera.
+    """
+    def __init__(self, frameRate=DEF_FRAME_RATE, budgets=None, ladders=None):
+        """
+        Instantiate FrameScheduler object.
+
+        @param frameRate Camera frame rate (frames/sec)
+        @param budgets Dict of stage name to budget (fraction of frame period)
+        @param ladders Dict of stage name to list of Quality levels
+        """
+        self.period = 1.0 / (frameRate if frameRate else DEF_FRAME_RATE)
+        budgets = dict(DEF_BUDGETS, **(budgets or {}))
+        ladders = dict(DEF_LADDERS, **(ladders or {}))
+        self.stages = {}
+        for name, fraction in budgets.items():
+            if fraction <= 0.0 or fraction > 1.0:
+                logging.error("Invalid budget for stage '%s': %f", name,
+                              fraction)
+                raise ValueError
+            self.stages[name] = Stage(name, fraction * self.period,
+                                      ladders.get(name, FIXED_LADDER))
+
+    def _budget(self, stage):
+        # an adaptive stage's budget, less its share of the fixed stages'
+        #  overruns
+        if not stage.adaptive():
+            return stage.budget
+        overrun = sum(max((s.cost or 0.0) - s.budget, 0.0)
+                      for s in self.stages.values() if not s.adaptive())
+        if overrun <= 0.0:
+            return stage.budget
+        total = sum(s.budget for s in self.stages.values() if s.adaptive())
+        return max(stage.budget - (overrun * (stage.budget / total)), 0.0)
+
+    def plan(self, name, frameId):
+        """
+        Return the Quality to run the named stage at on this frame, or None if
+         it shouldn't run (and its last result should be used).
+        """
+        quality = self.stages[name].quality()
+        if (frameId % quality.interval) != 0:
+            return None
+        return quality
+
+    def done(self, name, elapsed, result=None):
+        """
+        Record the time taken by a run of the named stage, and its result.
+
+        @param name Stage name
+        @param elapsed Secs that the stage took
+        @param result Result to carry over to frames where the stage is skipped
+        """
+        stage = self.stages[name]
+        stage.update(elapsed, self._budget(stage))
+        if result is not None:
+            stage.result = result
+
+    def result(self, name):
+        """
+        Return the last result of the named stage.
+        """
+        return self.stages[name].result
+
+    def levels(self):
+        """
+        Return a dict of each stage's current quality level.
+        """
+        return {name: s.level for name, s in self.stages.items()}
+
+
+def cropRoi(img, roi):
+    """
+    Return the central roi-fraction of an image, and the (x, y) offset of the
+     cropped region.
+    """
+    if roi >= 1.0:
+        return img, (0, 0)
+    h, w = img.shape[:2]
+    cw, ch = max(int(w * roi), 1), max(int(h * roi), 1)
+    x0, y0 = (w - cw) // 2, (h - ch) // 2
+    return img[y0:(y0 + ch), x0:(x0 + cw)], (x0, y0)
+
+
+def prepare(img, quality, pool, name):
+    """
+    Apply a Quality's ROI and scale to an image.
+
+    @param img Image to prepare
+    @param quality Quality to apply
+    @param pool FramePool to get the downscaled image's buffer from
+    @param name Name of the pool buffer to use
+
+    Returns the prepared image and the (x, y) offset of its ROI.
+    """
+    img, offset = cropRoi(img, quality.roi)
+    if quality.scale >= 1.0:
+        return img, offset
+    h, w = img.shape[:2]
+    size = (max(int(w * quality.scale), 1), max(int(h * quality.scale), 1))
+    dst = pool.get(name, (size[1], size[0]) + img.shape[2:], img.dtype)
+    cv2.resize(img, size, dst=dst, interpolation=cv2.INTER_AREA)
+    return dst, offset
+
+
+#
+# TEST
+#
+if __name__ == '__main__':
+    import time
+
+    sched = FrameScheduler(30.0)
+    cost = 0.030    # secs, at full resolution
+    for frameId in range(300):
+        q = sched.plan('detect', frameId)
+        if q is not None:
+            # cost goes down with the area processed
+            elapsed = cost * (q.scale ** 2) * (q.roi ** 2)
+            sched.done('detect', elapsed, frameId)
+        if frameId == 150:
+            cost = 0.002    # the scene got simpler
+        if (frameId % 25) == 0:
+            print("Frame {0}: levels={1}, last result from frame {2}".
+                  format(frameId, sched.levels(), sched.result('detect')))
@@ -0,0 +1,528 @@
+#!/usr/bin/env python
+
+"""X-Carve Microscope Tool MJPEG/WebSocket Streaming Server -- Library"""
+
+import argparse
+import base64
+import hashlib
+import json
+import logging
+import socket
+import struct
+import sys
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import cv2
+import numpy as np
+
+from util import monotonic
+
+
+'''
+DESIGN NOTES:
+  * The frame loop just offers each annotated frame to the server: the frame
+    is copied into a buffer that's owned by an encoder thread, and if the
+    encoder is still busy with the previous frame (or nobody is watching)
+    the frame is skipped, so the local display never waits on the server.
+  * Each frame is JPEG-encoded exactly once, and the latest JPEG is shared by
+    all of the clients. Every client has its own thread that sends the newest
+    JPEG whenever it's ready for one, so a slow client just skips frames --
+    nothing is ever queued for it.
+  * Machine status and measurements are pushed to WebSocket clients the same
+    way -- each client is sent the latest JSON message when there is a newer
+    one than it last got.
+  * The WebSocket handshake must be an HTTP/1.1 response (browsers reject an
+    HTTP/1.0 one), but BaseHTTPRequestHandler answers with HTTP/1.0, which
+    isn't wanted for the other (connection: close) responses, so its status
+    line is written by hand.
+  * Each WebSocket client also has a thread that reads its frames, so pings
+    are answered and a close is echoed (and ends the connection).
+'''
+
+WS_TEXT = 0x1               # WebSocket opcodes
+WS_CLOSE = 0x8
+WS_PING = 0x9
+WS_PONG = 0xa
+
+DEF_PORT = 8080
+DEF_HOST = "127.0.0.1"
+DEF_QUALITY = 80            # JPEG quality (0-100)
+DEF_WAIT = 1.0              # max secs a client waits for a new frame/message
+
+BOUNDARY = "mjpegframe"
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+INDEX_PAGE = """<html>
+<head><title>X-Carve Microscope</title></head>
+<body>
+<img src="/stream.mjpg"/>
+<pre id="status"></pre>
+<script>
+var ws = new WebSocket("ws://" + location.host + "/status");
+ws.onmessage = function(e) {
+    document.getElementById("status").textContent =
+        JSON.stringify(JSON.parse(e.data), null, 2);
+};
+</script>
+</body>
+</html>
+"""
+
+
+class Latest(object):
+    """
+    The latest version of a value that's shared between threads, with a
+     sequence number so readers can wait for a newer one.
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.value = None
+        self.seq = 0
+
+    def put(self, value):
+        with self.cond:
+            self.value = value
+            self.seq += 1
+            self.cond.notify_all()
+
+    def wait(self, lastSeq, timeout=DEF_WAIT):
+        """
+        Wait for a value newer than lastSeq.
+
+        Returns the (seq, value) of the latest value, or (lastSeq, None) if
+         there was no newer value before the timeout.
+        """
+        with self.cond:
+            if self.seq <= lastSeq:
+                self.cond.wait(timeout)
+            if self.seq <= lastSeq:
+                return lastSeq, None
+            return self.seq, self.value
+
+
+class StreamServer(object):
+    """
+    HTTP server that streams frames as MJPEG and pushes status messages over
+     WebSocket.
+
+    URLs:
+      /              -- viewer page
+      /stream.mjpg   -- MJPEG stream
+      /snapshot.jpg  -- latest frame
+      /status        -- WebSocket of JSON status messages
+    """
+    def __init__(self, port=DEF_PORT, host=DEF_HOST, quality=DEF_QUALITY):
+        """
+        Instantiate StreamServer object, and start serving.
+
+        @param port TCP port to listen on
+        @param host Address to listen on ("" for all interfaces)
+        @param quality JPEG quality (0-100)
+        """
+        self.quality = quality
+        self.jpeg = Latest()
+        self.status = Latest()
+        self.clients = 0
+        self.offered = 0        # frames offered while there were clients
+        self.encoded = 0
+        self.dropped = 0        # frames skipped because the encoder was busy
+        self.lock = threading.Lock()
+
+        self.buffer = None
+        self.pending = threading.Event()
+        self.running = True
+        self.encoder = threading.Thread(target=self._encode)
+        self.encoder.setDaemon(True)
+        self.encoder.start()
+
+        server = self
+
+        class Handler(StreamHandler):
+            streamer = server
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        logging.info("Streaming on http://%s:%d/", host or "*", self.port)
+
+    def publish(self, img):
+        """
+        Offer a frame to the server (never blocks on encoding or clients).
+        """
+        if not self.clients:
+            return
+        self.offered += 1
+        if self.pending.is_set():
+            self.dropped += 1
+            return
+        if self.buffer is None or self.buffer.shape != img.shape:
+            self.buffer = np.empty_like(img)
+        np.copyto(self.buffer, img)
+        self.pending.set()
+
+    def publishStatus(self, status):
+        """
+        Push a status message (a JSON-serializable dict) to the WebSocket
+         clients.
+        """
+        if self.clients:
+            self.status.put(json.dumps(status, sort_keys=True))
+
+    def _encode(self):
+        params = [cv2.IMWRITE_JPEG_QUALITY, self.quality]
+        while self.running:
+            if not self.pending.wait(DEF_WAIT):
+                continue
+            ret, buf = cv2.imencode(".jpg", self.buffer, params)
+            self.pending.clear()
+            if not ret:
+                logging.warning("JPEG encoding failed")
+                continue
+            self.encoded += 1
+            self.jpeg.put(buf.tostring())
+
+    def _addClient(self, delta):
+        with self.lock:
+            self.clients += delta
+
+    def getStats(self):
+        return {'clients': self.clients, 'offered': self.offered,
+                'encoded': self.encoded, 'dropped': self.dropped}
+
+    def close(self):
+        self.running = False
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.encoder.join()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class StreamHandler(BaseHTTPRequestHandler):
+    streamer = None     # set by StreamServer
+
+    def log_message(self, fmt, *args):
+        logging.debug("%s - %s", self.client_address[0], fmt % args)
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/":
+            self._sendPage()
+        elif path == "/stream.mjpg":
+            self._sendStream()
+        elif path == "/snapshot.jpg":
+            self._sendSnapshot()
+        elif path == "/status" and \
+                self.headers.get("Upgrade", "").lower() == "websocket":
+            self._sendStatus()
+        else:
+            self.send_error(404)
+
+    def _sendPage(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(INDEX_PAGE)))
+        self.end_headers()
+        self.wfile.write(INDEX_PAGE)
+
+    def _sendSnapshot(self):
+        self.streamer._addClient(1)
+        try:
+            seq, jpeg = self.streamer.jpeg.wait(0, DEF_WAIT * 5)
+        finally:
+            self.streamer._addClient(-1)
+        if jpeg is None:
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(len(jpeg)))
+        self.end_headers()
+        self.wfile.write(jpeg)
+
+    def _sendStream(self):
+        self.send_response(200)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Content-Type",
+                         "multipart/x-mixed-replace; boundary=" + BOUNDARY)
+        self.end_headers()
+        self.streamer._addClient(1)
+        seq = 0
+        try:
+            while self.streamer.running:
+                # always send the newest frame -- any that were encoded while
+                #  this client was busy are skipped
+                seq, jpeg = self.streamer.jpeg.wait(seq)
+                if jpeg is None:
+                    continue
+                self.wfile.write("--{0}\r\nContent-Type: image/jpeg\r\n"
+                                 "Content-Length: {1}\r\n\r\n".
+                                 format(BOUNDARY, len(jpeg)))
+                self.wfile.write(jpeg)
+                self.wfile.write("\r\n")
+                self.wfile.flush()
+        except socket.error:
+            pass
+        finally:
+            self.streamer._addClient(-1)
+
+    def _sendStatus(self):
+        key = self.headers.get("Sec-WebSocket-Key")
+        if not key:
+            self.send_error(400)
+            return
+        accept = base64.b64encode(hashlib.sha1(key + WS_GUID).digest())
+        # N.B. send_response() would use (our) HTTP/1.0
+        self.log_request(101)
+        self.wfile.write("HTTP/1.1 101 Switching Protocols\r\n")
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept)
+        self.end_headers()
+        self.wfile.flush()
+        self.closed = threading.Event()
+        self.writeLock = threading.Lock()
+        reader = threading.Thread(target=self._readFrames)
+        reader.setDaemon(True)
+        reader.start()
+        self.streamer._addClient(1)
+        seq = 0
+        try:
+            while self.streamer.running and not self.closed.is_set():
+                seq, msg = self.streamer.status.wait(seq)
+                if msg is None or self.closed.is_set():
+                    continue
+                self._sendFrame(wsFrame(msg))
+        except socket.error:
+            pass
+        finally:
+            self.closed.set()
+            self.streamer._addClient(-1)
+        reader.join(DEF_WAIT)
+
+    def _sendFrame(self, frame):
+        with self.writeLock:
+            self.wfile.write(frame)
+            self.wfile.flush()
+
+    def _readFrames(self):
+        # answer the client's pings, and echo its close
+        try:
+            while not self.closed.is_set():
+                frame = readWsFrame(self.rfile)
+                if frame is None:
+                    break
+                opcode, payload = frame
+                if opcode == WS_PING:
+                    self._sendFrame(wsFrame(payload, WS_PONG))
+                elif opcode == WS_CLOSE:
+                    # N.B. the payload is the status code (and reason)
+                    self._sendFrame(wsFrame(payload[:2], WS_CLOSE))
+                    break
+        except socket.error:
+            pass
+        finally:
+            self.closed.set()
+
+
+def wsFrame(text, opcode=WS_TEXT, mask=None):
+    """
+    Return a (final) WebSocket frame.
+
+    @param text Payload (string)
+    @param opcode Frame type (WS_TEXT, WS_CLOSE, WS_PING or WS_PONG)
+    @param mask 4-byte masking key (string) for a client frame, or None
+    """
+    n = len(text)
+    maskBit = 0x80 if mask else 0
+    if n < 126:
+        header = struct.pack("!BB", 0x80 | opcode, maskBit | n)
+    elif n < (1 << 16):
+        header = struct.pack("!BBH", 0x80 | opcode, maskBit | 126, n)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, maskBit | 127, n)
+    if mask:
+        header += mask
+        text = _unmask(text, mask)
+    return header + text
+
+
+def readWsFrame(f):
+    """
+    Read a WebSocket frame from a file.
+
+    Returns the (opcode, payload) of the frame (unmasked), or None at the end
+     of the file. N.B. fragmented messages aren't reassembled.
+    """
+    header = f.read(2)
+    if len(header) < 2:
+        return None
+    opcode = ord(header[0]) & 0x0f
+    masked = ord(header[1]) & 0x80
+    n = ord(header[1]) & 0x7f
+    if n == 126:
+        n = struct.unpack("!H", f.read(2))[0]
+    elif n == 127:
+        n = struct.unpack("!Q", f.read(8))[0]
+    mask = f.read(4) if masked else None
+    payload = f.read(n)
+    if len(payload) < n:
+        return None
+    if mask:
+        payload = _unmask(payload, mask)
+    return opcode, payload
+
+
+def _unmask(data, mask):
+    # (un)masking is an XOR with the (repeated) 4-byte key
+    if not data:
+        return data
+    key = np.tile(np.frombuffer(mask, np.uint8), (len(data) + 3) // 4)
+    return (np.frombuffer(data, np.uint8) ^ key[:len(data)]).tostring()
+
+
+#
+# TEST
+#
+class MjpegClient(threading.Thread):
+    """
+    Synthetic MJPEG client, that (optionally) takes a while with each frame.
+    """
+    def __init__(self, port, delay=0.0):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.port = port
+        self.delay = delay
+        self.frames = 0
+        self.running = True
+        self.start()
+
+    def run(self):
+        sock = socket.create_connection(("127.0.0.1", self.port))
+        sock.sendall("GET /stream.mjpg HTTP/1.0\r\n\r\n")
+        f = sock.makefile("rb")
+        while self.running:
+            line = f.readline()
+            if not line:
+                break
+            if line.lower().startswith("content-length:"):
+                f.readline()
+                f.read(int(line.split(":")[1]))
+                self.frames += 1
+                time.sleep(self.delay)
+        sock.close()
+
+
+class WsClient(threading.Thread):
+    """
+    Synthetic WebSocket status client.
+    """
+    def __init__(self, port):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.port = port
+        self.statusLine = None
+        self.messages = 0
+        self.last = None
+        self.pongs = 0
+        self.closeCode = None
+        self.sock = socket.create_connection(("127.0.0.1", self.port))
+        self.start()
+
+    def send(self, text, opcode):
+        self.sock.sendall(wsFrame(text, opcode, mask="\x12\x34\x56\x78"))
+
+    def run(self):
+        self.sock.sendall("GET /status HTTP/1.1\r\nHost: localhost\r\n"
+                          "Upgrade: websocket\r\nConnection: Upgrade\r\n"
+                          "Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n"
+                          "Sec-WebSocket-Version: 13\r\n\r\n")
+        f = self.sock.makefile("rb")
+        self.statusLine = f.readline().strip()
+        while f.readline() not in ("\r\n", ""):
+            pass
+        while True:
+            frame = readWsFrame(f)
+            if frame is None:
+                break
+            opcode, payload = frame
+            if opcode == WS_TEXT:
+                self.last = json.loads(payload)
+                self.messages += 1
+            elif opcode == WS_PONG:
+                self.pongs += 1
+            elif opcode == WS_CLOSE:
+                self.closeCode = struct.unpack("!H", payload[:2])[0]
+                break
+        self.sock.close()
+
+
+if __name__ == '__main__':
+    usage = sys.argv[0] + "[-v] [-n <numClients>] [-t <secs>]"
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        '-n', '--numClients', action='store', type=int, default=4,
+        help="number of (fast) synthetic clients")
+    ap.add_argument(
+        '-t', '--time', action='store', type=float, default=5.0,
+        help="secs to run for")
+    ap.add_argument(
+        '-v', '--verbose', action='count', default=0,
+        help="increase verbosity")
+    options = ap.parse_args()
+    if options.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+
+    server = StreamServer(port=0)
+    clients = [MjpegClient(server.port) for _ in range(options.numClients)]
+    slow = MjpegClient(server.port, delay=0.25)
+    ws = WsClient(server.port)
+
+    img = np.zeros((720, 1280, 3), np.uint8)
+    frames = 0
+    publishTime = 0.0
+    end = monotonic() + options.time
+    while monotonic() < end:
+        img[:] = frames % 256
+        cv2.putText(img, str(frames), (50, 100), cv2.FONT_HERSHEY_SIMPLEX, 2,
+                    (0, 0, 255), 3)
+        start = monotonic()
+        server.publish(img)
+        server.publishStatus({'frame': frames})
+        publishTime += monotonic() - start
+        frames += 1
+        time.sleep(1.0 / 30)
+
+    # ping, then close, the WebSocket
+    ws.send("ping", WS_PING)
+    time.sleep(0.1)
+    ws.send(struct.pack("!H", 1000), WS_CLOSE)
+    ws.join(DEF_WAIT * 2)
+
+    stats = server.getStats()
+    sys.stdout.write("Frames: {0}, offered: {1}, encoded: {2}, dropped: {3}\n".
+                     format(frames, stats['offered'], stats['encoded'],
+                            stats['dropped']))
+    sys.stdout.write("Publish time: {0:.3f} ms/frame\n".
+                     format(publishTime * 1000.0 / frames))
+    for i, c in enumerate(clients):
+        sys.stdout.write("Client {0}: {1} frames\n".format(i, c.frames))
+    sys.stdout.write("Slow client: {0} frames\n".format(slow.frames))
+    sys.stdout.write("WebSocket client: {0} messages, last: {1}\n".
+                     format(ws.messages, ws.last))
+    sys.stdout.write("WebSocket handshake: {0}, pongs: {1}, close: {2}\n".
+                     format(ws.statusLine, ws.pongs, ws.closeCode))
+    server.close()
+    # let the client threads see the server go away before exiting
+    time.sleep(DEF_WAIT * 1.5)
+    if not (ws.statusLine or "").startswith("HTTP/1.1 101 ") or \
+            ws.pongs != 1 or ws.closeCode != 1000:
+        logging.error("WebSocket test failed")
+        sys.exit(1)
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+
+"""X-Carve Microscope Tool Per-Frame Telemetry -- Library"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+
+from profiler import DEF_STAGES
+from util import monotonic
+
+
+'''
+DESIGN NOTES:
+  * Each frame's metrics go into one row of a fixed-schema NumPy structured
+    array, so recording a frame is a single row store (a few usecs) rather
+    than formatting and writing text.
+  * The rows are stored in fixed-size chunk files (.npy files that are
+    memory-mapped while they're being filled), so a session can run for any
+    length of time, and the OS writes the pages back in the background.
+  * The session's metadata (the number of valid rows in each chunk, and the
+    names of the stages, detectors, and machine states) is kept in a JSON
+    file that's updated whenever a chunk is finished. The count for the
+    chunk that's being filled is only right once the writer is closed, so a
+    session that's still being written (or that was never closed) is loaded
+    by scanning that chunk for its valid rows -- a new chunk file is zeroed,
+    and a frame's time (on the monotonic clock) is never zero.
+  * Sessions are loaded by memory-mapping the chunk files, so nothing is
+    copied until it's used.
+'''
+
+DEF_CHUNK_FRAMES = 65536    # rows per chunk file (~2 hours at 10 fps)
+
+META_FILE = "session.json"
+CHUNK_FILE = "chunk_{0:05d}.npy"
+
+# GRBL machine states (the first one is used for unknown states)
+STATES = ["Unknown", "Idle", "Run", "Hold", "Jog", "Alarm", "Door", "Check",
+          "Home", "Sleep"]
+STATE_CODES = {name: code for code, name in enumerate(STATES)}
+
+DEF_DETECTORS = ["circles", "corners", "lines"]
+
+
+def frameDtype(stages=DEF_STAGES, detectors=DEF_DETECTORS):
+    """
+    Return the structured dtype of a frame's telemetry row.
+
+    @param stages Names of the frame loop's (profiled) stages
+    @param detectors Names of the feature detectors
+    """
+    return np.dtype([
+        ('time', np.float64),                       # exposure time (secs)
+        ('frameId', np.uint32),
+        ('focus', np.float32),                      # focus metric (variance)
+        ('reused', np.uint8),                       # results reused (bool)
+        ('state', np.uint8),                        # machine state code
+        ('position', np.float32, (3,)),             # machine x, y, z (mm)
+        ('features', np.uint16, (len(detectors),)), # features per detector
+        ('stageTimes', np.float32, (len(stages) + 1,))  # stage/total secs
+    ])
+
+
+class TelemetryWriter(object):
+    """
+    Appends per-frame telemetry rows to memory-mapped chunk files.
+    """
+    def __init__(self, path, stages=DEF_STAGES, detectors=DEF_DETECTORS,
+                 chunkFrames=DEF_CHUNK_FRAMES):
+        """
+        Instantiate TelemetryWriter object, creating a new session.
+
+        @param path Session directory (created if it doesn't exist)
+        @param stages Names of the frame loop's (profiled) stages
+        @param detectors Names of the feature detectors
+        @param chunkFrames Number of rows per chunk file
+        """
+        if chunkFrames < 1:
+            logging.error("Invalid telemetry chunk size: %d", chunkFrames)
+            raise ValueError
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        if os.path.isfile(os.path.join(path, META_FILE)):
+            logging.error("Telemetry session already exists: %s", path)
+            raise RuntimeError
+        self.path = path
+        self.stages = list(stages)
+        self.detectors = list(detectors)
+        self.dtype = frameDtype(self.stages, self.detectors)
+        self.chunkFrames = chunkFrames
+        self.counts = []        # valid rows in each (finished) chunk
+        self.chunk = None
+        self.row = 0
+        self.frames = 0
+        self.noPosition = (np.nan, np.nan, np.nan)
+        self.noFeatures = (0,) * len(self.detectors)
+        self.noTimes = (np.nan,) * (len(self.stages) + 1)
+        self._newChunk()
+
+    def _newChunk(self):
+        name = os.path.join(self.path, CHUNK_FILE.format(len(self.counts)))
+        self.chunk = np.lib.format.open_memmap(name, mode='w+',
+                                               dtype=self.dtype,
+                                               shape=(self.chunkFrames,))
+        self.row = 0
+        self._writeMeta()
+
+    def _finishChunk(self):
+        self.chunk.flush()
+        self.counts.append(self.row)
+        self.chunk = None
+
+    def _writeMeta(self):
+        counts = self.counts + ([self.row] if self.chunk is not None else [])
+        meta = {'stages': self.stages, 'detectors': self.detectors,
+                'states': STATES, 'chunkFrames': self.chunkFrames,
+                'counts': counts, 'open': self.chunk is not None}
+        with open(os.path.join(self.path, META_FILE), 'w') as f:
+            json.dump(meta, f, indent=4, sort_keys=True)
+
+    def write(self, t, frameId, focus, reused, state, position, features,
+              stageTimes):
+        """
+        Append a frame's telemetry.
+
+        @param t Frame (exposure) time, on the monotonic clock
+        @param frameId Frame number
+        @param focus Focus metric (or None)
+        @param reused True if the frame's results were reused from an earlier
+         frame
+        @param state GRBL machine state name (or None)
+        @param position Machine (x, y, z) position (or None)
+        @param features Counts of the features found by each detector (in the
+         order of the writer's detectors), or None
+        @param stageTimes Durations of each stage plus the total frame time
+         (e.g., StageProfiler.frameTimes()), or None
+        """
+        self.chunk[self.row] = (
+            t, frameId, np.nan if focus is None else focus, reused,
+            STATE_CODES.get(state, 0),
+            self.noPosition if position is None else position,
+            self.noFeatures if features is None else features,
+            self.noTimes if stageTimes is None else stageTimes)
+        self.row += 1
+        self.frames += 1
+        if self.row >= self.chunkFrames:
+            self._finishChunk()
+            self._newChunk()
+
+    def close(self):
+        if self.chunk is None:
+            return
+        self._finishChunk()
+        self._writeMeta()
+
+
+def _validRows(chunk, count):
+    # return the number of rows that have been written to a chunk, given the
+    #  (possibly stale) count in the metadata
+    unwritten = np.flatnonzero(chunk['time'][count:] == 0.0)
+    return count + (unwritten[0] if len(unwritten) else len(chunk) - count)
+
+
+class Session(object):
+    """
+    A recorded telemetry session, loaded (zero-copy) from its chunk files.
+    """
+    def __init__(self, path):
+        """
+        Instantiate Session object.
+
+        @param path Session directory
+        """
+        metaPath = os.path.join(path, META_FILE)
+        if not os.path.isfile(metaPath):
+            logging.error("Not a telemetry session: %s", path)
+            raise ValueError
+        with open(metaPath, 'r') as f:
+            meta = json.load(f)
+        self.path = path
+        self.stages = meta['stages']
+        self.detectors = meta['detectors']
+        self.states = meta['states']
+        # read-only views of the valid rows of each chunk
+        self.chunks = []
+        counts = meta['counts']
+        for i, count in enumerate(counts):
+            chunk = np.load(os.path.join(path, CHUNK_FILE.format(i)),
+                            mmap_mode='r')
+            if meta.get('open', False) and i == len(counts) - 1:
+                # the last chunk is still being filled (or wasn't closed)
+                count = _validRows(chunk, count)
+            if count:
+                self.chunks.append(chunk[:count])
+
+    def __len__(self):
+        return sum(len(c) for c in self.chunks)
+
+    def __getitem__(self, field):
+        """
+        Return a field's values for the whole session -- a view if the
+         session is a single chunk, otherwise a (concatenated) copy.
+        """
+        if len(self.chunks) == 1:
+            return self.chunks[0][field]
+        if not self.chunks:
+            return np.zeros(0, frameDtype(self.stages,
+                                          self.detectors)[field])
+        return np.concatenate([c[field] for c in self.chunks])
+
+    def stateNames(self):
+        """
+        Return the machine state names of the frames.
+        """
+        return np.array(self.states)[self['state']]
+
+    def stageTimes(self, stage):
+        """
+        Return the durations (in secs) of the given stage (or "total").
+        """
+        col = len(self.stages) if stage == "total" else \
+            self.stages.index(stage)
+        return self['stageTimes'][:, col]
+
+    def featureCounts(self, detector):
+        return self['features'][:, self.detectors.index(detector)]
+
+
+#
+# MAIN
+#
+def summarize(session):
+    """
+    Write a summary of a session to stdout.
+    """
+    n = len(session)
+    sys.stdout.write("    Frames:        {0}\n".format(n))
+    if not n:
+        return
+    times = session['time']
+    sys.stdout.write("    Duration:      {0:.1f} secs\n".
+                     format(times[-1] - times[0]))
+    focus = session['focus']
+    focus = focus[~np.isnan(focus)]
+    if len(focus):
+        sys.stdout.write("    Focus:         min {0:.2f}, mean {1:.2f}, "
+                         "max {2:.2f}\n".format(focus.min(), focus.mean(),
+                                               focus.max()))
+    sys.stdout.write("    Reused:        {0:.1f}%\n".
+                     format(session['reused'].mean() * 100.0))
+    names, counts = np.unique(session.stateNames(), return_counts=True)
+    sys.stdout.write("    States:        {0}\n".format(
+        ", ".join("{0} {1}".format(s, c) for s, c in zip(names, counts))))
+    for detector in session.detectors:
+        sys.stdout.write("    {0:14} mean {1:.1f} features\n".format(
+            detector.capitalize() + ":",
+            session.featureCounts(detector).mean()))
+    sys.stdout.write("    Stage Times (msec, mean/p95):\n")
+    for stage in session.stages + ["total"]:
+        t = session.stageTimes(stage)
+        t = t[~np.isnan(t)] * 1000.0
+        if len(t):
+            sys.stdout.write("        {0:10} {1:8.3f} {2:8.3f}\n".format(
+                stage, t.mean(), np.percentile(t, 95)))
+
+
+def plot(session):
+    """
+    Plot a session's focus, features, stage times, and position over time.
+    """
+    try:
+        import matplotlib.pyplot as plt
+    except ImportError:
+        sys.stderr.write("Error: plotting requires matplotlib\n")
+        sys.exit(1)
+    t = session['time'] - session['time'][0]
+    fig, axes = plt.subplots(4, 1, sharex=True)
+    axes[0].plot(t, session['focus'])
+    axes[0].set_ylabel("focus")
+    for detector in session.detectors:
+        axes[1].plot(t, session.featureCounts(detector), label=detector)
+    axes[1].set_ylabel("features")
+    axes[1].legend()
+    for stage in session.stages:
+        axes[2].plot(t, session.stageTimes(stage) * 1000.0, label=stage)
+    axes[2].set_ylabel("msec")
+    axes[2].legend()
+    for i, axis in enumerate("XYZ"):
+        axes[3].plot(t, session['position'][:, i], label=axis)
+    axes[3].set_ylabel("mm")
+    axes[3].set_xlabel("secs")
+    axes[3].legend()
+    plt.show()
+
+
+def benchmark(path, numFrames):
+    """
+    Write synthetic frames to a session, and return the usecs per frame.
+    """
+    writer = TelemetryWriter(path, chunkFrames=min(numFrames,
+                                                   DEF_CHUNK_FRAMES))
+    times = np.zeros(len(DEF_STAGES) + 1)
+    start = monotonic()
+    for i in range(numFrames):
+        writer.write(i / 30.0, i, 123.4, False, "Run", (1.0, 2.0, -3.0),
+                     (0, 12, 3), times)
+    elapsed = monotonic() - start
+    writer.close()
+    return (elapsed / numFrames) * 1000000.0
+
+
+def main():
+    usage = sys.argv[0] + "[-v] [-p] [-B <numFrames>] <sessionDir>"
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        'session',
+        help="telemetry session directory")
+    ap.add_argument(
+        '-p', '--plot', action='store_true', default=False,
+        help="plot the session")
+    ap.add_argument(
+        '-B', '--benchmark', action='store', type=int,
+        help="write this many synthetic frames to a new session first")
+    ap.add_argument(
+        '-v', '--verbose', action='count', default=0,
+        help="increase verbosity")
+    options = ap.parse_args()
+
+    if options.benchmark:
+        usecs = benchmark(options.session, options.benchmark)
+        sys.stdout.write("    Write Cost:    {0:.2f} usecs/frame\n".
+                         format(usecs))
+
+    start = monotonic()
+    session = Session(options.session)
+    if options.verbose:
+        sys.stdout.write("    Load Time:     {0:.3f} msec\n".
+                         format((monotonic() - start) * 1000.0))
+    summarize(session)
+    if options.plot:
+        plot(session)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,343 @@
+"""X-Carve Microscope Tool Temporal Feature Tracker -- Library"""
+
+import logging
+
+import cv2
+import numpy as np
+
+import video
+
+
+'''
+DESIGN NOTES:
+  * Features barely move from one frame to the next, so the (full-frame)
+    detectors only run on keyframes, and the features are followed between
+    keyframes: corners and line end points with pyramidal Lucas-Kanade
+    optical flow, and circles (whose insides have nothing for the flow to
+    lock onto) by re-running the Hough detector in a small window around
+    where each one is expected to be.
+  * A new keyframe is detected when too many of the keyframe's features have
+    been lost, when the keyframe gets too old (sooner while the machine is
+    moving), when the machine starts or stops moving, and when the detector
+    parameters change.
+  * Each feature gets an id that's carried across keyframes (by matching the
+    new detections to the tracked features), so a locked (selected) feature
+    stays locked through re-detections.
+'''
+
+
+class FeatureTracker(object):
+    """
+    Follows detected features from frame to frame, between keyframes.
+    """
+    DEF_MAX_AGE = 30            # max frames between keyframes
+    DEF_MOVING_AGE = 5          # max frames between keyframes while moving
+    DEF_MIN_CONFIDENCE = 0.6    # fraction of keyframe features still tracked
+    DEF_WIN_SIZE = 21           # optical flow window size (pixels)
+    DEF_MAX_LEVEL = 2           # optical flow pyramid levels
+    DEF_MAX_ERROR = 30.0        # max optical flow (mean abs) window error
+    DEF_MATCH_RADIUS = 8.0      # max keyframe-to-keyframe move (pixels)
+    DEF_SEARCH_MARGIN = 12      # circle re-detection window margin (pixels)
+
+    def __init__(self, maxAge=DEF_MAX_AGE, movingAge=DEF_MOVING_AGE,
+                 minConfidence=DEF_MIN_CONFIDENCE, winSize=DEF_WIN_SIZE,
+                 maxLevel=DEF_MAX_LEVEL, maxError=DEF_MAX_ERROR,
+                 matchRadius=DEF_MATCH_RADIUS, margin=DEF_SEARCH_MARGIN):
+        """
+        Instantiate FeatureTracker object.
+
+        @param maxAge Max number of frames between keyframes
+        @param movingAge Max number of frames between keyframes while the
+         machine is moving
+        @param minConfidence Fraction of the keyframe's features that must
+         still be tracked (otherwise a new keyframe is detected)
+        @param winSize Optical flow window size (pixels)
+        @param maxLevel Optical flow pyramid levels
+        @param maxError Max optical flow error of a tracked point
+        @param matchRadius Max distance (pixels) between a feature's tracked
+         position and its new detection for it to keep its id
+        @param margin Margin (pixels) around a circle in which it's
+         re-detected
+        """
+        if not (0.0 <= minConfidence <= 1.0):
+            logging.error("Invalid tracker confidence: %s", minConfidence)
+            raise ValueError
+        self.maxAge = maxAge
+        self.movingAge = movingAge
+        self.minConfidence = minConfidence
+        self.winSize = (winSize, winSize)
+        self.maxLevel = maxLevel
+        self.maxError = maxError
+        self.matchRadius = matchRadius
+        self.margin = margin
+
+        self.prev = None        # copy of the previous frame (gray)
+        self.features = {}      # detector name -> results (as detected)
+        self.ids = {}           # detector name -> array of feature ids
+        self.nextId = 0
+        self.keyCount = 0       # number of features in the keyframe
+        self.age = 0            # frames since the keyframe
+        self.valid = False
+        self.moving = False
+        self.locked = None      # (detector name, feature id)
+        self.keyframes = 0
+        self.tracked = 0
+
+    def setMachineState(self, state):
+        """
+        Hint from the machine side -- re-detect when the machine starts or
+         stops moving.
+
+        @param state GRBL machine state (e.g., 'Idle', 'Run', 'Jog'), or None
+         if unknown
+        """
+        moving = (state is not None) and \
+            (state not in video.ChangeDetector.IDLE_STATES)
+        if moving != self.moving:
+            self.moving = moving
+            self.valid = False
+
+    def invalidate(self):
+        """
+        Force the next frame to be a keyframe.
+        """
+        self.valid = False
+
+    def keyframe(self, gray, features):
+        """
+        Start tracking from a keyframe.
+
+        @param gray Keyframe (grayscale) image
+        @param features Dict of the detector results for the keyframe
+        """
+        newFeatures, newIds = {}, {}
+        for name, feats in features.items():
+            if name not in video.DETECTORS:
+                continue
+            feats = np.asarray(feats, np.float32)
+            newFeatures[name] = feats
+            newIds[name] = self._carryIds(name, feats)
+        if self.locked and not np.any(newIds.get(self.locked[0], []) ==
+                                      self.locked[1]):
+            logging.info("Lost the locked feature")
+            self.locked = None
+        self.features, self.ids = newFeatures, newIds
+        self.keyCount = sum(len(f) for f in newFeatures.values())
+        self._setPrev(gray)
+        self.age = 0
+        self.valid = True
+        self.keyframes += 1
+
+    def _carryIds(self, name, feats):
+        # ids for new detections -- those of the nearest tracked features
+        #  (within the match radius), else new ones
+        ids = np.arange(self.nextId, self.nextId + len(feats))
+        old = self.features.get(name)
+        if old is not None and len(old) and len(feats):
+            a = video.featureAnchors(name, feats)
+            b = video.featureAnchors(name, old)
+            dist = np.sqrt(np.sum((a[:, np.newaxis] - b[np.newaxis]) ** 2,
+                                  axis=2))
+            rows, cols = np.nonzero(dist <= self.matchRadius)
+            usedOld = set()
+            for n in np.argsort(dist[rows, cols], kind='mergesort'):
+                i, j = rows[n], cols[n]
+                if ids[i] >= self.nextId and j not in usedOld:
+                    ids[i] = self.ids[name][j]
+                    usedOld.add(j)
+        self.nextId += len(feats)
+        return ids
+
+    def _setPrev(self, gray):
+        if self.prev is None or self.prev.shape != gray.shape:
+            self.prev = np.empty_like(gray)
+        np.copyto(self.prev, gray)
+
+    def track(self, gray, params):
+        """
+        Follow the features into a new frame.
+
+        @param gray Frame (grayscale) image
+        @param params Detector parameters (for the circle re-detection)
+
+        Returns True if the features were tracked, or False if a new keyframe
+         needs to be detected (and the tracked features are unchanged).
+        """
+        if not self.valid or self.prev is None or \
+           self.prev.shape != gray.shape or \
+           self.age >= (self.movingAge if self.moving else self.maxAge):
+            return False
+
+        corners = self.features.get('corners')
+        lines = self.features.get('lines')
+        circles = self.features.get('circles')
+        numCorners = len(corners) if corners is not None else 0
+        numLines = len(lines) if lines is not None else 0
+        points = []
+        if numCorners:
+            points.append(corners)
+        if numLines:
+            points.append(lines.reshape(-1, 2))
+
+        newFeatures, newIds = {}, {}
+        shift = np.zeros(2, np.float32)
+        if points:
+            points = np.concatenate(points).reshape(-1, 1, 2)
+            moved, status, err = cv2.calcOpticalFlowPyrLK(
+                self.prev, gray, points, None, winSize=self.winSize,
+                maxLevel=self.maxLevel)
+            moved = moved.reshape(-1, 2)
+            good = (status.ravel() == 1) & (err.ravel() < self.maxError)
+            if good.any():
+                # global motion, for predicting where the circles went
+                shift = np.median(moved[good] - points.reshape(-1, 2)[good],
+                                  axis=0)
+            if corners is not None:
+                keep = good[:numCorners]
+                newFeatures['corners'] = moved[:numCorners][keep]
+                newIds['corners'] = self.ids['corners'][keep]
+            if lines is not None:
+                keep = good[numCorners:].reshape(-1, 2).all(axis=1)
+                newFeatures['lines'] = \
+                    moved[numCorners:].reshape(-1, 4)[keep]
+                newIds['lines'] = self.ids['lines'][keep]
+        for name in ('corners', 'lines'):
+            if name in self.features and name not in newFeatures:
+                newFeatures[name] = self.features[name]
+                newIds[name] = self.ids[name]
+        if circles is not None:
+            newFeatures['circles'], keep = self._redetectCircles(
+                gray, circles, shift, params)
+            newIds['circles'] = self.ids['circles'][keep]
+
+        if self.keyCount:
+            confidence = sum(len(f) for f in newFeatures.values()) / \
+                float(self.keyCount)
+            if confidence < self.minConfidence:
+                self.valid = False
+                return False
+        self.features, self.ids = newFeatures, newIds
+        if self.locked and not np.any(self.ids.get(self.locked[0], []) ==
+                                      self.locked[1]):
+            logging.info("Lost the locked feature")
+            self.locked = None
+        self._setPrev(gray)
+        self.age += 1
+        self.tracked += 1
+        return True
+
+    def _redetectCircles(self, gray, circles, shift, params):
+        # find each circle again within a small window around where it's
+        #  expected to be, and return the circles found and a mask of them
+        height, width = gray.shape[:2]
+        found = []
+        keep = np.zeros(len(circles), np.bool_)
+        for i, (x, y, r) in enumerate(circles):
+            cx, cy = x + shift[0], y + shift[1]
+            half = int(r + self.margin)
+            x0, y0 = max(int(cx) - half, 0), max(int(cy) - half, 0)
+            x1, y1 = min(int(cx) + half + 1, width), min(int(cy) + half + 1,
+                                                          height)
+            if (x1 - x0) < half or (y1 - y0) < half:
+                continue
+            window = video.blurForCircles(gray[y0:y1, x0:x1])
+            res = cv2.HoughCircles(window, cv2.HOUGH_GRADIENT, 1.2,
+                                   2 * half, param1=100,
+                                   param2=params['circThrs'],
+                                   minRadius=max(int(r * 0.8), 1),
+                                   maxRadius=int(r * 1.2) + 1)
+            if res is None:
+                continue
+            res = res.reshape(-1, 3) + np.float32([x0, y0, 0])
+            dists = np.hypot(res[:, 0] - cx, res[:, 1] - cy)
+            n = int(np.argmin(dists))
+            if dists[n] <= self.margin:
+                found.append(res[n])
+                keep[i] = True
+        if not found:
+            return np.zeros((0, 3), np.float32), keep
+        return np.float32(found), keep
+
+    def getFeatures(self, frameId):
+        """
+        Return a dict of the tracked features (in the detector results' form).
+        """
+        features = dict(self.features)
+        features['frameId'] = frameId
+        return features
+
+    def lockNearest(self, x, y):
+        """
+        Lock onto the feature nearest to a point, and return its (x, y)
+         location (or None if there are no features).
+        """
+        found = video.nearestFeature(self.features, x, y)
+        if found is None:
+            self.locked = None
+            return None
+        name, index, pos = found
+        self.locked = (name, self.ids[name][index])
+        return pos
+
+    def unlock(self):
+        self.locked = None
+
+    def lockedPosition(self):
+        """
+        Return the current (x, y) location of the locked feature, or None.
+        """
+        if self.locked is None:
+            return None
+        name, featureId = self.locked
+        index = np.nonzero(self.ids[name] == featureId)[0]
+        if not len(index):
+            return None
+        anchor = video.featureAnchors(name, self.features[name][index[:1]])
+        return float(anchor[0, 0]), float(anchor[0, 1])
+
+
+#
+# TEST
+#
+if __name__ == '__main__':
+    import benchmark
+    from util import monotonic
+
+    width, height = 800, 600
+    base = benchmark.syntheticFrame(width + 64, height + 64)
+    detectors = ['corners', 'circles', 'lines']
+
+    def frameAt(dx, dy):
+        # view of the scene, panned by (dx, dy) pixels
+        M = np.float32([[1, 0, -(32 + dx)], [0, 1, -(32 + dy)]])
+        return cv2.warpAffine(base, M, (width, height))
+
+    full = video.VideoProcessing(detectors)
+    tracker = FeatureTracker(maxAge=30)
+    tracked = video.VideoProcessing(detectors, tracker=tracker)
+    frames = [frameAt(0.3 * i, 0.2 * i) for i in range(60)]
+
+    start = monotonic()
+    for img in frames:
+        full.processFrame(img)
+    fullSecs = (monotonic() - start) / len(frames)
+
+    # lock onto the big drill hole
+    tracked.processFrame(frames[0])
+    lockPos = tracked.getNearestFeature((width + 64) * 3 // 4 - 32,
+                                        (height + 64) * 3 // 4 - 32,
+                                        lock=True)
+    start = monotonic()
+    for img in frames[1:]:
+        tracked.processFrame(img)
+    trackSecs = (monotonic() - start) / (len(frames) - 1)
+
+    expected = (lockPos[0] - 0.3 * (len(frames) - 1),
+                lockPos[1] - 0.2 * (len(frames) - 1))
+    print("Full detection: {0:.2f} msec/frame".format(fullSecs * 1000.0))
+    print("Tracked:        {0:.2f} msec/frame ({1:.0f}%), {2} keyframes, "
+          "{3} tracked frames".format(trackSecs * 1000.0,
+                                      (trackSecs / fullSecs) * 100.0,
+                                      tracker.keyframes, tracker.tracked))
+    print("Locked feature: {0} -> {1} (expected {2})".format(
+        lockPos, tracked.getLockedFeature(), expected))
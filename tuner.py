@@ -0,0 +1,527 @@
+#!/usr/bin/env python
+
+"""X-Carve Microscope Tool Detector Parameter Tuner"""
+
+import argparse
+import copy
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import sys
+
+import numpy as np
+
+import batch
+import cnc_video
+import params
+import scheduler
+import util
+import video
+from util import monotonic
+
+
+'''
+DESIGN NOTES:
+  * Detector parameters are tuned offline, on recorded frames whose features
+    have been labelled by hand, instead of by eye with the trackbars.
+  * Each detector only depends on its own parameters, so each detector gets
+    its own sweep (the product of just its parameters' values), rather than
+    one sweep over the product of all of them.
+  * The configurations are farmed out to a process pool. Each worker gets
+    the labelled frames once (when it starts), and keeps a FrameContext for
+    each of them, which caches the derived images that every configuration
+    needs -- the grayscale frame, its pyramid levels, and the float and
+    median-blurred copies the Harris and Hough detectors work on -- so
+    they're made once per worker, not once per configuration.
+  * A configuration's accuracy is the F1 score of its detections against the
+    labels, and its runtime is the mean time per frame of the detector plus
+    the intermediates it needs (other than the grayscale frame, which the
+    frame loop makes anyway).
+  * The configurations on the accuracy/runtime Pareto front are reported, and
+    the fastest one that's within a slack of the most accurate one is
+    written back to the (YAML) config file.
+
+  Labels file (JSON) -- source paths are relative to the labels file, and a
+   detector that's missing from a frame's entry isn't scored on that frame:
+    {"frames": [{"source": "run1.avi", "frame": 12,
+                 "lines": [[x1, y1, x2, y2], ...],
+                 "corners": [[x, y], ...],
+                 "circles": [[x, y, radius], ...]}, ...]}
+'''
+
+# Parameters that each detector depends on
+DETECTOR_PARAMS = {
+    'lines': ['thrs1', 'thrs2'],
+    'corners': ['blkSize', 'kernelSize', 'kVal'],
+    'circles': ['minRadius', 'maxRadius', 'circThrs']
+}
+
+# Values tried for each parameter
+DEF_SWEEP = {
+    'thrs1': [500, 1000, 2000, 3000, 4000],
+    'thrs2': [1500, 3000, 4500, 6000],
+    'blkSize': [2, 3, 5, 7],
+    'kernelSize': [3, 5, 7],
+    'kVal': [4, 5, 6, 8],
+    'minRadius': [3, 5, 10],
+    'maxRadius': [0, 50, 100],
+    'circThrs': [20, 30, 40, 50]
+}
+
+DEF_TOLERANCE = 4.0     # max distance (pixels) of a match to a label
+DEF_SLACK = 0.02        # F1 that may be given up for a faster configuration
+DEF_CHUNK_SIZE = 4      # configurations handed to a worker at a time
+
+DEF_SYNTHETIC_SIZE = (640, 480)
+
+
+#
+# FEATURE MATCHING
+#
+def _segmentDistance(points, segments):
+    # distance from each point (Nx2) to each segment (Mx4), as an NxM array
+    p = points[:, np.newaxis, :]
+    a, b = segments[np.newaxis, :, 0:2], segments[np.newaxis, :, 2:4]
+    ab = b - a
+    denom = np.maximum(np.sum(ab * ab, axis=2), 1e-9)
+    t = np.clip(np.sum((p - a) * ab, axis=2) / denom, 0.0, 1.0)
+    closest = a + (t[:, :, np.newaxis] * ab)
+    return np.sqrt(np.sum((p - closest) ** 2, axis=2))
+
+
+def matchFeatures(found, truth, detector, tolerance=DEF_TOLERANCE):
+    """
+    Match a detector's results to the labelled features.
+
+    @param found Detector results (see video.DETECTORS)
+    @param truth Labelled features, in the same form as the results
+    @param detector Name of the detector
+    @param tolerance Max distance (in pixels) of a match
+
+    Returns (matchedFound, matchedTruth) -- the number of results that match
+     a label, and the number of labels that are matched.
+    N.B. Points and circles are matched one-to-one (nearest first). A line
+     result matches a labelled line if both of its end points lie on it, so
+     several (fragmentary) results can match the same label.
+    """
+    if not len(found) or not len(truth):
+        return 0, 0
+    found = np.asarray(found, np.float64)
+    truth = np.asarray(truth, np.float64)
+    if detector == 'lines':
+        dist = np.maximum(_segmentDistance(found[:, 0:2], truth),
+                          _segmentDistance(found[:, 2:4], truth))
+        near = dist <= tolerance
+        return int(np.count_nonzero(near.any(axis=1))), \
+            int(np.count_nonzero(near.any(axis=0)))
+
+    diff = found[:, np.newaxis, 0:2] - truth[np.newaxis, :, 0:2]
+    dist = np.sqrt(np.sum(diff * diff, axis=2))
+    if detector == 'circles':
+        radii = np.abs(found[:, np.newaxis, 2] - truth[np.newaxis, :, 2])
+        dist[radii > tolerance] = np.inf
+    rows, cols = np.nonzero(dist <= tolerance)
+    usedFound, usedTruth = set(), set()
+    for n in np.argsort(dist[rows, cols], kind='mergesort'):
+        i, j = rows[n], cols[n]
+        if i not in usedFound and j not in usedTruth:
+            usedFound.add(i)
+            usedTruth.add(j)
+    return len(usedFound), len(usedTruth)
+
+
+#
+# WORKERS
+#
+# labelled frames of a worker process, their FrameContexts (which are never
+#  reset, so they cache the derived images across configurations), and the
+#  secs it took to make each frame's derived images
+_labels = None
+_contexts = []
+_costs = {}
+
+
+def _initWorker(frames, labels):
+    global _labels
+    _labels = labels
+    del _contexts[:]
+    _costs.clear()
+    for frame in frames:
+        ctx = video.FrameContext()
+        ctx.reset(frame)
+        ctx.gray()      # the frame loop makes this anyway
+        _contexts.append(ctx)
+
+
+def _inputs(index, scale, kind):
+    """
+    Return a frame's (downscaled) grayscale image and the derived copy of it
+     that a detector uses, and the secs it took to make them.
+
+    @param index Index of the frame
+    @param scale Pyramid level (scale factor) of the image
+    @param kind Kind of derived image (see video.DETECTOR_INPUTS), or None
+    """
+    ctx = _contexts[index]
+    quality = scheduler.Quality(scale, 1, 1.0)
+    spent = ctx.spent
+    gray = ctx.prepared(quality, 'detectGray')[0]
+    cost = _costs.setdefault((index, scale, None), ctx.spent - spent)
+    extra = None
+    if kind:
+        spent = ctx.spent
+        extra = ctx.derived(kind, quality)
+        cost += _costs.setdefault((index, scale, kind), ctx.spent - spent)
+    return gray, extra, cost
+
+
+def evaluate(task):
+    """
+    Run a detector configuration over all of the labelled frames.
+
+    @param task Tuple of (detector, params, scales, tolerance)
+
+    Returns a dict with the configuration's counts, scores, and runtime.
+    N.B. This is a top-level function so that it can be used in a Pool.
+    """
+    detector, prms, scales, tolerance = task
+    func = video.DETECTORS[detector]
+    arg, kind = video.DETECTOR_INPUTS.get(detector, (None, None))
+    matchedFound = numFound = matchedTruth = numTruth = 0
+    elapsed = 0.0
+    runs = 0
+    for index, labels in enumerate(_labels):
+        truth = labels.get(detector)
+        if truth is None:
+            continue
+        for scale in scales:
+            gray, extra, cost = _inputs(index, scale, kind)
+            start = monotonic()
+            if kind is None:
+                found = func(gray, prms)
+            else:
+                found = func(gray, prms, **{arg: extra})
+            elapsed += (monotonic() - start) + cost
+            runs += 1
+            found = video.scaleFeatures({detector: found}, scale,
+                                        (0, 0))[detector]
+            mf, mt = matchFeatures(found, truth, detector, tolerance)
+            matchedFound += mf
+            numFound += len(found)
+            matchedTruth += mt
+            numTruth += len(truth)
+
+    precision = (float(matchedFound) / numFound) if numFound else 0.0
+    recall = (float(matchedTruth) / numTruth) if numTruth else 0.0
+    f1 = ((2.0 * precision * recall) / (precision + recall)) \
+        if (precision + recall) else 0.0
+    return {'detector': detector,
+            'params': {name: prms[name] for name in DETECTOR_PARAMS[detector]},
+            'precision': precision, 'recall': recall, 'f1': f1,
+            'secs': (elapsed / runs) if runs else 0.0, 'runs': runs}
+
+
+#
+# SWEEP
+#
+def configurations(detector, baseParams, sweep=DEF_SWEEP):
+    """
+    Generator that returns the parameter dicts to try for a detector.
+
+    @param detector Name of the detector
+    @param baseParams Detector parameters (values of the ones not swept)
+    @param sweep Dict of the values to try for each parameter
+    """
+    names = DETECTOR_PARAMS[detector]
+    for values in itertools.product(*[sweep.get(name, [baseParams[name]])
+                                      for name in names]):
+        prms = dict(baseParams)
+        prms.update(zip(names, values))
+        if detector == 'lines' and prms['thrs1'] > prms['thrs2']:
+            continue
+        if detector == 'circles' and prms['maxRadius'] and \
+           prms['maxRadius'] <= prms['minRadius']:
+            continue
+        yield prms
+
+
+def sweep(frames, labels, detectors, baseParams, values=DEF_SWEEP,
+          scales=(1.0,), tolerance=DEF_TOLERANCE, numJobs=1):
+    """
+    Evaluate all of the configurations of the given detectors.
+
+    @param frames List of (BGR) labelled frames
+    @param labels List (parallel to frames) of dicts of labelled features
+     (as arrays), keyed by detector name
+    @param detectors Names of the detectors to tune
+    @param baseParams Detector parameters (values of the ones not swept)
+    @param values Dict of the values to try for each parameter
+    @param scales Pyramid levels (scale factors) to run each configuration at
+    @param tolerance Max distance (in pixels) of a match
+    @param numJobs Number of worker processes (1 runs them in this process)
+
+    Returns a list of the results (see evaluate()).
+    """
+    tasks = [(detector, prms, tuple(scales), tolerance)
+             for detector in detectors
+             for prms in configurations(detector, baseParams, values)]
+    if numJobs > 1:
+        pool = multiprocessing.Pool(numJobs, _initWorker, (frames, labels))
+        try:
+            results = pool.map(evaluate, tasks, DEF_CHUNK_SIZE)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _initWorker(frames, labels)
+        results = [evaluate(task) for task in tasks]
+    return results
+
+
+def paretoFront(results):
+    """
+    Return the results that no other result beats on both accuracy (F1) and
+     runtime, fastest first.
+    """
+    front = []
+    for r in sorted(results, key=lambda r: (r['secs'], -r['f1'])):
+        if not front or r['f1'] > front[-1]['f1']:
+            front.append(r)
+    return front
+
+
+def selectBest(front, slack=DEF_SLACK):
+    """
+    Return the fastest result on a Pareto front whose F1 score is within the
+     given slack of the best one's.
+    """
+    bestF1 = front[-1]['f1']
+    for r in front:
+        if r['f1'] >= (bestF1 - slack):
+            return r
+
+
+#
+# INPUTS
+#
+def loadLabels(path, detectors):
+    """
+    Read the labelled frames.
+
+    @param path Labels (JSON) file (see DESIGN NOTES)
+    @param detectors Names of the detectors to read labels for
+
+    Returns a tuple of the lists of frames and of labels.
+    """
+    with open(path, 'r') as f:
+        entries = json.load(f)['frames']
+    baseDir = os.path.dirname(os.path.abspath(path))
+    wanted = {}     # source -> {frameNum: labels}
+    for entry in entries:
+        source = os.path.join(baseDir, entry['source'])
+        labels = {name: np.asarray(entry[name], np.float64)
+                  for name in detectors if name in entry}
+        wanted.setdefault(source, {})[int(entry.get('frame', 0))] = labels
+
+    frames, labels = [], []
+    for source in sorted(wanted):
+        if not os.path.exists(source):
+            logging.error("Labelled source not found: %s", source)
+            raise ValueError
+        for frameNum, img in batch.frameSource(source):
+            if frameNum in wanted[source]:
+                frames.append(img)
+                labels.append(wanted[source].pop(frameNum))
+        if wanted[source]:
+            logging.warning("Labelled frames missing from '%s': %s", source,
+                            sorted(wanted[source].keys()))
+    return frames, labels
+
+
+def syntheticLabels(width, height):
+    """
+    Return the labels of the features drawn by benchmark.syntheticFrame().
+    """
+    x0, y0 = width // 8, height // 8
+    x1, y1 = (width * 5) // 8, (height * 5) // 8
+    radius = min(width, height) // 10
+    return {
+        'lines': np.float64([[x0, y0, x1, y0], [x1, y0, x1, y1],
+                             [x1, y1, x0, y1], [x0, y1, x0, y0],
+                             [0, (height * 7) // 8, width,
+                              (height * 6) // 8]]),
+        'corners': np.float64([[x0, y0], [x1, y0], [x1, y1], [x0, y1]]),
+        'circles': np.float64([[(width * 3) // 4, (height * 3) // 4, radius],
+                               [width // 3, (height * 2) // 3, radius // 2]])
+    }
+
+
+def syntheticInputs(numFrames, size=DEF_SYNTHETIC_SIZE):
+    """
+    Return lists of synthetic frames and their labels.
+    """
+    import benchmark
+
+    width, height = size
+    frames = [benchmark.syntheticFrame(width, height, seed)
+              for seed in range(numFrames)]
+    return frames, [syntheticLabels(width, height)] * numFrames
+
+
+def writeBest(path, best):
+    """
+    Write the chosen detector parameters to a YAML config file, keeping the
+     rest of the file's settings.
+
+    @param path Config file
+    @param best List of the chosen results (see evaluate())
+    """
+    registry = params.ParameterRegistry()
+    for r in best:
+        for name, value in r['params'].items():
+            registry.define(name, value, 0,
+                            configPath=['detection', 'params', name])
+    registry.save(path)
+
+
+#
+# MAIN
+#
+def main():
+    usage = sys.argv[0] + "[-v] [-C <confFile>] [-o <outFile>] [-n] "
+    usage += "[-d <detectors>] [-s <param>=<values>] [-L <scales>] "
+    usage += "[-j <numJobs>] [-t <tolerance>] [-e <slack>] "
+    usage += "(-l <labelsFile> | -S <numFrames>)"
+    ap = argparse.ArgumentParser()
+    ap.add_argument(
+        '-l', '--labels', action='store', type=str,
+        help="labelled ground-truth features file (JSON)")
+    ap.add_argument(
+        '-S', '--synthetic', action='store', type=int,
+        help="tune on this many synthetic (benchmark) frames instead")
+    ap.add_argument(
+        '-C', '--configFile', action='store',
+        help="configuration file to start from, and to write the results to")
+    ap.add_argument(
+        '-o', '--output', action='store', type=str,
+        help="configuration file to write the results to (instead)")
+    ap.add_argument(
+        '-n', '--dryRun', action='store_true', default=False,
+        help="don't write the results")
+    ap.add_argument(
+        '-d', '--detectors', action='store', type=str,
+        default=",".join(sorted(DETECTOR_PARAMS)),
+        help="comma-separated list of detectors to tune")
+    ap.add_argument(
+        '-s', '--sweep', action='append', default=[],
+        help="values to try for a parameter -- '<name>=<v1>,<v2>,...'")
+    ap.add_argument(
+        '-L', '--levels', action='store', type=str,
+        help="comma-separated pyramid levels (scales) to run the detectors "
+             "at (default: those the scheduler uses, if it's enabled)")
+    ap.add_argument(
+        '-j', '--jobs', action='store', type=int,
+        default=multiprocessing.cpu_count(),
+        help="number of worker processes")
+    ap.add_argument(
+        '-t', '--tolerance', action='store', type=float,
+        default=DEF_TOLERANCE,
+        help="max distance (pixels) of a detection from its label")
+    ap.add_argument(
+        '-e', '--slack', action='store', type=float, default=DEF_SLACK,
+        help="F1 score that may be given up for a faster configuration")
+    ap.add_argument(
+        '-v', '--verbose', action='count', default=0,
+        help="increase verbosity")
+    options = ap.parse_args()
+
+    if not options.labels and not options.synthetic:
+        sys.stderr.write("Error: a labels file or synthetic frames must be "
+                         "given\n")
+        sys.exit(1)
+
+    config = copy.deepcopy(cnc_video.config)
+    if options.configFile and os.path.isfile(options.configFile):
+        import yaml
+        with open(options.configFile, 'r') as ymlFile:
+            util.dictMerge(config, yaml.load(ymlFile) or {})
+    baseParams = dict(video.DEF_DETECTOR_PARAMS)
+    baseParams.update(config['detection'].get('params') or {})
+
+    detectors = options.detectors.split(",")
+    for name in detectors:
+        if name not in DETECTOR_PARAMS:
+            sys.stderr.write("Error: unknown detector: {0}\n".format(name))
+            sys.exit(1)
+
+    values = dict(DEF_SWEEP)
+    for s in options.sweep:
+        name, _, vals = s.partition("=")
+        if name not in baseParams or not vals:
+            sys.stderr.write("Error: invalid sweep: {0}\n".format(s))
+            sys.exit(1)
+        values[name] = [int(v) for v in vals.split(",")]
+
+    if options.levels:
+        scales = [float(v) for v in options.levels.split(",")]
+    elif config['scheduler'].get('enable'):
+        scales = sorted(set(q.scale for q in scheduler.DETECT_LADDER),
+                        reverse=True)
+    else:
+        scales = [1.0]
+
+    if options.labels:
+        frames, labels = loadLabels(options.labels, detectors)
+    else:
+        frames, labels = syntheticInputs(options.synthetic)
+    if not frames:
+        sys.stderr.write("Error: no labelled frames\n")
+        sys.exit(1)
+
+    if options.verbose:
+        sys.stdout.write("    Labelled Frames:  {0}\n".format(len(frames)))
+        sys.stdout.write("    Detectors:        {0}\n".format(detectors))
+        sys.stdout.write("    Pyramid Levels:   {0}\n".format(scales))
+        sys.stdout.write("    Worker Processes: {0}\n".format(options.jobs))
+        sys.stdout.flush()
+
+    start = monotonic()
+    results = sweep(frames, labels, detectors, baseParams, values, scales,
+                    options.tolerance, options.jobs)
+    elapsed = monotonic() - start
+
+    best = []
+    for detector in detectors:
+        front = paretoFront([r for r in results
+                             if r['detector'] == detector and r['runs']])
+        if not front:
+            logging.warning("No labels for detector '%s'", detector)
+            continue
+        choice = selectBest(front, options.slack)
+        best.append(choice)
+        sys.stdout.write("{0}: Pareto front ({1} of {2} configurations)\n".
+                         format(detector, len(front),
+                                sum(r['detector'] == detector
+                                    for r in results)))
+        for r in front:
+            sys.stdout.write("  {0} F1 {1:.3f} (P {2:.3f}, R {3:.3f}) "
+                             "{4:8.3f} msec  {5}\n".format(
+                                 "*" if r is choice else " ", r['f1'],
+                                 r['precision'], r['recall'],
+                                 r['secs'] * 1000.0,
+                                 json.dumps(r['params'], sort_keys=True)))
+    if options.verbose:
+        sys.stdout.write("    Sweep: {0} configurations in {1:.2f} secs\n".
+                         format(len(results), elapsed))
+
+    if best and not options.dryRun:
+        path = options.output or options.configFile or \
+            cnc_video.DEF_CONFIG_FILE
+        writeBest(path, best)
+        sys.stdout.write("Wrote the chosen parameters to '{0}'\n".format(path))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,61 @@
 """Utility Functions for the CNC_VIDEO app -- Library"""
 
 import collections
+import ctypes
+import ctypes.util
 import logging
+import sys
 import threading
 import time
 
 
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _monotonicClock():
+    # return a function that reads a monotonic clock (in secs) -- Python 2
+    #  doesn't have one, so it's read from the OS through ctypes
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    try:
+        if sys.platform.startswith('win'):
+            kernel32 = ctypes.windll.kernel32
+            freq = ctypes.c_int64()
+            kernel32.QueryPerformanceFrequency(ctypes.byref(freq))
+
+            def winMonotonic():
+                # N.B. ctypes releases the GIL, so each call gets its own
+                #  buffer
+                counter = ctypes.c_int64()
+                kernel32.QueryPerformanceCounter(ctypes.byref(counter))
+                return counter.value / float(freq.value)
+            return winMonotonic
+        # CLOCK_MONOTONIC is 6 on macOS, 1 on Linux
+        clockId = 6 if sys.platform == 'darwin' else 1
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or
+                           ctypes.util.find_library('rt'), use_errno=True)
+        clockGettime = libc.clock_gettime
+        clockGettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+        ts = _Timespec()
+        if clockGettime(clockId, ctypes.byref(ts)) != 0:
+            raise OSError(ctypes.get_errno(), "clock_gettime failed")
+
+        def posixMonotonic():
+            # N.B. ctypes releases the GIL, so each call gets its own buffer
+            ts = _Timespec()
+            clockGettime(clockId, ctypes.byref(ts))
+            return ts.tv_sec + (ts.tv_nsec * 1e-9)
+        return posixMonotonic
+    except (AttributeError, OSError, TypeError):
+        logging.warning("No monotonic clock, using wall-clock time")
+        return time.time
+
+
+# Monotonic clock for timestamps and intervals (secs, arbitrary epoch)
+monotonic = _monotonicClock()
+
+
 # Map of type names into types
 TYPES = {
     'int': int,
@@ -57,5 +107,7 @@ if __name__ == '__main__':
     print type(r), r
     r = typeCast('boolean', "1")
     print type(r), r
+    t = [monotonic() for i in range(1000)]
+    print "monotonic:", all(b >= a for a, b in zip(t, t[1:])), t[-1] - t[0]
     r = typeCast("foo", "1")
     print type(r), r
@@ -4,6 +4,10 @@ import logging
 import math
 
 import cv2
+import numpy as np
+
+import scheduler
+from util import monotonic
 
 
 MAX_CROSSHAIR_THICKNESS = 5
@@ -20,6 +24,228 @@ FONT_FACE_5 = cv2.FONT_HERSHEY_COMPLEX_SMALL   # 19 small serif
 FONT_FACE_6 = cv2.FONT_HERSHEY_SCRIPT_SIMPLEX  # 27 script-like
 FONT_FACE_7 = cv2.FONT_HERSHEY_SCRIPT_COMPLEX  # 27 script-like
 
+# Default feature detector parameters (N.B. names match the trackbars)
+DEF_DETECTOR_PARAMS = {
+    'thrs1': 3000,          # Canny lower threshold
+    'thrs2': 4500,          # Canny upper threshold
+    'blkSize': 5,           # Harris neighborhood size
+    'kernelSize': 5,        # Harris Sobel aperture (forced odd)
+    'kVal': 5,              # Harris k parameter (in hundredths)
+    'minRadius': 5,         # smallest circle radius (pixels)
+    'maxRadius': 0,         # largest circle radius (pixels, 0=unbounded)
+    'circThrs': 30          # Hough circle accumulator threshold
+}
+
+
+class FramePool(object):
+    """
+    Pool of preallocated image buffers that are reused on every frame.
+
+    Each stage asks for its buffers by name, and gets the same array back on
+     every frame (unless the requested shape/type changes), so that the frame
+     loop doesn't allocate (multi-MB, at high resolutions) images per frame.
+     N.B. This only covers the images the stages ask for -- temporaries that
+     OpenCV and NumPy allocate inside their calls aren't seen by the pool.
+    """
+    def __init__(self, width, height):
+        """
+        Instantiate FramePool object.
+
+        @param width Frame width in pixels
+        @param height Frame height in pixels
+        """
+        self.width = width
+        self.height = height
+        self.buffers = {}
+        self.allocations = 0    # number of pool buffers (re)allocated (int)
+
+    def get(self, name, shape=None, dtype=np.uint8):
+        """
+        Return the named buffer, allocating it if necessary.
+
+        @param name Name of the buffer (unique to the stage that uses it)
+        @param shape Shape of the buffer (defaults to a BGR frame)
+        @param dtype Element type of the buffer
+        """
+        if shape is None:
+            shape = (self.height, self.width, 3)
+        buf = self.buffers.get(name)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = np.empty(shape, dtype)
+            self.buffers[name] = buf
+            self.allocations += 1
+        return buf
+
+    def frame(self):
+        """
+        Return the buffer that camera frames are captured into.
+        """
+        return self.get('frame')
+
+
+class FrameContext(object):
+    """
+    Derived images (grayscale, pyramid levels, etc.) of the current frame,
+     shared by all of the stages that use them.
+
+    Each derived image is made the first time a stage asks for it (in a
+     FramePool buffer), and the same image is returned to every later request
+     during that frame. Hits, misses, and the time the hits saved are
+     counted across frames.
+    """
+    def __init__(self, pool=None):
+        """
+        Instantiate FrameContext object.
+
+        @param pool FramePool to get the derived images' buffers from
+        """
+        self.pool = pool
+        self.img = None
+        self.frameId = None
+        self.memo = {}          # key -> derived image (this frame)
+        self.costs = {}         # key -> secs it took to make (this frame)
+        self.built = 0.0        # secs spent making images (nested in a make)
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0.0        # secs not spent, thanks to hits
+        self.spent = 0.0        # secs spent making images
+        self.kinds = {}         # kind -> [hits, misses]
+
+    def reset(self, img, frameId=None):
+        """
+        Start a new frame -- forget the previous frame's derived images.
+        """
+        if self.pool is None:
+            height, width = img.shape[:2]
+            self.pool = FramePool(width, height)
+        self.img = img
+        self.frameId = frameId
+        self.memo.clear()
+        self.costs.clear()
+
+    def get(self, key, make):
+        """
+        Return a derived image, making it if it hasn't been made this frame.
+
+        @param key Hashable key of the image -- a kind name, or a tuple that
+         starts with one
+        @param make Function that makes (and returns) the image
+        """
+        kind = key[0] if isinstance(key, tuple) else key
+        counts = self.kinds.setdefault(kind, [0, 0])
+        img = self.memo.get(key)
+        if img is not None:
+            self.hits += 1
+            counts[0] += 1
+            self.saved += self.costs[key]
+            return img
+        self.misses += 1
+        counts[1] += 1
+        # N.B. the time spent making the images this one's made from is
+        #  charged to them, not to this one
+        outer, self.built = self.built, 0.0
+        start = monotonic()
+        img = make()
+        elapsed = monotonic() - start
+        self.costs[key] = elapsed - self.built
+        self.spent += self.costs[key]
+        self.built = outer + elapsed
+        self.memo[key] = img
+        return img
+
+    def gray(self):
+        return self.get('gray', self._makeGray)
+
+    def _makeGray(self):
+        if self.img.ndim == 2:
+            # already grayscale (see capture.Camera)
+            return self.img
+        height, width = self.img.shape[:2]
+        gray = self.pool.get('gray', (height, width))
+        cv2.cvtColor(self.img, cv2.COLOR_BGR2GRAY, dst=gray)
+        return gray
+
+    def level(self, n):
+        """
+        Return the n'th (cv2.pyrDown()) pyramid level of the grayscale frame.
+        """
+        if n <= 0:
+            return self.gray()
+
+        def make():
+            up = self.level(n - 1)
+            shape = (((up.shape[0] + 1) // 2), ((up.shape[1] + 1) // 2))
+            down = self.pool.get("level{0}".format(n), shape)
+            cv2.pyrDown(up, dst=down)
+            return down
+        return self.get(('level', n), make)
+
+    def prepared(self, quality, name):
+        """
+        Return the grayscale frame with a scheduler Quality's ROI and scale
+         applied, and the (x, y) offset of its ROI (see scheduler.prepare()).
+
+        @param name Name of the pool buffer to use (if the image isn't a
+         pyramid level)
+        """
+        n = FrameContext._levelOf(quality)
+        if n is not None:
+            return self.level(n), (0, 0)
+        return self.get(('prepared', quality), lambda: scheduler.prepare(
+            self.gray(), quality, self.pool, name))
+
+    @staticmethod
+    def _levelOf(quality):
+        # pyramid level that a Quality's image is, or None if it isn't one
+        if quality.roi < 1.0:
+            return None
+        if quality.scale >= 1.0:
+            return 0
+        n = int(round(-math.log(quality.scale, 2)))
+        if abs(quality.scale - (0.5 ** n)) < 1e-6:
+            return n
+        return None
+
+    def derived(self, kind, source=None):
+        """
+        Return a derived copy of a grayscale image from this context.
+
+        @param kind 'float' (float32, for the Harris detector) or 'median'
+         (median-blurred, for the Hough circle detector)
+        @param source Pyramid level (int) of the image, or the scheduler
+         Quality it was prepared with -- None for the full-size frame
+        """
+        if source is None:
+            source = 0
+        elif not isinstance(source, int):
+            n = FrameContext._levelOf(source)
+            source = source if n is None else n
+        if isinstance(source, int):
+            src = self.level(source)
+        else:
+            src = self.prepared(source, 'detectGray')[0]
+
+        def make():
+            if kind == 'float':
+                dst = self.pool.get(('float', source), src.shape, np.float32)
+                np.copyto(dst, src)
+                return dst
+            if kind == 'median':
+                dst = self.pool.get(('median', source), src.shape)
+                return blurForCircles(src, dst)
+            logging.error("Unknown derived image: %s", kind)
+            raise ValueError
+        return self.get((kind, source), make)
+
+    def getStats(self):
+        """
+        Return the hit/miss counts (in total and for each kind of image), and
+         the secs spent making images and saved by the hits.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'spent': self.spent, 'saved': self.saved,
+                'kinds': {k: tuple(v) for k, v in self.kinds.items()}}
+
 
 class Crosshair(object):
     """
@@ -27,15 +253,22 @@ class Crosshair(object):
 
     Horizontal and vertical parts can be (idependently) highlighted, e.g., to
      indicate alignment with selected feature.
+
+    Only the pixels under the lines change, so the rendered lines and their
+     mask are cached as a few bands (a horizontal one, and the parts of a
+     vertical one above and below it) and only those bands are blended. The
+     cache is rebuilt when the highlighting changes.
     """
-    def __init__(self, width, height, confVals, adjustments=False):
+    def __init__(self, width, height, confVals, registry=None, pool=None):
         """
         Instantiate Crosshair object.
 
         @param width Crosshair image width in pixels
         @param width Crosshair image height in pixels
         @param confVals See 'crosshair' field in config dict
-        @param adjustments Enable real-time value adjustment inputs
+        @param registry ParameterRegistry to take (run-time) 'alpha' changes
+         from
+        @param pool FramePool to get the blending buffers from
 
         The given width and height must be the same as that of the video image.
         """
@@ -47,9 +280,15 @@ class Crosshair(object):
         self.thick = confVals['thickness']
         self.alpha = confVals['alpha']
         self.highlightColor = confVals['highlightColor']
-        self.adjustments = adjustments
+        self.pool = pool if pool else FramePool(width, height)
+        self.bands = None
         if not self._validate():
             raise ValueError
+        if registry:
+            registry.subscribe(['alpha'], self._paramChanged)
+
+    def _paramChanged(self, name, value):
+        self.alpha = value
 
     def _validate(self):
         if self.width < 0 or self.width > MAX_VIDEO_WIDTH:
@@ -72,25 +311,38 @@ class Crosshair(object):
             return False
         return True
 
-    def _render(self, img, hiliteH=False, hiliteV=False):
-        hStart = (0, (self.height / 2))
-        hEnd = (self.width, (self.height / 2))
-        vStart = ((self.width / 2), 0)
-        vEnd = ((self.width / 2), self.height)
-
-        if hiliteH:
-            color = self.highlightColor
-        else:
-            color = self.color
-        cv2.line(img, hStart, hEnd, color, self.thick)
-
-        if hiliteV:
-            color = self.highlightColor
-        else:
-            color = self.color
-        cv2.line(img, vStart, vEnd, color, self.thick)
+    def _render(self, img, hColor, vColor):
+        hStart = (0, (self.height // 2))
+        hEnd = (self.width, (self.height // 2))
+        vStart = ((self.width // 2), 0)
+        vEnd = ((self.width // 2), self.height)
+        cv2.line(img, hStart, hEnd, hColor, self.thick)
+        cv2.line(img, vStart, vEnd, vColor, self.thick)
         return img
 
+    def _build(self):
+        # render the lines (and their mask), and cache the bands they're in
+        lines = np.zeros((self.height, self.width, 3), np.uint8)
+        self._render(lines,
+                     self.highlightColor if self.hiH else self.color,
+                     self.highlightColor if self.hiV else self.color)
+        # N.B. the mask is drawn separately, as the lines may be black
+        mask = np.zeros((self.height, self.width), np.uint8)
+        self._render(mask, 255, 255)
+        mask = mask.astype(np.bool_)
+        rows = np.flatnonzero(mask[:, 0])
+        cols = np.flatnonzero(mask[0, :])
+        r0, r1 = rows[0], rows[-1] + 1
+        c0, c1 = cols[0], cols[-1] + 1
+        self.bands = []
+        for rs, cs in ((slice(r0, r1), slice(0, self.width)),
+                       (slice(0, r0), slice(c0, c1)),
+                       (slice(r1, self.height), slice(c0, c1))):
+            if rs.start >= rs.stop:
+                continue
+            self.bands.append((rs, cs, lines[rs, cs].copy(),
+                               mask[rs, cs, np.newaxis].copy()))
+
     def setHighlightH(self, val):
         """
         Turn highlight on/off for horizontal line of crosshair.
@@ -99,7 +351,9 @@ class Crosshair(object):
         """
         if not isinstance(val, bool):
             raise ValueError
-        self.hiH = val
+        if val != self.hiH:
+            self.hiH = val
+            self.bands = None
 
     def setHighlightV(self, val):
         """
@@ -109,7 +363,9 @@ class Crosshair(object):
         """
         if not isinstance(val, bool):
             raise ValueError
-        self.hiV = val
+        if val != self.hiV:
+            self.hiV = val
+            self.bands = None
 
     def overlay(self, img):
         """
@@ -117,10 +373,15 @@ class Crosshair(object):
 
         @param img Image onto which crosshair is overlayed
         """
-        ovrly = self._render(img.copy(), self.hiH, self.hiV)
-        if self.adjustments:
-            self.alpha = (cv2.getTrackbarPos('alpha', 'view') / 100.0)
-        cv2.addWeighted(ovrly, self.alpha, img, (1.0 - self.alpha), 0, img)
+        if self.bands is None:
+            self._build()
+        for i, (rows, cols, lines, mask) in enumerate(self.bands):
+            dst = img[rows, cols]
+            blend = self.pool.get("crosshair{0}".format(i), dst.shape,
+                                  dst.dtype)
+            cv2.addWeighted(lines, self.alpha, dst, (1.0 - self.alpha), 0,
+                            blend)
+            np.copyto(dst, blend, where=mask)
 
 
 class OnScreenDisplay(object):
@@ -214,9 +475,19 @@ class OnScreenDisplay(object):
 
 class Measurement(object):
     def __init__(self, width, height, calData):
+        """
+        Instantiate Measurement object.
+
+        @param width Width of image in pixels
+        @param height Height of image in pixels
+        @param calData Calibration dict (or None) -- 'mmPerPixel' is the
+         camera scale, and 'cameraOffset' is the (x, y) offset in mm of the
+         image center from the machine position
+        """
         self.deltaX = None    # distance to X axis in mm (float)
         self.deltaY = None    # distance to Y axis in mm (float)
         self.distance = None  # distance to origin in mm (float)
+        self.workspace = None  # (x, y) workspace position in mm (floats)
 
         self.width = width    # width of image in pixels (int)
         self.height = height  # height of image in pixels (int)
@@ -225,16 +496,34 @@ class Measurement(object):
         self.originY = (height / 2)  # vertical center of image in pixels (int)
 
         self.calib = calData
+        self.mmPerPixel = None
+        self.cameraOffset = (0.0, 0.0)
+        if calData:
+            self.mmPerPixel = calData.get('mmPerPixel')
+            self.cameraOffset = tuple(calData.get('cameraOffset', (0.0, 0.0)))
 
     def getValues(self):
         return self.deltaX, self.deltaY, self.distance
 
     # take x/y in pixel coordinates and save distances
-    def setValues(self, x, y):
+    #  (and the workspace position, given the work position -- i.e., the
+    #  machine position less the work offset -- at the time the frame was
+    #  exposed)
+    def setValues(self, x, y, workPos=None):
         #### FIXME compute distances in mm (using calibration)
         self.deltaX = (x - self.originX)
         self.deltaY = (self.originY - y)
         self.distance = math.sqrt(self.deltaX**2 + self.deltaY**2)
+        self.workspace = None
+        if workPos is not None and self.mmPerPixel:
+            self.workspace = (
+                workPos[0] + self.cameraOffset[0] +
+                (self.deltaX * self.mmPerPixel),
+                workPos[1] + self.cameraOffset[1] +
+                (self.deltaY * self.mmPerPixel))
+
+    def getWorkspace(self):
+        return self.workspace
 
     def getDeltaX(self):
         return self.deltaX
@@ -246,15 +535,621 @@ class Measurement(object):
         return self.distance
 
 
+class TargetLocator(object):
+    """
+    Finds a target (e.g., a home-position decal or a drill hole) in a frame
+     by coarse-to-fine template matching.
+
+    The template is first matched against a small (downscaled) pyramid level
+     of the whole frame, and the match is then refined by matching at full
+     resolution in a small window around the coarse location, with subpixel
+     interpolation of the correlation peak.
+    """
+    MIN_TEMPLATE_SIZE = 12  # smallest template dimension at the coarse level
+
+    def __init__(self, template, levels=None, margin=None, minScore=0.5,
+                 pool=None):
+        """
+        Instantiate TargetLocator object.
+
+        @param template Image of the target (grayscale or BGR)
+        @param levels Number of pyramid levels to go down for the coarse
+         search (defaults to as many as the template size allows)
+        @param margin Refinement window margin in (full resolution) pixels
+         (defaults to two coarse pixels)
+        @param minScore Minimum normalized correlation score for a match
+        @param pool FramePool to get the pyramid buffers from
+        """
+        if template.ndim == 3:
+            template = cv2.cvtColor(template, cv2.COLOR_BGR2GRAY)
+        if levels is None:
+            levels = 0
+            size = min(template.shape[:2])
+            while (size // 2) >= TargetLocator.MIN_TEMPLATE_SIZE:
+                size //= 2
+                levels += 1
+        self.levels = levels
+        self.margin = margin if margin else (2 * (2 ** levels))
+        self.minScore = minScore
+        self.pool = pool
+        self.templates = [template]
+        for i in range(levels):
+            self.templates.append(cv2.pyrDown(self.templates[-1]))
+        self.height, self.width = template.shape[:2]
+
+    def _buffer(self, name, shape):
+        if self.pool is None:
+            self.pool = FramePool(shape[1], shape[0])
+        return self.pool.get(name, shape)
+
+    @staticmethod
+    def _subpixel(scores, x, y):
+        # fit a parabola through the peak and its neighbors, in each axis
+        dx = dy = 0.0
+        h, w = scores.shape[:2]
+        if 0 < x < (w - 1):
+            l, c, r = scores[y, x - 1], scores[y, x], scores[y, x + 1]
+            denom = (l - (2.0 * c)) + r
+            if denom < 0.0:
+                dx = 0.5 * (l - r) / denom
+        if 0 < y < (h - 1):
+            t, c, b = scores[y - 1, x], scores[y, x], scores[y + 1, x]
+            denom = (t - (2.0 * c)) + b
+            if denom < 0.0:
+                dy = 0.5 * (t - b) / denom
+        return (x + dx), (y + dy)
+
+    def locate(self, img, ctx=None):
+        """
+        Find the target in a frame.
+
+        @param img Frame to search (grayscale or BGR)
+        @param ctx FrameContext of the frame (to share its grayscale image and
+         pyramid levels with the other stages), or None
+
+        Returns ((x, y), score) -- where (x, y) is the (subpixel) location of
+         the center of the target -- or None if the target wasn't found.
+        """
+        if ctx is not None:
+            gray = ctx.gray()
+        elif img.ndim == 3:
+            gray = self._buffer('locGray', img.shape[:2])
+            cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=gray)
+        else:
+            gray = img
+
+        # coarse search over the whole (downscaled) frame
+        if ctx is not None:
+            level = ctx.level(self.levels)
+        else:
+            level = gray
+            for i in range(self.levels):
+                shape = (((level.shape[0] + 1) // 2),
+                         ((level.shape[1] + 1) // 2))
+                down = self._buffer("locLevel{0}".format(i + 1), shape)
+                cv2.pyrDown(level, dst=down)
+                level = down
+        scores = cv2.matchTemplate(level, self.templates[self.levels],
+                                   cv2.TM_CCOEFF_NORMED)
+        _, score, _, (cx, cy) = cv2.minMaxLoc(scores)
+        scale = 2 ** self.levels
+
+        # refine at full resolution, in a small window around the coarse match
+        x0 = max((cx * scale) - self.margin, 0)
+        y0 = max((cy * scale) - self.margin, 0)
+        x1 = min((cx * scale) + self.margin + self.width, gray.shape[1])
+        y1 = min((cy * scale) + self.margin + self.height, gray.shape[0])
+        if (x1 - x0) < self.width or (y1 - y0) < self.height:
+            return None
+        scores = cv2.matchTemplate(gray[y0:y1, x0:x1], self.templates[0],
+                                   cv2.TM_CCOEFF_NORMED)
+        _, score, _, (fx, fy) = cv2.minMaxLoc(scores)
+        if score < self.minScore:
+            return None
+        fx, fy = TargetLocator._subpixel(scores, fx, fy)
+        x = x0 + fx + ((self.width - 1) / 2.0)
+        y = y0 + fy + ((self.height - 1) / 2.0)
+        return (x, y), score
+
+    def measure(self, img, measurement, ctx=None):
+        """
+        Find the target and set its offset from the crosshair origin in the
+         given Measurement object.
+
+        @param ctx FrameContext of the frame, or None
+
+        Returns the Measurement's (deltaX, deltaY, distance) values, or None
+         if the target wasn't found.
+        """
+        loc = self.locate(img, ctx)
+        if loc is None:
+            return None
+        (x, y), score = loc
+        measurement.setValues(x, y)
+        return measurement.getValues()
+
+
+class ToolpathOverlay(object):
+    """
+    Draws the planned toolpath of a job over the camera view.
+
+    The job's polylines are split into short chunks, and the chunks' bounding
+     boxes are used as a segment index, so only the chunks that are visible
+     in the current view get transformed and drawn (with a single, batched
+     polylines call per type of move).
+    """
+    DEF_CHUNK_SIZE = 32         # segments per indexed chunk
+    DEF_COLOR = (255, 0, 255)   # feed moves
+    DEF_RAPID_COLOR = (128, 128, 128)
+    SHIFT = 4                   # fractional bits of the drawn points
+
+    def __init__(self, paths, width, height, calData, color=DEF_COLOR,
+                 rapidColor=DEF_RAPID_COLOR, thickness=1,
+                 chunkSize=DEF_CHUNK_SIZE):
+        """
+        Instantiate ToolpathOverlay object.
+
+        @param paths List of (rapid, points) polylines in work coordinates
+         (as returned by gcode.toolpath())
+        @param width Width of image in pixels
+        @param height Height of image in pixels
+        @param calData Calibration dict (see Measurement)
+        @param color Color of feed moves (or None to not draw them)
+        @param rapidColor Color of rapid moves (or None to not draw them)
+        @param thickness Line thickness in pixels
+        @param chunkSize Number of segments in each indexed chunk
+        """
+        if not calData or not calData.get('mmPerPixel'):
+            logging.error("Toolpath overlay requires a camera scale")
+            raise ValueError
+        self.mmPerPixel = calData['mmPerPixel']
+        self.cameraOffset = tuple(calData.get('cameraOffset', (0.0, 0.0)))
+        self.width = width
+        self.height = height
+        self.thickness = thickness
+        self.colors = (color, rapidColor)
+        self.chunks = ([], [])   # X/Y point arrays, for feeds and rapids
+
+        for rapid, points in paths:
+            n = len(points) - 1
+            for i in range(0, n, chunkSize):
+                chunk = points[i:(i + chunkSize + 1), :2]
+                self.chunks[int(bool(rapid))].append(chunk)
+        self.bounds = tuple(
+            np.array([np.concatenate((c.min(axis=0), c.max(axis=0)))
+                      for c in chunks], np.float32).reshape(-1, 4)
+            for chunks in self.chunks)
+        self.visible = [0, 0]   # number of chunks drawn in the last frame
+
+    def _view(self, machinePos, workOffset):
+        # work (mm) coordinates of the image's center, and half its size
+        cx = machinePos[0] - workOffset[0] + self.cameraOffset[0]
+        cy = machinePos[1] - workOffset[1] + self.cameraOffset[1]
+        hw = (self.width / 2.0) * self.mmPerPixel
+        hh = (self.height / 2.0) * self.mmPerPixel
+        return cx, cy, hw, hh
+
+    def overlay(self, img, machinePos, workOffset):
+        """
+        Draw the toolpath on an image taken at the given machine position.
+
+        @param workOffset (x, y, z) work coordinate offset (machine position
+         minus work position), which places the job on the machine
+        """
+        cx, cy, hw, hh = self._view(machinePos, workOffset)
+        scale = (1 << self.SHIFT) / self.mmPerPixel
+        for i, (chunks, bounds) in enumerate(zip(self.chunks, self.bounds)):
+            self.visible[i] = 0
+            if self.colors[i] is None or not len(bounds):
+                continue
+            # cull the chunks whose bounding boxes are outside the view
+            hit = np.flatnonzero((bounds[:, 0] <= (cx + hw)) &
+                                 (bounds[:, 2] >= (cx - hw)) &
+                                 (bounds[:, 1] <= (cy + hh)) &
+                                 (bounds[:, 3] >= (cy - hh)))
+            if not len(hit):
+                continue
+            self.visible[i] = len(hit)
+            # transform the visible points to (fixed-point) pixel coordinates
+            pts = np.concatenate([chunks[n] for n in hit])
+            lengths = [len(chunks[n]) for n in hit]
+            pix = np.empty(pts.shape, np.int32)
+            pix[:, 0] = ((pts[:, 0] - cx + hw) * scale).astype(np.int32)
+            pix[:, 1] = ((cy + hh - pts[:, 1]) * scale).astype(np.int32)
+            polys = np.split(pix, np.cumsum(lengths)[:-1])
+            cv2.polylines(img, polys, False, self.colors[i], self.thickness,
+                          cv2.LINE_AA, self.SHIFT)
+        return img
+
+
+class ChangeDetector(object):
+    """
+    Cheap detector of whether the scene has changed since the last frame that
+     was fully processed.
+
+    Frames are reduced to small thumbnails (each pixel is the average of a
+     block of the frame), and the scene counts as changed when enough blocks
+     differ from the reference thumbnail by more than the noise threshold.
+    The reference is only updated when a change is detected, so slow drift
+     accumulates until it's noticed.
+    """
+    DEF_THUMB_SIZE = (80, 60)
+    DEF_NOISE_THRESHOLD = 8     # per-block gray level difference
+    DEF_MIN_BLOCKS = 3          # changed blocks needed for a scene change
+    DEF_REFRESH_INTERVAL = 150  # frames between forced refreshes
+
+    IDLE_STATES = ("Idle", "Hold", "Door", "Alarm")
+
+    def __init__(self, thumbSize=DEF_THUMB_SIZE,
+                 threshold=DEF_NOISE_THRESHOLD, minBlocks=DEF_MIN_BLOCKS,
+                 refresh=DEF_REFRESH_INTERVAL):
+        """
+        Instantiate ChangeDetector object.
+
+        @param thumbSize (width, height) of the thumbnails that are compared
+        @param threshold Gray level difference of a block that's a change
+        @param minBlocks Number of changed blocks that's a scene change
+        @param refresh Max number of frames between (forced) changes
+        """
+        self.thumbSize = tuple(thumbSize)
+        self.threshold = threshold
+        self.minBlocks = minBlocks
+        self.refresh = refresh
+        shape = (self.thumbSize[1], self.thumbSize[0])
+        self.thumbBGR = np.empty(shape + (3,), np.uint8)
+        self.thumb = np.empty(shape, np.uint8)
+        self.reference = np.empty(shape, np.uint8)
+        self.diff = np.empty(shape, np.uint8)
+        self.valid = False
+        self.machineIdle = True
+        self.sinceChange = 0
+        self.frames = 0
+        self.changes = 0
+
+    def setMachineState(self, state):
+        """
+        Hint from the machine side -- the scene can't be static while the
+         machine is moving.
+
+        @param state GRBL machine state (e.g., 'Idle', 'Run', 'Jog'), or None
+         if unknown
+        """
+        self.machineIdle = (state is None) or (state in self.IDLE_STATES)
+
+    def changed(self, img):
+        """
+        Return True if the scene in the given (BGR or gray) frame has changed,
+         and the frame needs to be processed.
+        """
+        self.frames += 1
+        self.sinceChange += 1
+        if img.ndim == 2:
+            cv2.resize(img, self.thumbSize, dst=self.thumb,
+                       interpolation=cv2.INTER_AREA)
+        else:
+            cv2.resize(img, self.thumbSize, dst=self.thumbBGR,
+                       interpolation=cv2.INTER_AREA)
+            cv2.cvtColor(self.thumbBGR, cv2.COLOR_BGR2GRAY, dst=self.thumb)
+        change = (not self.valid) or (not self.machineIdle) or \
+            (self.sinceChange >= self.refresh)
+        if not change:
+            cv2.absdiff(self.thumb, self.reference, dst=self.diff)
+            change = cv2.countNonZero(
+                cv2.compare(self.diff, self.threshold, cv2.CMP_GT)) >= \
+                self.minBlocks
+        if change:
+            self.reference, self.thumb = self.thumb, self.reference
+            self.valid = True
+            self.sinceChange = 0
+            self.changes += 1
+        return change
+
+
+def detectLines(gray, params):
+    """
+    Find straight line segments in a grayscale image.
+
+    Returns an Nx4 array of (x1, y1, x2, y2) segment end points.
+    """
+    edges = cv2.Canny(gray, params['thrs1'], params['thrs2'], apertureSize=5)
+    lines = cv2.HoughLinesP(edges, 1, np.pi / 180, 2, None, 30, 1)
+    if lines is None:
+        return np.zeros((0, 4), np.int32)
+    return lines.reshape(-1, 4)
+
+
+def detectCorners(gray, params, grayF=None):
+    """
+    Find corners in a grayscale image with the Harris detector.
+
+    @param grayF Float32 copy of the image (if one's already been made)
+
+    Returns an Nx2 array of (x, y) corner locations -- one for each blob of
+     pixels with a strong corner response.
+    """
+    if grayF is None:
+        grayF = np.float32(gray)
+    kSize = min(max(params['kernelSize'] | 1, 3), 31)
+    resp = cv2.cornerHarris(grayF, max(params['blkSize'], 2),
+                            kSize, (params['kVal'] / 100.0))
+    mask = np.uint8(resp > (0.01 * resp.max()))
+    n, labels, stats, centroids = cv2.connectedComponentsWithStats(mask)
+    return centroids[1:].astype(np.float32)
+
+
+def detectCircles(gray, params, blurred=None):
+    """
+    Find circles (e.g., drill holes) in a grayscale image.
+
+    @param blurred Median-blurred copy of the image (see blurForCircles()),
+     if one's already been made
+
+    Returns an Nx3 array of (x, y, radius) circles.
+    """
+    if blurred is None:
+        blurred = blurForCircles(gray)
+    minDist = max(min(gray.shape[:2]) // 8, 1)
+    circles = cv2.HoughCircles(blurred, cv2.HOUGH_GRADIENT, 1.2, minDist,
+                               param1=100, param2=params['circThrs'],
+                               minRadius=params['minRadius'],
+                               maxRadius=params['maxRadius'])
+    if circles is None:
+        return np.zeros((0, 3), np.float32)
+    return circles.reshape(-1, 3)
+
+
+def blurForCircles(gray, dst=None):
+    """
+    Return the median-blurred image that detectCircles() works on.
+    """
+    return cv2.medianBlur(gray, 5, dst=dst)
+
+
+# Map of detector names to detector functions
+DETECTORS = {
+    'lines': detectLines,
+    'corners': detectCorners,
+    'circles': detectCircles
+}
+
+# Derived images (see FrameContext.derived()) that detectors can be given,
+#  as (keyword argument, kind of derived image)
+DETECTOR_INPUTS = {
+    'corners': ('grayF', 'float'),
+    'circles': ('blurred', 'median')
+}
+
+
+def scaleFeatures(features, scale, offset):
+    """
+    Map detector results from a scaled/cropped image back to the full frame.
+
+    @param features Dict of detector results (see runDetectors())
+    @param scale Scale factor the image was processed at
+    @param offset (x, y) offset of the processed region in the full frame
+    """
+    if scale >= 1.0 and offset == (0, 0):
+        return features
+    ox, oy = offset
+    out = {}
+    for name, feats in features.items():
+        feats = feats.astype(np.float32) / scale
+        if name == 'lines':
+            feats += np.float32([ox, oy, ox, oy])
+        else:
+            feats[:, 0] += ox
+            feats[:, 1] += oy
+        out[name] = feats
+    return out
+
+
+def featureAnchors(name, feats):
+    """
+    Return the (x, y) point that stands for each of a detector's results --
+     a corner's location, a circle's center, or a line's midpoint -- as an
+     Nx2 array.
+    """
+    feats = np.asarray(feats, np.float32)
+    if name == 'lines':
+        return (feats[:, 0:2] + feats[:, 2:4]) * 0.5
+    return feats[:, 0:2]
+
+
+def nearestFeature(features, x, y):
+    """
+    Find the detected feature nearest to a point.
+
+    @param features Dict of detector results (see runDetectors())
+
+    Returns a tuple of the feature's detector name, index, and (x, y) anchor
+     point, or None if there are no features.
+    """
+    best, bestDist = None, None
+    for name, feats in (features or {}).items():
+        if name not in DETECTORS or not len(feats):
+            continue
+        anchors = featureAnchors(name, feats)
+        dists = np.sum((anchors - np.float32([x, y])) ** 2, axis=1)
+        i = int(np.argmin(dists))
+        if bestDist is None or dists[i] < bestDist:
+            best = (name, i, tuple(float(v) for v in anchors[i]))
+            bestDist = dists[i]
+    return best
+
+
+def runDetectors(gray, detectors, params, derived=None):
+    """
+    Run the named detectors on a grayscale image.
+
+    @param derived Function that returns a derived copy of the image, given
+     its kind (e.g., FrameContext.derived()), or None
+
+    Returns a dict with the results of each detector, keyed by its name.
+    """
+    if derived is None:
+        return {name: DETECTORS[name](gray, params) for name in detectors}
+    results = {}
+    for name in detectors:
+        if name in DETECTOR_INPUTS:
+            arg, kind = DETECTOR_INPUTS[name]
+            results[name] = DETECTORS[name](gray, params,
+                                            **{arg: derived(kind)})
+        else:
+            results[name] = DETECTORS[name](gray, params)
+    return results
+
+
 # Object that encapsulates all video processing to be done on the given
 #  input video image stream.
 class VideoProcessing(object):
-    def __init__(self):
-        pass
+    def __init__(self, detectors=None, params=None, workers=0, slots=None,
+                 pool=None, sched=None, changes=None, registry=None,
+                 tracker=None):
+        """
+        Instantiate VideoProcessing object.
+
+        @param detectors List of names of feature detectors to run
+        @param params Dict of detector parameters (see DEF_DETECTOR_PARAMS)
+        @param workers Number of worker processes to run the detectors in
+         (0 runs them inline, in the frame loop)
+        @param slots Number of shared-memory frame slots for the workers
+        @param pool FramePool to get the intermediate image buffers from
+        @param sched FrameScheduler that sets the quality/rate of the focus
+         and detector stages (None runs them at full quality on every frame)
+        @param changes ChangeDetector used to skip processing (and reuse the
+         previous results) when the scene hasn't changed
+        @param registry ParameterRegistry to take (run-time) detector parameter
+         changes from
+        @param tracker FeatureTracker that follows the features between
+         keyframes, so the detectors only run on the keyframes
+
+        With worker processes, detector results arrive asynchronously, some
+         frames later -- the 'features' output has the id of the frame that
+         the results came from. The same goes for frames where the scheduler
+         skips detection.
+        N.B. With worker processes, the scheduler only sets the detector rate,
+         as the shared-memory slots are a fixed size, and the tracker isn't
+         used, as the results arrive after the frames have moved on.
+        """
+        self.detectors = list(detectors) if detectors else []
+        for name in self.detectors:
+            if name not in DETECTORS:
+                logging.error("Invalid feature detector: %s", name)
+                raise ValueError
+        self.params = dict(DEF_DETECTOR_PARAMS)
+        if params:
+            self.params.update(params)
+        self.workers = workers
+        self.slots = slots
+        self.workerPool = None
+        self.framePool = pool
+        self.scheduler = sched
+        self.changes = changes
+        self.tracker = tracker
+        if tracker and workers:
+            logging.warning("Feature tracking is disabled with worker "
+                            "processes")
+            self.tracker = None
+        self.frameId = 0
+        self.context = None
+        self.features = None
+        self.variance = None
+        self.output = None
+        if registry:
+            names = [n for n in DEF_DETECTOR_PARAMS if n in registry.params]
+            self.params.update(registry.values(names))
+            registry.subscribe(names, self._paramChanged)
+
+    def _paramChanged(self, name, value):
+        self.params[name] = value
+        if self.tracker:
+            self.tracker.invalidate()
+
+    def close(self):
+        if self.workerPool:
+            self.workerPool.close()
+            self.workerPool = None
+
+    def _focus(self, ctx):
+        gray = ctx.gray()
+        quality = None
+        if self.scheduler:
+            quality = self.scheduler.plan('focus', self.frameId)
+            if quality is None:
+                return self.variance
+            gray, offset = ctx.prepared(quality, 'focusGray')
+            start = monotonic()
+
+        # N.B. meanStdDev() avoids the full-frame temporaries of ndarray.var()
+        lap = self.framePool.get('laplacian', gray.shape, np.float64)
+        cv2.Laplacian(gray, cv2.CV_64F, dst=lap)
+        self.variance = cv2.meanStdDev(lap)[1][0][0] ** 2
+
+        if quality:
+            self.scheduler.done('focus', monotonic() - start, self.variance)
+        return self.variance
+
+    def _detect(self, ctx):
+        gray = ctx.gray()
+        # between keyframes, follow the features instead of detecting them
+        if self.tracker and self.tracker.track(gray, self.params):
+            self.features = self.tracker.getFeatures(self.frameId)
+            return
+        fullGray = gray
+        quality = None
+        if self.scheduler:
+            quality = self.scheduler.plan('detect', self.frameId)
+            if quality is None:
+                return
+            start = monotonic()
+        if not self.workers:
+            offset, scale = (0, 0), 1.0
+            if quality:
+                gray, offset = ctx.prepared(quality, 'detectGray')
+                scale = quality.scale
+            features = runDetectors(gray, self.detectors, self.params,
+                                    lambda kind: ctx.derived(kind, quality))
+            self.features = scaleFeatures(features, scale, offset)
+            self.features['frameId'] = self.frameId
+            if self.tracker:
+                self.tracker.keyframe(fullGray, self.features)
+            if quality:
+                self.scheduler.done('detect', monotonic() - start,
+                                    self.features)
+            return
+        if self.workerPool is None:
+            import workers
+            height, width = gray.shape[:2]
+            self.workerPool = workers.DetectorPool(width, height, self.workers,
+                                                   self.slots)
+        self.workerPool.submit(gray, self.frameId, self.detectors, self.params)
+        for frameId, features in self.workerPool.collect():
+            if self.features is None or frameId > self.features['frameId']:
+                features['frameId'] = frameId
+                self.features = features
+        if quality:
+            self.scheduler.done('detect', monotonic() - start, self.features)
+
+    def processFrame(self, img, ctx=None):
+        """
+        Process a frame.
 
-    def processFrame(self, img):
+        @param img Frame (BGR) to process
+        @param ctx FrameContext (already reset to this frame) to share the
+         derived images with the caller's other stages, or None
+        """
         #### TODO run img through camera calibration correction matrix
+        self.frameId += 1
+        if self.changes and self.output is not None and \
+           not self.changes.changed(img):
+            # static scene, so reuse the last frame's results
+            output = dict(self.output)
+            output['frameId'] = self.frameId
+            output['reused'] = True
+            return output
         output = {}
+        output['frameId'] = self.frameId
+        output['reused'] = False
 
         #### Detection Pipeline:
         ####  * cvt2gray
@@ -264,9 +1159,21 @@ class VideoProcessing(object):
         ####  * cvFindContours
         ####  * cvApproxPoly
 
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        height, width = img.shape[:2]
+        if self.framePool is None:
+            self.framePool = FramePool(width, height)
+        if ctx is None:
+            if self.context is None:
+                self.context = FrameContext(self.framePool)
+            ctx = self.context
+            ctx.reset(img, self.frameId)
+
+        output['variance'] = self._focus(ctx)
 
-        output['variance'] = cv2.Laplacian(gray, cv2.CV_64F).var()
+        if self.detectors:
+            self._detect(ctx)
+            output['features'] = self.features
+        self.output = output
 
         """
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
@@ -348,13 +1255,59 @@ class VideoProcessing(object):
         """
         return output
 
-    def getNearestFeature(self, x, y):
-        #### TODO implement this
-        return x, y
+    def getNearestFeature(self, x, y, lock=False):
+        """
+        Return the (x, y) location of the feature nearest to a point (or the
+         point itself, if there are no features).
+
+        @param lock If True (and there's a tracker), lock onto the feature, so
+         that it's followed from frame to frame (see getLockedFeature())
+        """
+        if lock and self.tracker:
+            pos = self.tracker.lockNearest(x, y)
+        else:
+            found = nearestFeature(self.features, x, y)
+            pos = found[2] if found else None
+        return (x, y) if pos is None else pos
+
+    def unlockFeature(self):
+        if self.tracker:
+            self.tracker.unlock()
+
+    def getLockedFeature(self):
+        """
+        Return the current (x, y) location of the locked feature, or None if
+         no feature is locked (or it's been lost).
+        """
+        return self.tracker.lockedPosition() if self.tracker else None
 
 
 #
 # TEST
 #
 if __name__ == '__main__':
-    print("TBD")
+    import benchmark
+
+    # a frame's stages -- focus, detection, and target location -- with and
+    #  without a shared FrameContext
+    width, height = 1920, 1080
+    img = benchmark.drawTarget(benchmark.syntheticFrame(width, height),
+                               width * 0.4, height * 0.6)
+    template = benchmark.targetTemplate()
+    numFrames = 20
+    for shared in (False, True):
+        pool = FramePool(width, height)
+        vidProc = VideoProcessing(['corners', 'circles'], pool=pool)
+        locator = TargetLocator(template, pool=pool)
+        ctx = FrameContext(pool) if shared else None
+        start = monotonic()
+        for i in range(numFrames):
+            if ctx:
+                ctx.reset(img, i)
+            vidProc.processFrame(img, ctx)
+            loc = locator.locate(img, ctx)
+        elapsed = (monotonic() - start) / numFrames
+        print("{0}: {1:.2f} msec/frame, target at {2}".format(
+            "Shared context" if shared else "Separate", elapsed * 1000.0,
+            loc[0]))
+    print("Context stats: {0}".format(ctx.getStats()))
@@ -0,0 +1,176 @@
+"""X-Carve Microscope Tool Feature Detector Worker Processes -- Library"""
+
+import ctypes
+import logging
+import multiprocessing
+from Queue import Empty
+
+import cv2
+import numpy as np
+
+import video
+
+
+'''
+DESIGN NOTES:
+  * The heavy detectors run in separate processes, so they can use all of
+    the cores without contending for the GIL.
+  * Frames are passed through a ring of shared-memory slots -- the frame loop
+    copies each (grayscale) frame into a free slot and only the slot index,
+    frame id, and detector parameters go through the task queue. Frame data
+    is never pickled.
+  * A slot is owned by a worker until its results come back, so if all the
+    slots are busy the frame just isn't submitted for detection (i.e., the
+    display loop never waits on the workers).
+'''
+
+DEF_NUM_WORKERS = max(multiprocessing.cpu_count() - 1, 1)
+
+
+def _detectorWorker(shared, shape, tasks, results):
+    """
+    Worker process main loop -- run detectors on frames in shared memory.
+
+    Each task is a tuple of (slot, frameId, detectors, params), and a None
+     task tells the worker to exit.
+    """
+    # parallelism comes from the processes, so don't oversubscribe the cores
+    cv2.setNumThreads(1)
+    frames = np.frombuffer(shared, dtype=np.uint8).reshape(shape)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        slot, frameId, detectors, params = task
+        try:
+            features = video.runDetectors(frames[slot], detectors, params)
+        except Exception as e:
+            logging.error("Detector failed on frame %d: %s", frameId, e)
+            features = None
+        results.put((slot, frameId, features))
+
+
+class DetectorPool(object):
+    """
+    Pool of worker processes that run feature detectors on frames passed
+     through shared-memory slots.
+    """
+    def __init__(self, width, height, numWorkers=DEF_NUM_WORKERS,
+                 numSlots=None):
+        """
+        Instantiate DetectorPool object.
+
+        @param width Width of (grayscale) frames in pixels
+        @param height Height of (grayscale) frames in pixels
+        @param numWorkers Number of worker processes
+        @param numSlots Number of shared-memory frame slots (defaults to two
+         per worker, so each worker always has a frame queued up)
+        """
+        self.procs = []
+        if numWorkers < 1:
+            logging.error("Invalid number of workers: %d", numWorkers)
+            raise ValueError
+        if numSlots is None:
+            numSlots = 2 * numWorkers
+        self.shape = (numSlots, height, width)
+        self.shared = multiprocessing.RawArray(ctypes.c_uint8,
+                                               numSlots * height * width)
+        self.frames = np.frombuffer(self.shared,
+                                    dtype=np.uint8).reshape(self.shape)
+        self.free = list(range(numSlots))
+        self.tasks = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.submitted = 0
+        self.skipped = 0
+        for i in range(numWorkers):
+            proc = multiprocessing.Process(target=_detectorWorker,
+                                           args=(self.shared, self.shape,
+                                                 self.tasks, self.results))
+            proc.daemon = True
+            proc.start()
+            self.procs.append(proc)
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Shut down the worker processes.
+        """
+        for proc in self.procs:
+            self.tasks.put(None)
+        for proc in self.procs:
+            proc.join(1.0)
+            if proc.is_alive():
+                proc.terminate()
+        self.procs = []
+
+    def pending(self):
+        """
+        Return the number of frames that are waiting for results.
+        """
+        return self.shape[0] - len(self.free)
+
+    def submit(self, gray, frameId, detectors, params):
+        """
+        Queue a grayscale frame for detection, if there's a free slot.
+
+        @param gray Grayscale frame (must be the size the pool was made for)
+        @param frameId Id returned with the results for this frame
+        @param detectors List of names of detectors to run
+        @param params Dict of detector parameters
+
+        Returns True if the frame was queued, False if it was skipped.
+        """
+        if not self.free:
+            self.skipped += 1
+            return False
+        slot = self.free.pop()
+        np.copyto(self.frames[slot], gray)
+        self.tasks.put((slot, frameId, detectors, params))
+        self.submitted += 1
+        return True
+
+    def collect(self, timeout=None):
+        """
+        Return a list of (frameId, features) tuples for all finished frames.
+
+        @param timeout Secs to wait for at least one result (None returns
+         immediately)
+        """
+        done = []
+        block = timeout is not None
+        while True:
+            try:
+                slot, frameId, features = self.results.get(block, timeout)
+            except Empty:
+                break
+            block = False
+            self.free.append(slot)
+            if features is not None:
+                done.append((frameId, features))
+        return done
+
+
+#
+# TEST
+#
+if __name__ == '__main__':
+    import time
+
+    import benchmark
+
+    img = benchmark.syntheticFrame(800, 600)
+    gray = np.ascontiguousarray(img[:, :, 0])
+    pool = DetectorPool(800, 600, 2)
+    params = dict(video.DEF_DETECTOR_PARAMS)
+    for frameId in range(8):
+        pool.submit(gray, frameId, ["lines", "corners", "circles"], params)
+    results = []
+    start = time.time()
+    while len(results) < pool.submitted and (time.time() - start) < 30.0:
+        results += pool.collect(1.0)
+    for frameId, features in sorted(results, key=lambda r: r[0]):
+        print("Frame {0}: {1}".format(frameId, {k: len(v) for k, v in
+                                               features.items()}))
+    pool.close()
@@ -1,14 +1,33 @@
 """X-Carve GRBL Device Interface -- Library"""
 
 import logging
+import re
+import time
 
-from grbl import GrblDevice
+import numpy as np
+
+import grbl_status
+from grbl import GrblDevice, GRBL_RX_BUFFER_SIZE
+from util import monotonic
 
 # X-Carve travel limits (in mm)
 MAX_X = 260.00
 MAX_Y = 260.00
 MAX_Z = 100.00
 
+DEF_IDLE_TIMEOUT = 60.0     # max secs to wait for a move to finish
+DEF_POLL_INTERVAL = 0.05    # secs between status polls
+
+DEF_PROBE_FEED = 100.0      # probing feed rate (mm/min)
+DEF_PROBE_CLEARANCE = 2.0   # mm above the last contact to move between points
+DEF_PROBE_TIMEOUT = 60.0    # max secs for a single probe cycle
+DEF_PROBE_MIN_TRAVEL = 0.1  # min mm a probe must travel before contact
+DEF_WCO_POLLS = 32          # max status polls to get a work offset
+
+# Contact position and success flag from a probe cycle's report
+PROBE_PATTERN = re.compile(
+    r"^\[PRB:([-.0-9]+),([-.0-9]+),([-.0-9]+):([01])\]")
+
 
 class XCarve(GrblDevice):
     def __init__(self, config):
@@ -22,26 +41,315 @@ class XCarve(GrblDevice):
             logging.error("Must provide serial device name")
             raise RuntimeError
         serialDevice = cnc['device']
+        # reused for every status report
+        self.status = grbl_status.MachineState()
+        # functions called with the (t, state, (x, y, z)) of the status
+        #  reports read while streaming G-code (see handleStatus())
+        self.statusListeners = []
         super(XCarve, self).__init__(serialDevice)
 
     def home(self):
         #### FIXME
         return
 
-    def probe(self):
-        #### FIXME
-        return
+    def sendBlock(self, lines, timeout):
+        """
+        Send a block of command lines, and wait for all of them to complete.
+
+        @param lines List of command lines (that fit in GRBL's RX buffer)
+        @param timeout Max secs to wait for the responses
+
+        The lines are all sent at once, and this returns as soon as each one
+         has been acknowledged (rather than after fixed delays).
+        Returns the list of non-'ok' response lines (e.g., probe reports).
+        """
+        data = "".join(line.strip() + "\n" for line in lines)
+        if len(data) >= GRBL_RX_BUFFER_SIZE:
+            logging.error("Command block too long: %d chars", len(data))
+            raise ValueError
+        end = monotonic() + timeout
+        responses = []
+        with self.lock:
+            self.dev.write(data)
+            acks = 0
+            while acks < len(lines):
+                resp = self.readLine(max(end - monotonic(), 0.0))
+                if resp is None:
+                    logging.error("Timed out waiting for command responses")
+                    raise RuntimeError
+                if resp == "ok":
+                    acks += 1
+                elif resp.startswith("error") or resp.startswith("ALARM"):
+                    logging.error("Command failed: %s (%s)", resp, lines)
+                    raise RuntimeError
+                else:
+                    responses.append(resp)
+        return responses
+
+    def probe(self, zMin, feed=DEF_PROBE_FEED, x=None, y=None, zStart=None,
+              timeout=DEF_PROBE_TIMEOUT):
+        """
+        Run a probe cycle (G38.2) down towards the given Z.
+
+        All positions are in work coordinates (i.e., those of the G-code).
+
+        @param zMin Lowest Z position (in mm) to probe down to
+        @param feed Probing feed rate in mm/min
+        @param x X position to probe at (or None for the current position)
+        @param y Y position to probe at (or None for the current position)
+        @param zStart Z position to (rapid) move to before moving in X/Y and
+         probing (or None to not move in Z first)
+        @param timeout Max secs for the cycle
+
+        Returns the (x, y, z) contact position, in mm, in machine coordinates
+         (as GRBL reports it -- see getWorkOffset()).
+        N.B. GRBL raises an alarm if there's no contact before zMin.
+        """
+        lines = []
+        if zStart is not None:
+            lines.append("G90 G0 Z{0:.3f}".format(zStart))
+        if x is not None or y is not None:
+            cmd = "G90 G0"
+            if x is not None:
+                cmd += " X{0:.3f}".format(x)
+            if y is not None:
+                cmd += " Y{0:.3f}".format(y)
+            lines.append(cmd)
+        lines.append("G90 G38.2 Z{0:.3f} F{1:.1f}".format(zMin, feed))
+        for resp in self.sendBlock(lines, timeout):
+            m = PROBE_PATTERN.match(resp)
+            if m is None:
+                continue
+            if m.group(4) != "1":
+                logging.error("Probe made no contact: %s", resp)
+                raise RuntimeError
+            return float(m.group(1)), float(m.group(2)), float(m.group(3))
+        logging.error("No probe report received")
+        raise RuntimeError
+
+    def probeGrid(self, region, numX, numY, zStart, zMin,
+                  feed=DEF_PROBE_FEED, clearance=DEF_PROBE_CLEARANCE,
+                  path=None):
+        """
+        Probe a grid of points over a region to make a surface height map.
+
+        All positions are in work coordinates (i.e., those of the G-code that
+         the map is used to correct).
+
+        @param region (x0, y0, x1, y1) corners of the region, in mm
+        @param numX Number of grid points in X
+        @param numY Number of grid points in Y
+        @param zStart Z position (in mm) to start from (clear of the surface)
+        @param zMin Lowest Z position (in mm) to probe down to
+        @param feed Probing feed rate in mm/min
+        @param clearance Height (in mm) above the expected surface at which to
+         move to the next point
+        @param path File to save the height map to (as a .npy file), if given
+
+        The points are visited in serpentine order, and each probe cycle is
+         sent as soon as the previous one reports. The move to the next point
+         is made at the clearance above its expected height -- the highest of
+         its probed neighbours and the height extrapolated from the last two
+         points in the direction of travel (the first move is made at zStart).
+        Raises a RuntimeError (after moving up to zStart) if the height
+         changes by more than the clearance between adjacent points, since
+         the next such rise could be hit before it's probed.
+        Returns a (numY, numX, 3) array of the (x, y, z) contact positions.
+        """
+        if numX < 2 or numY < 2:
+            logging.error("Probe grid must be at least 2x2: %dx%d", numX, numY)
+            raise ValueError
+        if clearance <= DEF_PROBE_MIN_TRAVEL:
+            logging.error("Probe clearance too small: %f", clearance)
+            raise ValueError
+        # probe reports are in machine coordinates
+        wco = self.getWorkOffset()
+        if wco is None:
+            logging.error("Unable to get the work coordinate offset")
+            raise RuntimeError
+        wco = np.array(wco, np.float64)
+        x0, y0, x1, y1 = region
+        xs = np.linspace(x0, x1, numX)
+        ys = np.linspace(y0, y1, numY)
+        heights = np.full((numY, numX, 3), np.nan)
+
+        def probed(j, i):
+            # height of a grid point, or None if it hasn't been probed
+            if 0 <= j < numY and 0 <= i < numX and \
+               not np.isnan(heights[j, i, 2]):
+                return heights[j, i, 2]
+            return None
+
+        z = zStart
+        start = monotonic()
+        order = serpentine(numX, numY)
+        for n, (j, i) in enumerate(order):
+            try:
+                contact = self.probe(zMin, feed, xs[i], ys[j], z)
+            except RuntimeError:
+                logging.error("Probe failed at X%.3f Y%.3f (from Z%.3f)",
+                              xs[i], ys[j], z)
+                raise
+            heights[j, i] = np.array(contact, np.float64) - wco
+            contact = heights[j, i, 2]
+            rise = max([abs(contact - h) for h in
+                        (probed(j - 1, i), probed(j, i - 1),
+                         probed(j, i + 1)) if h is not None] + [0.0])
+            if rise > clearance or contact > (z - DEF_PROBE_MIN_TRAVEL):
+                self.moveTo(z=zStart)
+                logging.error("Surface height changes by %.3f mm at X%.3f "
+                              "Y%.3f, more than the clearance (%.3f mm) -- "
+                              "use more points or more clearance", rise,
+                              xs[i], ys[j], clearance)
+                raise RuntimeError
+            if n == 0 or (n + 1) >= len(order):
+                continue
+            # the expected height of the next point
+            nj, ni = order[n + 1]
+            expected = [contact, probed(nj - 1, ni), probed(nj, ni - 1),
+                        probed(nj, ni + 1)]
+            behind = probed((2 * j) - nj, (2 * i) - ni)
+            if behind is not None:
+                expected.append((2.0 * contact) - behind)
+            z = min(max(h for h in expected if h is not None) + clearance,
+                    zStart)
+        self.moveTo(z=zStart)
+        logging.info("Probed %dx%d grid in %.1f secs", numX, numY,
+                     monotonic() - start)
+        if path:
+            np.save(path, heights)
+        return heights
 
     def gotoMaxZ(self):
         #### FIXME
         return
 
+    def getState(self):
+        """
+        Return the machine state (e.g., 'Idle', 'Run') and (x, y, z) position.
+
+        Returns (None, None) if there's no valid status report.
+        """
+        t, state, pos = self.getTimedState()
+        return state, pos
+
+    def getTimedState(self):
+        """
+        Return the (monotonic clock) time at which the status was requested,
+         the machine state, and (x, y, z) position.
+
+        GRBL samples its position as soon as it gets the status request, so
+         the request time is used as the time of the report.
+        Returns (t, None, None) if there's no valid status report.
+        """
+        with self.lock:
+            t = monotonic()
+            status = self.getCurrentStatus()
+            if not status:
+                return t, None, None
+            if not grbl_status.parse(status, self.status):
+                logging.debug("Unrecognized status report: %s", status)
+                return t, None, None
+            return t, self.status.state, self.status.machinePosition()
+
+    def handleStatus(self, t, report):
+        """
+        Parse a status report that was read while streaming G-code, and pass
+         it on to the status listeners (e.g., a StatusPoller).
+        """
+        if not grbl_status.parse(report, self.status):
+            logging.debug("Unrecognized status report: %s", report)
+            return
+        for listener in self.statusListeners:
+            listener(t, self.status.state, self.status.machinePosition())
+
+    def lastWorkOffset(self):
+        """
+        Return the work coordinate offset from the latest status reports
+         (e.g., a StatusPoller's), without polling, or None if it isn't known.
+        """
+        ms = self.status
+        if ms.wco is not None:
+            return ms.wco
+        if ms.mpos is not None and ms.wpos is not None:
+            # GRBL 0.9 reports both positions
+            return tuple(m - w for m, w in zip(ms.mpos, ms.wpos))
+        return None
+
+    def getWorkOffset(self, maxPolls=DEF_WCO_POLLS):
+        """
+        Return the work coordinate offset (machine position minus work
+         position), or None if the machine doesn't report it.
+
+        GRBL 1.1 only includes the offset in some status reports (at least
+         every 30th, and the first one after it changes), so this polls until
+         it has one.
+        """
+        for i in range(maxPolls):
+            with self.lock:
+                self.getTimedState()
+                wco = self.lastWorkOffset()
+            if wco is not None:
+                return wco
+        return None
+
     def getPosition(self):
-        #### FIXME
-        status = self.getCurrentStatus()
-        print("Status: {0}".format(status))
-        x = y = z = None
-        return x, y, z
+        state, pos = self.getState()
+        if pos is None:
+            return None, None, None
+        return pos
+
+    def moveTo(self, x=None, y=None, z=None, feed=None):
+        """
+        Move to the given (absolute) position, in mm.
+
+        @param x X position (or None to not move in X)
+        @param y Y position (or None to not move in Y)
+        @param z Z position (or None to not move in Z)
+        @param feed Feed rate in mm/min (or None for a rapid move)
+
+        N.B. This returns as soon as the move is queued, use waitForIdle() to
+         wait for it to finish.
+        """
+        cmd = "G90 G0" if feed is None else "G90 G1 F{0:.1f}".format(feed)
+        for axis, val, limit in (("X", x, MAX_X), ("Y", y, MAX_Y),
+                                 ("Z", z, MAX_Z)):
+            if val is None:
+                continue
+            if abs(val) > limit:
+                logging.error("%s position out of range: %f", axis, val)
+                raise ValueError
+            cmd += " {0}{1:.3f}".format(axis, val)
+        with self.lock:
+            return self.sendLine(cmd, self.delay)
+
+    def waitForIdle(self, timeout=DEF_IDLE_TIMEOUT):
+        """
+        Wait for the machine to finish all its moves.
+
+        Returns the final (x, y, z) position, or None if the timeout expired.
+        """
+        end = monotonic() + timeout
+        while monotonic() < end:
+            state, pos = self.getState()
+            if state == "Idle":
+                return pos
+            time.sleep(DEF_POLL_INTERVAL)
+        logging.warning("Timed out waiting for machine to be idle")
+        return None
+
+
+def serpentine(numX, numY):
+    """
+    Return the (row, column) indices of a grid in serpentine order -- i.e.,
+     alternate rows are traversed in opposite directions, so consecutive
+     points are always adjacent.
+    """
+    order = []
+    for j in range(numY):
+        cols = range(numX) if (j % 2) == 0 else range(numX - 1, -1, -1)
+        order.extend((j, i) for i in cols)
+    return order
 
 
 #